@@ -14,12 +14,13 @@
 #  * limitations under the License.
 
 import uuid
+from collections import OrderedDict
 
 # Third-party Imports
 from boto import exception
 
 # Cloudify imports
-from . import utils, constants, connection
+from . import cidr, utils, constants, connection
 from cloudify.exceptions import NonRecoverableError, RecoverableError
 from cloudify import ctx
 
@@ -31,6 +32,7 @@ class AwsBase(object):
                  ):
         self.client = \
             client if client else connection.EC2ConnectionClient().client()
+        self.relationship_type_hierarchies = {}
 
     def execute(self, fn, args=None, raise_on_falsy=False):
 
@@ -81,7 +83,9 @@ class AwsBase(object):
         :param relationships: should be ctx.instance.relationships
         or ctx.source/target.instance.relationships
         :return: targets_and_types a dict of structure
-        relationship-type: relationship_target_id
+        relationship-type: relationship_target_id. The type hierarchies
+        of the relationships are kept for
+        get_target_ids_of_relationship_type.
         """
 
         targets_by_relationship_type = dict()
@@ -89,6 +93,8 @@ class AwsBase(object):
         if len(relationships) > 0:
 
             for relationship in relationships:
+                self.relationship_type_hierarchies[relationship.type] = \
+                    utils.get_type_hierarchy(relationship)
                 targets_by_relationship_type.update(
                     {
                         relationship.type:
@@ -109,11 +115,77 @@ class AwsBase(object):
         for current_relationship_type, current_target_id in \
                 targets_by_relationship_type.items():
 
-            if relationship_type in current_relationship_type:
+            type_hierarchy = self.relationship_type_hierarchies.get(
+                current_relationship_type, [current_relationship_type])
+            if relationship_type in utils.get_type_index(type_hierarchy):
                 target_ids.append(current_target_id)
 
         return target_ids
 
+    def add_reference(self, resource_id, prefix, lookup_key=None):
+        """Tags a shared resource as used by the current node instance.
+
+        A resource that was found by its lookup tag is only used if the
+        tag is still there once the reference is added. Otherwise its last
+        user is deleting it, and the reference is removed again.
+
+        :returns whether the resource can be used.
+        """
+
+        reference = utils.get_reference_tag(prefix)
+
+        self.execute(self.client.create_tags, dict(
+            resource_ids=[resource_id], tags={reference: ''}))
+
+        if lookup_key and lookup_key not in self.get_tags(resource_id):
+            self.execute(self.client.delete_tags, dict(
+                resource_ids=[resource_id], tags=[reference]))
+            return False
+
+        return True
+
+    def release_reference(self, resource_id, prefix, lookup_key=None):
+        """Removes the reference of the current node instance from a
+        shared resource.
+
+        When no references are left, the lookup tag that other node
+        instances find the resource by is removed, and the references
+        are counted again. A node instance that found the resource before
+        that keeps it, and the lookup tag is put back.
+
+        :returns the number of references that are left.
+        """
+
+        self.execute(self.client.delete_tags, dict(
+            resource_ids=[resource_id],
+            tags=[utils.get_reference_tag(prefix)]))
+
+        tags = self.get_tags(resource_id)
+        references = len([key for key in tags if key.startswith(prefix)])
+
+        if references or lookup_key not in tags:
+            return references
+
+        lookup = {lookup_key: tags[lookup_key]}
+        self.execute(self.client.delete_tags, dict(
+            resource_ids=[resource_id], tags=lookup))
+
+        references = len([key for key in self.get_tags(resource_id)
+                          if key.startswith(prefix)])
+
+        if references:
+            self.execute(self.client.create_tags, dict(
+                resource_ids=[resource_id], tags=lookup))
+
+        return references
+
+    def get_tags(self, resource_id):
+
+        tags = self.execute(self.client.get_all_tags, dict(
+            filters={'resource-id': resource_id}))
+
+        return dict((tag.name, tag.value) for tag in tags)
+
     def raise_forbidden_external_resource(self, resource_id):
         raise NonRecoverableError(
             'Cannot use_external_resource because resource {0} '
@@ -253,6 +325,10 @@ class AwsBaseRelationship(AwsBase):
 
 class AwsBaseNode(AwsBase):
 
+    # Wait in post_start for a resource that may not be visible in the
+    # describe calls right after it is created
+    wait_for_visible = False
+
     def __init__(self,
                  aws_resource_type,
                  required_properties,
@@ -467,7 +543,15 @@ class AwsBaseNode(AwsBase):
 
     def post_start(self):
 
-        resource = self.get_resource()
+        if self.wait_for_visible:
+            resource = utils.wait_for(self.get_resource, bool)
+            if not resource:
+                return ctx.operation.retry(
+                    message='Waiting for AWS resource {0} to be visible.'
+                    .format(self.resource_id))
+        else:
+            resource = self.get_resource()
+
         self.tag_resource(resource)
 
         return True
@@ -493,6 +577,84 @@ class AwsBaseNode(AwsBase):
 
 class RouteMixin(object):
 
+    def aggregate_routes(self, routes, route_table_id=None):
+        """Returns the routes with the destination blocks of each target
+        collapsed into the fewest blocks that cover the same addresses.
+
+        A collapsed block is not used when the table already routes a part
+        of it to another target with a block that the replaced blocks are
+        more specific than, as that route would take their traffic. The
+        replaced blocks are used instead.
+
+        :param routes: A list of route dicts.
+        :param route_table_id: The table that the routes are added to.
+        """
+
+        existing = []
+        if route_table_id:
+            route_tables = self.execute(
+                self.client.get_all_route_tables,
+                dict(route_table_ids=[route_table_id]))
+            existing = route_tables[0].routes if route_tables else []
+
+        # Destination blocks by everything else in the route
+        destinations = OrderedDict()
+        for route in routes:
+            target = tuple(sorted(
+                (key, value) for key, value in route.items()
+                if key != 'destination_cidr_block'))
+            destinations.setdefault(target, []).append(
+                route['destination_cidr_block'])
+
+        aggregated = []
+        for target, blocks in destinations.items():
+            try:
+                collapsed = cidr.collapse(blocks)
+            except ValueError as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
+            for block in collapsed:
+                replaced = [b for b in blocks if block != b and
+                            cidr.overlaps(block, b)]
+                if replaced and self._shadows(
+                        block, replaced, dict(target), existing):
+                    aggregated.extend(
+                        dict(target, destination_cidr_block=b)
+                        for b in OrderedDict.fromkeys(replaced))
+                else:
+                    aggregated.append(
+                        dict(target, destination_cidr_block=block))
+
+        if len(aggregated) < len(routes):
+            ctx.logger.info('Aggregated {0} routes into {1}.'
+                            .format(len(routes), len(aggregated)))
+
+        return aggregated
+
+    @staticmethod
+    def _shadows(block, replaced, target, existing_routes):
+
+        start, end = cidr.get_range(block)
+
+        for route in existing_routes:
+            if not route.destination_cidr_block or [
+                    key for key in constants.ROUTE_TARGETS
+                    if target.get(key) and
+                    getattr(route, key, None) == target[key]]:
+                continue
+            route_start, route_end = cidr.get_range(
+                route.destination_cidr_block)
+            if not start <= route_start < route_end <= end:
+                continue
+            # The replaced blocks won over the route by being more specific
+            for replaced_block in replaced:
+                replaced_start, replaced_end = cidr.get_range(replaced_block)
+                if route_start <= replaced_start < replaced_end <= route_end \
+                        and replaced_end - replaced_start < \
+                        route_end - route_start:
+                    return True
+
+        return False
+
     def create_route(self, route_table_id,
                      route, route_table_ctx_instance=None):
 
@@ -542,10 +704,9 @@ class RouteMixin(object):
 
     def add_route_to_runtime_properties(self,
                                         route_table_ctx_instance, route):
-        if 'routes' not in \
-                route_table_ctx_instance.runtime_properties.keys():
-            route_table_ctx_instance.runtime_properties['routes'] = []
-        route_table_ctx_instance.runtime_properties['routes'].append(route)
+        routes = self.get_runtime_routes(route_table_ctx_instance)
+        routes.update(utils.encode_routes([route]))
+        route_table_ctx_instance.runtime_properties['routes'] = routes
 
     def delete_route(self, route_table_id,
                      route, route_table_ctx_instance=None):
@@ -574,6 +735,17 @@ class RouteMixin(object):
 
     def remove_route_from_runtime_properties(
             self, route_table_ctx_instance, route):
-        if route in route_table_ctx_instance.runtime_properties['routes']:
-            route_table_ctx_instance.runtime_properties[
-                'routes'].remove(route)
+        routes = self.get_runtime_routes(route_table_ctx_instance)
+        if routes.pop(route['destination_cidr_block'], None) is not None:
+            route_table_ctx_instance.runtime_properties['routes'] = routes
+
+    @staticmethod
+    def get_runtime_routes(route_table_ctx_instance):
+        """Returns the routes runtime property of a route table, indexed
+        by destination block.
+        """
+
+        routes = route_table_ctx_instance.runtime_properties.get('routes')
+        if isinstance(routes, dict):
+            return routes
+        return utils.encode_routes(utils.decode_routes(routes))
@@ -0,0 +1,163 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+from bisect import bisect_left
+
+ADDRESS_BITS = 32
+
+
+def parse_cidr(cidr_block):
+    """Returns the (network, prefix length) of an IPv4 CIDR block, with
+    the network as an integer and its host bits cleared.
+
+    :raises ValueError if cidr_block is not an IPv4 CIDR block.
+    """
+
+    address, _, prefix = cidr_block.partition('/')
+    octets = address.split('.')
+    prefix = int(prefix) if prefix else ADDRESS_BITS
+
+    if len(octets) != 4 or not 0 <= prefix <= ADDRESS_BITS:
+        raise ValueError('Invalid CIDR block {0}'.format(cidr_block))
+
+    network = 0
+    for octet in octets:
+        octet = int(octet)
+        if not 0 <= octet <= 255:
+            raise ValueError('Invalid CIDR block {0}'.format(cidr_block))
+        network = network << 8 | octet
+
+    return network & ~(get_size(prefix) - 1), prefix
+
+
+def format_cidr(network, prefix):
+    return '{0}/{1}'.format(
+        '.'.join(str(network >> shift & 255) for shift in (24, 16, 8, 0)),
+        prefix)
+
+
+def get_size(prefix):
+    return 1 << ADDRESS_BITS - prefix
+
+
+def get_range(cidr_block):
+    """Returns the [start, end) range of addresses of a CIDR block."""
+
+    network, prefix = parse_cidr(cidr_block)
+    return network, network + get_size(prefix)
+
+
+def overlaps(cidr_block, other_cidr_block):
+    start, end = get_range(cidr_block)
+    other_start, other_end = get_range(other_cidr_block)
+    return start < other_end and other_start < end
+
+
+class CidrAllocator(object):
+    """Hands out free, aligned blocks of a parent CIDR block.
+
+    The used address space is kept as a sorted list of disjoint ranges.
+    Finding whether a block is free is a binary search, and the first
+    free block of a size is found in one pass over the gaps.
+    """
+
+    def __init__(self, cidr_block, used=None):
+        self.start, self.end = get_range(cidr_block)
+        self.prefix = parse_cidr(cidr_block)[1]
+        self.used = []
+        for used_block in used or []:
+            self.reserve(used_block)
+
+    def is_free(self, cidr_block):
+        start, end = get_range(cidr_block)
+        if start < self.start or end > self.end:
+            return False
+        index = bisect_left(self.used, (end, end))
+        return not index or self.used[index - 1][1] <= start
+
+    def reserve(self, cidr_block):
+        """Marks a block as used. Blocks outside the parent are ignored."""
+
+        start, end = get_range(cidr_block)
+        start, end = max(start, self.start), min(end, self.end)
+        if start >= end:
+            return
+
+        # Merge the block with the ranges it overlaps or touches
+        index = bisect_left(self.used, (start, end))
+        if index and self.used[index - 1][1] >= start:
+            index -= 1
+            start = self.used[index][0]
+        last = index
+        while last < len(self.used) and self.used[last][0] <= end:
+            end = max(end, self.used[last][1])
+            last += 1
+        self.used[index:last] = [(start, end)]
+
+    def allocate(self, prefix):
+        """Reserves and returns the first free block with a prefix length,
+        or None if the parent block is full.
+        """
+
+        if prefix < self.prefix or prefix > ADDRESS_BITS:
+            raise ValueError(
+                'A /{0} block does not fit in a /{1} block'
+                .format(prefix, self.prefix))
+
+        size = get_size(prefix)
+        candidate = self.start
+
+        for used_start, used_end in self.used + [(self.end, self.end)]:
+            if candidate + size <= used_start:
+                break
+            # The next candidate is the first aligned address after the range
+            candidate = max(candidate, -(-used_end // size) * size)
+        else:
+            return None
+
+        if candidate + size > self.end:
+            return None
+
+        cidr_block = format_cidr(candidate, prefix)
+        self.reserve(cidr_block)
+        return cidr_block
+
+
+def collapse(cidr_blocks):
+    """Returns the fewest CIDR blocks that cover exactly the addresses of
+    the given blocks: overlapping blocks are merged, and adjacent blocks
+    are joined into their supernet where they fill it.
+    """
+
+    ranges = []
+    for start, end in sorted(get_range(block) for block in cidr_blocks):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(end, ranges[-1][1]))
+        else:
+            ranges.append((start, end))
+
+    collapsed = []
+    for start, end in ranges:
+        while start < end:
+            # The largest aligned block that starts here and fits
+            prefix = ADDRESS_BITS
+            while prefix > 0 and not start % get_size(prefix - 1) and \
+                    start + get_size(prefix - 1) <= end:
+                prefix -= 1
+            collapsed.append(format_cidr(start, prefix))
+            start += get_size(prefix)
+
+    return collapsed
@@ -37,11 +37,11 @@ class EC2ConnectionClient():
     def __init__(self):
         self.connection = None
 
-    def client(self):
+    def client(self, aws_config=None):
         """Represents the EC2Connection Client
         """
 
-        aws_config_property = (self._get_aws_config_property() or
+        aws_config_property = (self._get_aws_config_property(aws_config) or
                                self._get_aws_config_from_file())
         if not aws_config_property:
             return EC2Connection()
@@ -60,7 +60,9 @@ class EC2ConnectionClient():
 
         return EC2Connection(**aws_config)
 
-    def _get_aws_config_property(self):
+    def _get_aws_config_property(self, aws_config=None):
+        if aws_config:
+            return aws_config
         node_properties = \
             utils.get_instance_or_source_node_properties()
         return node_properties[constants.AWS_CONFIG_PROPERTY]
@@ -137,11 +139,11 @@ class EC2ConnectionClient():
 
 class ELBConnectionClient(EC2ConnectionClient):
 
-    def client(self):
+    def client(self, aws_config=None):
         """Represents the ELBConnection Client
         """
 
-        aws_config_property = (self._get_aws_config_property() or
+        aws_config_property = (self._get_aws_config_property(aws_config) or
                                self._get_aws_config_from_file())
         if not aws_config_property:
             return ELBConnection()
@@ -207,10 +209,3 @@ class VPCConnectionClient(EC2ConnectionClient):
             del(aws_config["ec2_region_endpoint"])
 
         return VPCConnection(**aws_config)
-
-    def _get_aws_config_property(self, aws_config=None):
-        if aws_config:
-            return aws_config
-        node_properties = \
-            utils.get_instance_or_source_node_properties()
-        return node_properties[constants.AWS_CONFIG_PROPERTY]
@@ -14,20 +14,62 @@
 #    * limitations under the License.
 
 # instance module constants
+INSTANCE_STATE_PENDING = 0
 INSTANCE_STATE_STARTED = 16
+INSTANCE_STATE_SHUTTING_DOWN = 32
 INSTANCE_STATE_TERMINATED = 48
 INSTANCE_STATE_STOPPED = 80
+INSTANCE_WAIT_PROPERTY = 'state_wait'
+
+# Instance state waiter
+WAITER_STATS_PATH_ENV_VAR_NAME = 'CLOUDIFY_AWS_WAITER_STATS_PATH'
+WAITER_STATS_FILE_NAME = 'cloudify-aws-waiter-stats.json'
+WAITER_SAMPLES = 20
+WAITER_MIN_INTERVAL = 2
+WAITER_MAX_INTERVAL = 30
+
+# Instance state poller
+POLLER_FILE_NAME = 'cloudify-aws-poller-{0}.json'
+POLLER_TICK = 5
+POLLER_EXPIRY = 600
+POLLER_CHUNK_SIZE = 200
+POLLER_IN_FLIGHT_TIMEOUT = 60
+POLLER_IN_FLIGHT_WAIT = 0.5
+
+# In-operation wait for resources that settle within seconds, before
+# falling back to an operation retry
+READY_WAIT_TIMEOUT = 10
+READY_WAIT_MIN_INTERVAL = 0.25
+READY_WAIT_MAX_INTERVAL = 2
+
+# Seconds between attempts to delete a resource that is still in use
+DELETE_RETRY_INTERVAL = 10
+
+# Windows password polling
+WINDOWS_PASSWORD_DELAY = 240  # seconds after launch
+WINDOWS_PASSWORD_MIN_INTERVAL = 15
+WINDOWS_PASSWORD_MAX_INTERVAL = 120
+PASSWORD_POLL_PROPERTY = 'password_poll'
+PRIVATE_KEY_CACHE_SIZE = 16
+
+# User data builder
+USERDATA_CACHE_SIZE = 64
 
 # ELB Default Values
 HEALTH_CHECK_INTERVAL = 30
 HEALTH_CHECK_HEALTHY_THRESHOLD = 3
 HEALTH_CHECK_TIMEOUT = 5
 HEALTH_CHECK_UNHEALTHY_THRESHOLD = 5
+HEALTH_CHECK_ATTRIBUTES = ['target', 'interval', 'timeout',
+                           'healthy_threshold', 'unhealthy_threshold']
 
 EXTERNAL_RESOURCE_ID = 'aws_resource_id'
 AVAILABILITY_ZONE = 'availability_zone'
 AWS_CONFIG_PROPERTY = 'aws_config'
 ROUTE_NOT_FOUND_ERROR = 'InvalidRoute.NotFound'
+ROUTE_TARGETS = ['gateway_id', 'instance_id', 'interface_id',
+                 'vpc_peering_connection_id']
+ROUTE_ENCODED_KEYS = ['destination_cidr_block', 'route_table_id']
 
 INSTANCE_INTERNAL_ATTRIBUTES = \
     ['private_dns_name', 'public_dns_name',
@@ -58,7 +100,13 @@ SECURITYGROUP = dict(
         CLOUDIFY_NODE_TYPE='cloudify.aws.nodes.SecurityGroup',
         ID_FORMAT='^sg\-[0-9a-z]{8}$',
         NOT_FOUND_ERROR='InvalidGroup.NotFound',
-        REQUIRED_PROPERTIES=['description', 'rules']
+        DEPENDENCY_VIOLATION='DependencyViolation',
+        REQUIRED_PROPERTIES=['description', 'rules'],
+        PORT_PROTOCOLS=['tcp', 'udp'],
+        PROTOCOL_NAMES={'1': 'icmp', '6': 'tcp', '17': 'udp'},
+        SHARED_PROPERTY='shared',
+        FINGERPRINT_TAG='cloudify-sg-fingerprint',
+        REFERENCE_TAG_PREFIX='cloudify-sg-ref:'
 )
 
 SUBNET = dict(
@@ -66,7 +114,12 @@ SUBNET = dict(
         CLOUDIFY_NODE_TYPE='cloudify.aws.nodes.Subnet',
         ID_FORMAT='^subnet\-[0-9a-z]{8}$',
         NOT_FOUND_ERROR='InvalidSubnetID.NotFound',
-        REQUIRED_PROPERTIES=['cidr_block']
+        REQUIRED_PROPERTIES=['cidr_block'],
+        CIDR_PREFIX_PROPERTY='cidr_prefix',
+        CONFLICT_ERROR='InvalidSubnet.Conflict',
+        CLAIM_TAG_PREFIX='cloudify-cidr-claim:',
+        CLAIM_EXPIRY=300,
+        ALLOCATION_ATTEMPTS=5
 )
 
 VPC = dict(
@@ -88,7 +141,8 @@ ELB = dict(
         AWS_RESOURCE_TYPE='load_balancer',
         CLOUDIFY_NODE_TYPE='cloudify.aws.nodes.ElasticLoadBalancer',
         NOT_FOUND_ERROR='LoadBalancerNotFound',
-        REQUIRED_PROPERTIES=['elb_name', 'zones', 'listeners']
+        REQUIRED_PROPERTIES=['elb_name', 'zones', 'listeners'],
+        IN_SERVICE_STATE='InService'
 )
 
 ELASTICIP = dict(
@@ -98,7 +152,11 @@ ELASTICIP = dict(
         REQUIRED_PROPERTIES=[],
         ALLOCATION_ID='allocation_id',
         VPC_DOMAIN='vpc',
-        ELASTIC_IP_DOMAIN_PROPERTY='domain'
+        ELASTIC_IP_DOMAIN_PROPERTY='domain',
+        POOL_PROPERTY='pool',
+        POOL_TAG='cloudify-eip-pool',
+        CLAIM_TAG='cloudify-eip-claim',
+        INTENT_TAG='cloudify-eip-intent'
 )
 
 ZONE = 'zone'
@@ -154,12 +212,36 @@ CUSTOMER_GATEWAY = dict(
         REQUIRED_PROPERTIES=[]
 )
 
+VPN_CONNECTION = dict(
+        NOT_FOUND_ERROR='InvalidVpnConnectionID.NotFound',
+        DELETED_STATES=['deleting', 'deleted'],
+        ROUTE_THREADS=16
+)
+
+GATEWAY_ATTACHMENT = dict(
+        ATTACHED_STATES=['attached', 'available'],
+        DETACHED_STATE='detached',
+        RETRY_INTERVAL=5
+)
+
 DHCP_OPTIONS = dict(
         AWS_RESOURCE_TYPE='dhcp_options',
         CLOUDIFY_NODE_TYPE='cloudify.aws.nodes.DHCPOptions',
         ID_FORMAT='^dopt\-[0-9a-z]{8}$',
         NOT_FOUND_ERROR='InvalidDhcpOptionID.NotFound',
-        REQUIRED_PROPERTIES=[]
+        REQUIRED_PROPERTIES=[],
+        REUSE_PROPERTY='reuse',
+        HASH_TAG='cloudify-dhcp-options-hash',
+        REFERENCE_TAG_PREFIX='cloudify-dhcp-options-ref:',
+        DEPENDENCY_VIOLATION='DependencyViolation'
+)
+
+NETWORK_STACK = dict(
+        CLOUDIFY_NODE_TYPE='cloudify.aws.nodes.NetworkStack',
+        DEPENDENCY_VIOLATION='DependencyViolation',
+        THREADS=16,
+        RUNTIME_PROPERTIES=['vpc_id', 'internet_gateway_id', 'subnet_ids',
+                            'route_table_ids', 'network_acl_ids']
 )
 
 GATEWAY_VPC_RELATIONSHIP = \
@@ -180,6 +262,8 @@ VPC_PEERING_RELATIONSHIP = \
     'cloudify.aws.relationships.vpc_connected_to_peer'
 DHCP_VPC_RELATIONSHIP = \
     'cloudify.aws.relationships.dhcp_options_associated_with_vpc'
+NETWORK_STACK_VPC_RELATIONSHIP = \
+    'cloudify.aws.relationships.network_stack_contained_in_vpc'
 CUSTOMER_VPC_RELATIONSHIP = \
     'cloudify.aws.relationships.customer_gateway_connected_to_vpn_gateway'
 
@@ -188,9 +272,12 @@ INSTANCE_INTERNAL_ATTRIBUTES_POST_CREATE = \
 AGENTS_SECURITY_GROUP = 'agents_security_group'
 AGENTS_KEYPAIR = 'agents_keypair'
 AGENTS_AWS_INSTANCE_PARAMETERS = 'agents_instance_parameters'
-INSTANCE_KEYPAIR_RELATIONSHIP = 'instance_connected_to_keypair'
-INSTANCE_SUBNET_RELATIONSHIP = 'instance_contained_in_subnet'
-INSTANCE_SUBNET_CONNECTED_TO_RELATIONSHIP = 'instance_connected_to_subnet'
+INSTANCE_KEYPAIR_RELATIONSHIP = \
+    'cloudify.aws.relationships.instance_connected_to_keypair'
+INSTANCE_SUBNET_RELATIONSHIP = \
+    'cloudify.aws.relationships.instance_contained_in_subnet'
+INSTANCE_SUBNET_CONNECTED_TO_RELATIONSHIP = \
+    'cloudify.aws.relationships.instance_connected_to_subnet'
 
 ADMIN_PASSWORD_PROPERTY = 'password'  # the server's password
 
@@ -216,6 +303,8 @@ BOTO_CONFIG_SCHEMA = {
     'Boto': ['ec2_region_name', 'ec2_region_endpoint']
 }
 
-INSTANCE_SECURITY_GROUP_RELATIONSHIP = 'instance_connected_to_security_group'
-SECURITY_GROUP_VPC_RELATIONSHIP = 'security_group_contained_in_vpc'
+INSTANCE_SECURITY_GROUP_RELATIONSHIP = \
+    'cloudify.aws.relationships.instance_connected_to_security_group'
+SECURITY_GROUP_VPC_RELATIONSHIP = \
+    'cloudify.aws.relationships.security_group_contained_in_vpc'
 RUNTIME_PROPERTIES = [AWS_TYPE_PROPERTY, EXTERNAL_RESOURCE_ID]
@@ -233,7 +233,8 @@ class Ebs(AwsBaseNode):
 
         return ctx.operation.retry(
                 message='Failed to delete volume {0}. Retrying...'
-                .format(self.resource_id))
+                .format(self.resource_id),
+                retry_after=constants.DELETE_RETRY_INTERVAL)
 
     def post_delete(self):
 
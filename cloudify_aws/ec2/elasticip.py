@@ -34,6 +34,11 @@ def create(args=None, **_):
     return ElasticIP().created(args)
 
 
+@operation
+def top_up_pool(**_):
+    return ElasticIP().top_up_pool()
+
+
 @operation
 def delete(args=None, **_):
     return ElasticIP().deleted(args)
@@ -79,6 +84,12 @@ class ElasticIPInstanceConnection(AwsBaseRelationship):
                      ctx.target.instance.runtime_properties[
                              constants.ELASTICIP['ALLOCATION_ID']]})
 
+        # A pooled address that was claimed twice must not be taken from
+        # the instance it is already associated with
+        if constants.ELASTICIP['POOL_PROPERTY'] in \
+                ctx.target.instance.runtime_properties:
+            associate_args['allow_reassociation'] = False
+
         associate_args = utils.update_args(associate_args, args)
 
         try:
@@ -178,6 +189,198 @@ class ElasticIPInstanceConnection(AwsBaseRelationship):
         return addresses[0] if addresses else addresses
 
 
+class ElasticIPPool(object):
+    """A set of pre-allocated VPC Elastic IPs that share a pool tag.
+
+    An address is claimed by tagging it with the id of its owner, see
+    _tag_claim. Associating a pooled address does not allow
+    reassociation, so an address that is still claimed twice fails to
+    associate instead of being taken from its instance. Addresses are
+    indexed by allocation id, which is the only id that can be tagged.
+    """
+
+    def __init__(self, client, name, size=0):
+        self.client = client
+        self.name = name
+        self.size = size
+        self.addresses = None
+        self.claims = None
+
+    def refresh(self):
+        """Reads the pool membership, the claims of its addresses and the
+        addresses with two DescribeTags and one DescribeAddresses call.
+        """
+
+        tags = self._execute(self.client.get_all_tags, dict(
+            filters={'key': constants.ELASTICIP['POOL_TAG'],
+                     'value': self.name}))
+        members = list(set(tag.res_id for tag in tags))
+
+        self.claims = {}
+        self.addresses = {}
+        if not members:
+            return self.addresses
+
+        tags = self._execute(self.client.get_all_tags, dict(
+            filters={'key': constants.ELASTICIP['CLAIM_TAG'],
+                     'resource-id': members}))
+        for tag in tags:
+            self.claims[tag.res_id] = tag.value
+
+        addresses = self._execute(self.client.get_all_addresses, dict(
+            allocation_ids=members))
+        for address in addresses:
+            if address.allocation_id in members:
+                self.addresses[address.allocation_id] = address
+
+        return self.addresses
+
+    def get_address(self, allocation_id):
+
+        if self.addresses is None:
+            self.refresh()
+
+        return self.addresses.get(allocation_id)
+
+    def get_free(self):
+
+        if self.addresses is None:
+            self.refresh()
+
+        return [allocation_id for allocation_id, address
+                in sorted(self.addresses.items())
+                if not self.claims.get(allocation_id) and
+                not address.association_id and not address.instance_id]
+
+    def claim(self, owner):
+        """Returns an address of the pool claimed by owner, allocating
+        a new one only if the pool is empty.
+        """
+
+        if self.addresses is None:
+            self.refresh()
+
+        for allocation_id, claimed_by in self.claims.items():
+            if claimed_by == owner and allocation_id in self.addresses:
+                return self.addresses[allocation_id]
+
+        for allocation_id in self.get_free():
+            if self._tag_claim(allocation_id, owner):
+                return self.addresses[allocation_id]
+
+        # The address joins the pool already claimed, no one else can
+        # claim it
+        return self.allocate(owner)
+
+    def release(self, allocation_id, owner):
+        """Returns an address to the pool. Only a claim made by owner
+        is removed, together with its claim intent if one was left.
+        """
+
+        self._execute(self.client.delete_tags, dict(
+            resource_ids=[allocation_id],
+            tags={constants.ELASTICIP['CLAIM_TAG']: owner,
+                  self._get_intent_tag(owner): None}))
+
+        if self.claims is not None:
+            self.claims.pop(allocation_id, None)
+
+    def top_up(self):
+        """Allocates addresses until the pool has size free addresses."""
+
+        missing = self.size - len(self.get_free())
+
+        for _ in range(missing):
+            self.allocate()
+
+        return max(missing, 0)
+
+    def allocate(self, owner=None):
+        """Allocates an address to the pool, claimed by owner if given.
+        The pool and claim tags are written together.
+        """
+
+        address = self._execute(
+            self.client.allocate_address,
+            dict(domain=constants.ELASTICIP['VPC_DOMAIN']))
+
+        tags = {constants.ELASTICIP['POOL_TAG']: self.name}
+        if owner:
+            tags[constants.ELASTICIP['CLAIM_TAG']] = owner
+        self._execute(self.client.create_tags, dict(
+            resource_ids=[address.allocation_id], tags=tags))
+
+        if self.addresses is not None:
+            self.addresses[address.allocation_id] = address
+        if owner and self.claims is not None:
+            self.claims[address.allocation_id] = owner
+
+        ctx.logger.info(
+            'Allocated Elastic IP {0} to pool {1}.'
+            .format(address.public_ip, self.name))
+
+        return address
+
+    def _tag_claim(self, allocation_id, owner):
+        """Claims a free address, returns whether owner got it.
+
+        Tag writes are not conditional, the last write wins. So every
+        owner first tags the address with an intent of its own, a key
+        that no other owner writes, and then reads all tags of the
+        address back. Only an owner that sees neither a claim nor the
+        intent of another owner writes its claim. Of two owners that
+        race, the one that reads last sees the other one, so at most one
+        of them gets the address. The intent is removed either way.
+        """
+
+        intent_tag = self._get_intent_tag(owner)
+        self._execute(self.client.create_tags, dict(
+            resource_ids=[allocation_id], tags={intent_tag: owner}))
+
+        tags = self._execute(self.client.get_all_tags, dict(
+            filters={'resource-id': allocation_id}))
+        claimed_by = None
+        contended = False
+        for tag in tags:
+            if tag.name == constants.ELASTICIP['CLAIM_TAG']:
+                claimed_by = tag.value
+            elif tag.name != intent_tag and tag.name.startswith(
+                    constants.ELASTICIP['INTENT_TAG']):
+                contended = True
+
+        if not claimed_by and not contended:
+            self._execute(self.client.create_tags, dict(
+                resource_ids=[allocation_id],
+                tags={constants.ELASTICIP['CLAIM_TAG']: owner}))
+            claimed_by = owner
+
+        self._execute(self.client.delete_tags, dict(
+            resource_ids=[allocation_id], tags={intent_tag: None}))
+
+        self.claims[allocation_id] = claimed_by
+
+        if claimed_by != owner:
+            ctx.logger.debug(
+                'Elastic IP {0} of pool {1} was claimed by {2}.'
+                .format(allocation_id, self.name,
+                        claimed_by or 'another owner'))
+            return False
+
+        return True
+
+    def _get_intent_tag(self, owner):
+        return '{0}:{1}'.format(constants.ELASTICIP['INTENT_TAG'], owner)
+
+    def _execute(self, fn, args):
+
+        try:
+            return fn(**args)
+        except (exception.EC2ResponseError,
+                exception.BotoServerError) as e:
+            raise NonRecoverableError(
+                'Elastic IP pool {0}: {1}'.format(self.name, str(e)))
+
+
 class ElasticIP(AwsBaseNode):
 
     def __init__(self):
@@ -191,10 +394,14 @@ class ElasticIP(AwsBaseNode):
             'function': self.client.get_all_addresses,
             'argument': 'addresses'
         }
+        self.pool = self._get_pool()
 
     def create(self, args=None, **_):
         """This allocates an Elastic IP in the connected account."""
 
+        if self.pool:
+            return self._claim_from_pool()
+
         ctx.logger.debug('Attempting to allocate elasticip.')
 
         provider_variables = utils.get_provider_variables()
@@ -225,11 +432,87 @@ class ElasticIP(AwsBaseNode):
 
         return True
 
+    def _claim_from_pool(self):
+
+        address = self.pool.claim(self._get_pool_owner())
+
+        ctx.logger.info(
+            'Claimed Elastic IP {0} from pool {1}.'
+            .format(address.public_ip, self.pool.name))
+
+        ctx.instance.runtime_properties[constants.ELASTICIP[
+            'ALLOCATION_ID']] = address.allocation_id
+        ctx.instance.runtime_properties[constants.ELASTICIP[
+            'POOL_PROPERTY']] = self.pool.name
+        self.allocation_id = address.allocation_id
+        self.resource_id = address.public_ip
+
+        return True
+
+    def top_up_pool(self):
+        """Allocates the free addresses the pool is missing. This runs
+        after the address of the node instance is claimed, and a failure
+        only leaves the pool short until the next top up.
+        """
+
+        if not self.pool:
+            return False
+
+        try:
+            allocated = self.pool.top_up()
+        except NonRecoverableError as e:
+            ctx.logger.warn(
+                'Unable to top up Elastic IP pool {0}: {1}'
+                .format(self.pool.name, str(e)))
+            return False
+
+        ctx.logger.debug(
+            'Allocated {0} Elastic IPs to pool {1}.'
+            .format(allocated, self.pool.name))
+
+        return True
+
+    def _release_to_pool(self):
+
+        allocation_id = ctx.instance.runtime_properties.get(
+            constants.ELASTICIP['ALLOCATION_ID'])
+
+        self.pool.release(allocation_id, self._get_pool_owner())
+
+        ctx.logger.info(
+            'Returned Elastic IP {0} to pool {1}.'
+            .format(self.resource_id, self.pool.name))
+
+        utils.unassign_runtime_properties_from_resource(
+            [constants.ELASTICIP['ALLOCATION_ID'],
+             constants.ELASTICIP['POOL_PROPERTY']], ctx.instance)
+
+        return True
+
+    def _get_pool(self):
+
+        pool = ctx.node.properties.get(
+            constants.ELASTICIP['POOL_PROPERTY']) or {}
+
+        if not pool.get('enabled'):
+            return None
+
+        return ElasticIPPool(
+            self.client,
+            pool.get('name') or ctx.deployment.id,
+            pool.get('size', 0))
+
+    def _get_pool_owner(self):
+        return '{0}:{1}'.format(ctx.deployment.id, ctx.instance.id)
+
     def delete(self, args=None, **_):
         """This releases an Elastic IP created by Cloudify
         in the connected account.
         """
 
+        if self.pool:
+            return self._release_to_pool()
+
         address_object = self.get_resource()
 
         if not address_object:
@@ -287,6 +570,12 @@ class ElasticIP(AwsBaseNode):
 
     def get_resource(self):
 
+        allocation_id = ctx.instance.runtime_properties.get(
+            constants.ELASTICIP['ALLOCATION_ID'])
+
+        if self.pool and allocation_id:
+            return self.pool.get_address(allocation_id)
+
         resources = self.get_all_matching(self.resource_id)
 
         if resources:
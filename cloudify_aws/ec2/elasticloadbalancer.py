@@ -42,8 +42,8 @@ def delete(args=None, **_):
 
 
 @operation
-def associate(args=None, **_):
-    return ElbInstanceConnection().associated(args)
+def associate(args=None, wait_for_health=False, **_):
+    return ElbInstanceConnection().associated(args, wait_for_health)
 
 
 @operation
@@ -51,6 +51,38 @@ def disassociate(args=None, **_):
     return ElbInstanceConnection().disassociated(args)
 
 
+def get_load_balancers_by_name(client, load_balancer_names=None):
+    """Describes load balancers and indexes them by name.
+
+    Follows the DescribeLoadBalancers marker so that every page of the
+    result is collected with one request per page.
+
+    :param client: An ELBConnection.
+    :param load_balancer_names: An optional list of names to describe.
+    :returns a dict of load balancer name to load balancer object.
+    :raises NonRecoverableError: If Boto errors.
+    """
+
+    load_balancers = {}
+    marker = None
+
+    while True:
+        try:
+            page = client.get_all_load_balancers(
+                load_balancer_names=load_balancer_names, marker=marker)
+        except exception.BotoServerError as e:
+            if constants.ELB['NOT_FOUND_ERROR'] in str(e):
+                return load_balancers
+            raise NonRecoverableError('{0}'.format(str(e)))
+
+        for load_balancer in page:
+            load_balancers[load_balancer.name] = load_balancer
+
+        marker = getattr(page, 'next_marker', None)
+        if not marker:
+            return load_balancers
+
+
 class ElbInstanceConnection(AwsBaseRelationship):
 
     def __init__(self, client=None):
@@ -58,6 +90,7 @@ class ElbInstanceConnection(AwsBaseRelationship):
         super(ElbInstanceConnection, self).__init__(client=self.client)
         self.not_found_error = 'InvalidInstanceID.NotFound.'
         self.resource_id = None
+        self.load_balancers = None
         self.source_get_all_handler = {
             'function': self.client.get_all_load_balancers,
             'argument': (
@@ -65,6 +98,86 @@ class ElbInstanceConnection(AwsBaseRelationship):
             )
         }
 
+    def associated(self, args=None, wait_for_health=False):
+
+        if wait_for_health and ctx.operation.retry_number > 0 and \
+                self.source_resource_id in self._get_instance_list():
+            ctx.logger.info(
+                'Instance {0} already registered to Load Balancer {1}.'
+                .format(self.source_resource_id, self.target_resource_id))
+        else:
+            super(ElbInstanceConnection, self).associated(args)
+
+        # An external source instance is not registered by this operation,
+        # so there is no health to wait for
+        if not wait_for_health or self.source_is_external_resource:
+            return True
+
+        return self.wait_for_instance_health()
+
+    def wait_for_instance_health(self, instances=None):
+        """Checks the health of the registered instances with a single
+        DescribeInstanceHealth call and retries the operation until all
+        of them are InService.
+
+        The retry interval starts at the time the load balancer takes to
+        mark an instance healthy, and doubles from there, bounded by the
+        time it takes to mark an instance unhealthy.
+        """
+
+        instances = instances or [self.source_resource_id]
+
+        try:
+            states = self.execute(
+                self.client.describe_instance_health,
+                dict(load_balancer_name=self.target_resource_id,
+                     instances=instances))
+        except (exception.EC2ResponseError,
+                exception.BotoServerError,
+                exception.BotoClientError) as e:
+            raise NonRecoverableError(
+                'Unable to describe instance health on Load Balancer '
+                '{0}: {1}'.format(self.target_resource_id, str(e)))
+
+        pending = [state.instance_id for state in states
+                   if state.state != constants.ELB['IN_SERVICE_STATE']]
+
+        if not pending:
+            ctx.logger.info(
+                'Instances {0} are InService on Load Balancer {1}.'
+                .format(instances, self.target_resource_id))
+            return True
+
+        retry_after = self._get_health_poll_interval(
+            ctx.operation.retry_number)
+
+        return ctx.operation.retry(
+            message='Waiting for instances {0} to be InService on Load '
+                    'Balancer {1}. Retrying...'
+                    .format(pending, self.target_resource_id),
+            retry_after=retry_after)
+
+    def _get_health_poll_interval(self, retry_number):
+
+        lb = self.get_target_resource()
+        health_check = lb.health_check if lb else None
+
+        interval = int(getattr(health_check, 'interval', None) or
+                       constants.HEALTH_CHECK_INTERVAL)
+        healthy_threshold = int(
+            getattr(health_check, 'healthy_threshold', None) or
+            constants.HEALTH_CHECK_HEALTHY_THRESHOLD)
+        unhealthy_threshold = int(
+            getattr(health_check, 'unhealthy_threshold', None) or
+            constants.HEALTH_CHECK_UNHEALTHY_THRESHOLD)
+
+        # An instance needs healthy_threshold consecutive passing checks
+        # before it can be InService, so there is no point asking sooner.
+        first = interval * healthy_threshold
+
+        return min(first * 2 ** retry_number,
+                   max(first, interval * unhealthy_threshold))
+
     def associate(self, args=None, **_):
 
         elb_name = self.target_resource_id
@@ -134,6 +247,10 @@ class ElbInstanceConnection(AwsBaseRelationship):
                 ctx.target.instance.runtime_properties.keys():
             ctx.target.instance.runtime_properties['instance_list'] = []
 
+        if instance_id in \
+                ctx.target.instance.runtime_properties['instance_list']:
+            return
+
         ctx.target.instance.runtime_properties['instance_list'] \
             .append(instance_id)
 
@@ -147,19 +264,24 @@ class ElbInstanceConnection(AwsBaseRelationship):
 
         ctx.logger.info('Attempting to get Load Balancer Instance List.')
 
-        elb_name = ctx.node.properties['elb_name']
-        lb = self.get_target_resource(elb_name)
-        list_of_instances = lb.instances
-        self.resource_id = \
-            lb.name
+        lb = self.get_target_resource()
 
-        return list_of_instances
+        if not lb:
+            return []
+
+        self.resource_id = lb.name
+
+        return [instance.id for instance in lb.instances]
 
     def get_target_resource(self, elb_name=None):
-        return self.filter_for_single_resource(
-            self.get_all_handler['function'],
-            [elb_name]
-        )
+
+        elb_name = elb_name or self.target_resource_id
+
+        if self.load_balancers is None:
+            self.load_balancers = \
+                get_load_balancers_by_name(self.client, [elb_name])
+
+        return self.load_balancers.get(elb_name)
 
 
 class Elb(AwsBaseNode):
@@ -176,6 +298,7 @@ class Elb(AwsBaseNode):
             'function': self.client.get_all_load_balancers,
             'argument': '{0}_names'.format(constants.ELB['AWS_RESOURCE_TYPE'])
         }
+        self.load_balancers = None
 
     def create(self, args=None, **_):
 
@@ -184,8 +307,12 @@ class Elb(AwsBaseNode):
         health_checks = ctx.node.properties.get('health_checks')
 
         if health_checks:
+            current_lb = self.get_resource(refresh=True)
+            current_health_check = \
+                current_lb.health_check if current_lb else None
             for health_check in health_checks:
-                self._add_health_check_to_elb(lb, health_check)
+                current_health_check = self._add_health_check_to_elb(
+                    lb, health_check, current_health_check)
 
         return True
 
@@ -238,9 +365,22 @@ class Elb(AwsBaseNode):
             ctx.instance.runtime_properties.pop('elb_name')
         return True
 
-    def _add_health_check_to_elb(self, elb, health_check):
+    def _add_health_check_to_elb(self, elb, health_check,
+                                 current_health_check=None):
+        """Configures a health check on the load balancer, unless the
+        load balancer is already configured with the same settings.
+
+        :returns the health check that is now in effect.
+        """
 
         hc = self._create_health_check(health_check)
+
+        if self._health_check_matches(current_health_check, hc):
+            ctx.logger.info(
+                'Health check {0} is already configured on Load Balancer '
+                '{1}.'.format(hc.target, elb.name))
+            return current_health_check
+
         add_hc_args = dict(
             name=elb.name,
             health_check=hc
@@ -259,6 +399,20 @@ class Elb(AwsBaseNode):
             'Health check added to Load Balancer {0}.'
             .format(elb.name))
 
+        return hc
+
+    def _health_check_matches(self, current_health_check, health_check):
+
+        if not current_health_check:
+            return False
+
+        for attribute in constants.HEALTH_CHECK_ATTRIBUTES:
+            if str(getattr(current_health_check, attribute, None)) != \
+                    str(getattr(health_check, attribute, None)):
+                return False
+
+        return True
+
     def _create_elb_params(self):
         params_dict = {'listeners': ctx.node.properties['listeners'],
                        'name': ctx.node.properties['elb_name'],
@@ -292,5 +446,12 @@ class Elb(AwsBaseNode):
 
         return health_check
 
-    def get_resource(self):
-        return self.resource_id
+    def get_resource(self, refresh=False):
+
+        elb_name = self.resource_id or ctx.node.properties['elb_name']
+
+        if self.load_balancers is None or refresh:
+            self.load_balancers = \
+                get_load_balancers_by_name(self.client, [elb_name])
+
+        return self.load_balancers.get(elb_name)
@@ -14,14 +14,16 @@
 #    * limitations under the License.
 
 import os
+import time
+import calendar
+from datetime import datetime
 
 # Third-party Imports
 from boto import exception
 
 # Cloudify imports
 from cloudify import ctx
-from cloudify import compute
-from cloudify_aws.ec2 import passwd
+from cloudify_aws.ec2 import passwd, poller, userdata, waiter
 from cloudify.decorators import operation
 from cloudify_aws.base import AwsBaseNode
 from cloudify_aws import utils, constants
@@ -72,6 +74,8 @@ class Instance(AwsBaseNode):
             'argument': '{0}_ids'.format(constants
                                          .INSTANCE['AWS_RESOURCE_TYPE'])
         }
+        self._instance = None
+        self._password_retry_after = None
 
     def creation_validation(self, **_):
 
@@ -103,6 +107,8 @@ class Instance(AwsBaseNode):
         if instance is None:
             return False
 
+        self._instance = instance
+
         utils.set_external_resource_id(
                 instance_id, ctx.instance, external=False)
         self._instance_created_assign_runtime_properties()
@@ -132,41 +138,42 @@ class Instance(AwsBaseNode):
 
         instance_id = self.resource_id
 
-        self._assign_runtime_properties_to_instance(
-                    runtime_properties=constants.INSTANCE_INTERNAL_ATTRIBUTES)
+        state = self._get_instance_state()
 
-        if self._get_instance_state() == constants.INSTANCE_STATE_STARTED:
-            if ctx.node.properties['use_password']:
-                password_success = self._retrieve_windows_pass(
-                        instance_id=instance_id,
-                        private_key_path=private_key_path)
-                if not password_success:
-                    return False
-            return True
+        if state == constants.INSTANCE_STATE_PENDING:
+            return False
 
-        ctx.logger.debug('Attempting to start instance: {0}.)'
-                         .format(instance_id))
+        if state != constants.INSTANCE_STATE_STARTED:
 
-        try:
-            self.execute(self.client.start_instances,
-                         dict(instance_ids=instance_id),
-                         raise_on_falsy=True)
-        except (exception.EC2ResponseError,
-                exception.BotoServerError) as e:
-            raise NonRecoverableError('{0}'.format(str(e)))
+            ctx.logger.debug('Attempting to start instance: {0}.)'
+                             .format(instance_id))
 
-        ctx.logger.debug('Attempted to start instance {0}.'
-                         .format(instance_id))
+            try:
+                self.execute(self.client.start_instances,
+                             dict(instance_ids=instance_id),
+                             raise_on_falsy=True)
+            except (exception.EC2ResponseError,
+                    exception.BotoServerError) as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
 
-        if self._get_instance_state() == constants.INSTANCE_STATE_STARTED:
-            if ctx.node.properties['use_password']:
-                password_success = self._retrieve_windows_pass(
-                        instance_id=instance_id,
-                        private_key_path=private_key_path)
-                if not password_success:
-                    return False
-        else:
-            return False
+            ctx.logger.debug('Attempted to start instance {0}.'
+                             .format(instance_id))
+
+            # The start request changed the instance, describe it again
+            self._instance = None
+            if self._get_instance_attribute('state_code') != \
+                    constants.INSTANCE_STATE_STARTED:
+                return False
+
+        self._assign_runtime_properties_to_instance(
+                    runtime_properties=constants.INSTANCE_INTERNAL_ATTRIBUTES)
+
+        if ctx.node.properties['use_password']:
+            password_success = self._retrieve_windows_pass(
+                    instance_id=instance_id,
+                    private_key_path=private_key_path)
+            if not password_success:
+                return False
         return True
 
     def started(self, args=None, start_retry_interval=5,
@@ -179,11 +186,33 @@ class Instance(AwsBaseNode):
 
         if self.use_external_resource_naively() or \
                 self.start(args, start_retry_interval, private_key_path):
+            self._state_reached(constants.INSTANCE_STATE_STARTED)
             return self.post_start()
 
+        if self._password_retry_after is not None:
+            self._state_reached(constants.INSTANCE_STATE_STARTED)
+            return ctx.operation.retry(
+                    message='Waiting for the server password. Retrying...',
+                    retry_after=self._password_retry_after)
+
         return ctx.operation.retry(
                 message='Waiting server to be running. Retrying...',
-                retry_after=start_retry_interval)
+                retry_after=self._get_state_waiter(
+                    constants.INSTANCE_STATE_STARTED,
+                    start_retry_interval).next_interval())
+
+    def _get_state_waiter(self, state, max_interval=None):
+        # The boto instance is not described on every retry, the node
+        # properties are always there
+        return waiter.InstanceStateWaiter(
+            ctx.node.properties.get('image_id'),
+            ctx.node.properties.get('instance_type'),
+            state, max_interval)
+
+    def _state_reached(self, state):
+        self._get_state_waiter(state).done()
+        if self.resource_id:
+            poller.InstanceStatePoller(self.client).release(self.resource_id)
 
     def _get_private_key(self, private_key_path):
         pk_node_by_rel = \
@@ -232,12 +261,73 @@ class Instance(AwsBaseNode):
     def _get_windows_password(self,
                               instance_id,
                               private_key_path):
+
+        retry_after = self._get_password_poll_delay()
+        if retry_after > 0:
+            ctx.logger.debug('Password data is not expected yet, '
+                             'next poll in {0} seconds'.format(retry_after))
+            self._password_retry_after = retry_after
+            return None
+
         password_data = self.client.get_password_data(instance_id=instance_id)
         if not password_data:
+            self._password_retry_after = self._schedule_password_poll()
             return None
 
+        ctx.instance.runtime_properties.pop(
+                constants.PASSWORD_POLL_PROPERTY, None)
+
         return passwd.get_windows_passwd(private_key_path, password_data)
 
+    def _get_password_poll_delay(self):
+        """Returns the number of seconds until the password data should be
+        polled for.
+
+        Windows generates the password a few minutes after the instance
+        was launched, so the first poll is not made before that. After
+        that, the polls follow the schedule kept in the runtime properties.
+        """
+
+        poll = ctx.instance.runtime_properties.get(
+                constants.PASSWORD_POLL_PROPERTY)
+
+        if poll:
+            not_before = poll['next']
+        else:
+            not_before = self._get_launched_at() + \
+                constants.WINDOWS_PASSWORD_DELAY
+
+        return int(max(0, not_before - time.time()))
+
+    def _schedule_password_poll(self):
+        """Schedules the next password data poll with an exponential
+        backoff and returns the number of seconds until it.
+        """
+
+        poll = ctx.instance.runtime_properties.get(
+                constants.PASSWORD_POLL_PROPERTY) or {}
+        attempts = poll.get('attempts', 0)
+        interval = min(
+                constants.WINDOWS_PASSWORD_MIN_INTERVAL * 2 ** attempts,
+                constants.WINDOWS_PASSWORD_MAX_INTERVAL)
+
+        ctx.instance.runtime_properties[constants.PASSWORD_POLL_PROPERTY] = \
+            {'attempts': attempts + 1, 'next': time.time() + interval}
+
+        return interval
+
+    def _get_launched_at(self):
+
+        launch_time = self._get_instance_attribute('launch_time')
+
+        try:
+            launched_at = datetime.strptime(
+                    launch_time, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except (TypeError, ValueError):
+            return 0
+
+        return calendar.timegm(launched_at.timetuple())
+
     def stop(self, args=None, **_):
 
         instance_id = self.resource_id
@@ -259,16 +349,27 @@ class Instance(AwsBaseNode):
 
         instance_id = self.resource_id
 
-        try:
-            self.execute(self.client.terminate_instances,
-                         dict(instance_ids=instance_id),
-                         raise_on_falsy=True)
-        except (exception.EC2ResponseError,
-                exception.BotoServerError) as e:
-            raise NonRecoverableError('{0}'.format(str(e)))
+        state = poller.InstanceStatePoller(self.client).get_state(
+                instance_id)
 
-        if self._get_instance_state() == \
-                constants.INSTANCE_STATE_TERMINATED:
+        # An instance that is already shutting down was terminated by an
+        # earlier attempt or in bulk, so it is only waited for
+        if state not in (constants.INSTANCE_STATE_SHUTTING_DOWN,
+                         constants.INSTANCE_STATE_TERMINATED):
+
+            try:
+                self.execute(self.client.terminate_instances,
+                             dict(instance_ids=instance_id),
+                             raise_on_falsy=True)
+            except (exception.EC2ResponseError,
+                    exception.BotoServerError) as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
+
+            # The terminate request changed the instance, describe it again
+            self._instance = None
+            state = self._get_instance_attribute('state_code')
+
+        if state == constants.INSTANCE_STATE_TERMINATED:
             ctx.logger.info('Terminated instance: {0}.'.format(instance_id))
             utils.unassign_runtime_property_from_resource(
                     constants.EXTERNAL_RESOURCE_ID, ctx.instance)
@@ -283,10 +384,13 @@ class Instance(AwsBaseNode):
                         self.cloudify_node_instance_id))
 
         if self.delete_external_resource_naively() or self.delete(args):
+            self._state_reached(constants.INSTANCE_STATE_TERMINATED)
             return self.post_delete()
 
         return ctx.operation.retry(
-                message='Waiting server to terminate. Retrying...')
+                message='Waiting server to terminate. Retrying...',
+                retry_after=self._get_state_waiter(
+                    constants.INSTANCE_STATE_TERMINATED).next_interval())
 
     def _run_instances_if_needed(self, create_args):
 
@@ -377,7 +481,8 @@ class Instance(AwsBaseNode):
                     .format(attribute, constants.EXTERNAL_RESOURCE_ID))
 
         instance_id = self.resource_id
-        instance_object = self._get_instance_from_id(instance_id)
+        instance_object = self._instance or \
+            self._get_instance_from_id(instance_id)
 
         if not instance_object:
             if not ctx.node.properties['use_external_resource']:
@@ -400,24 +505,24 @@ class Instance(AwsBaseNode):
                         'instance id {0} is not in the account.'
                         .format(instance_id))
 
+        # One describe per operation serves every attribute and state check
+        self._instance = instance_object
+
         attribute = getattr(instance_object, attribute)
         return attribute
 
     def _handle_userdata(self, parameters):
 
         existing_userdata = parameters.get('user_data')
-        install_agent_userdata = ctx.agent.init_script()
+        install_agent_userdata = userdata.get_agent_script()
 
         if not (existing_userdata or install_agent_userdata):
             return parameters
 
-        if not existing_userdata:
-            final_userdata = install_agent_userdata
-        elif not install_agent_userdata:
-            final_userdata = existing_userdata
-        else:
-            final_userdata = compute.create_multi_mimetype_userdata(
-                    [existing_userdata, install_agent_userdata])
+        # EC2Config on Windows does not decompress user data
+        final_userdata = userdata.build(
+                existing_userdata, install_agent_userdata,
+                compress=ctx.node.properties.get('os_family') != 'windows')
 
         parameters['user_data'] = final_userdata
 
@@ -552,7 +657,8 @@ class Instance(AwsBaseNode):
 
     def post_start(self):
 
-        resource = self._get_instance_from_id(self.resource_id)
+        resource = self._instance or \
+            self._get_instance_from_id(self.resource_id)
         self.tag_resource(resource)
 
         return True
@@ -577,9 +683,13 @@ class Instance(AwsBaseNode):
                         self.cloudify_node_instance_id))
 
         if self.delete_external_resource_naively() or self.stop(args):
+            self._state_reached(constants.INSTANCE_STATE_STOPPED)
             return self.post_stop()
 
-        return ctx.operation.retry('Waiting server to stop. Retrying...')
+        return ctx.operation.retry(
+                message='Waiting server to stop. Retrying...',
+                retry_after=self._get_state_waiter(
+                    constants.INSTANCE_STATE_STOPPED).next_interval())
 
     def post_stop(self):
 
@@ -603,9 +713,22 @@ class Instance(AwsBaseNode):
     def _get_instance_state(self):
         """Gets the instance state code of a EC2 Instance
 
+        The state comes from the poller shared by all the operations on
+        this host. The instance is described on its own only if the
+        poller does not find it.
+
         :returns a state code from a boto object representing an EC2 Image.
         """
-        state = self._get_instance_attribute('state_code')
+
+        state = None
+
+        if constants.EXTERNAL_RESOURCE_ID in ctx.instance.runtime_properties:
+            state = poller.InstanceStatePoller(self.client).get_state(
+                self.resource_id)
+
+        if state is None:
+            state = self._get_instance_attribute('state_code')
+
         return state
 
     def _get_image(self, image_id):
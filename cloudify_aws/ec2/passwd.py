@@ -13,57 +13,57 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
-# Taken from https://github.com/tomrittervg/decrypt-windows-ec2-passwd
+import os
 import base64
-import binascii
+from collections import OrderedDict
 
+from Crypto.Cipher import PKCS1_v1_5
 from Crypto.PublicKey import RSA
 
 from cloudify.exceptions import NonRecoverableError
+from cloudify_aws import constants
 
+# Parsed private keys by (realpath, mtime, inode), least recently used first
+_KEY_CACHE = OrderedDict()
 
-def _pkcs1_unpad(text):
-    if len(text) > 0 and text[0] == '\x02':
-        # Find end of padding marked by nul
-        pos = text.find('\x00')
-        if pos > 0:
-            return text[pos+1:]
-    return None
 
+def _get_key_cache_key(private_key_path):
+    real_path = os.path.realpath(private_key_path)
+    stat = os.stat(real_path)
+    return real_path, stat.st_mtime, stat.st_ino
 
-def _long_to_bytes(val, endianness='big'):
-    # one (1) hex digit per four (4) bits
-    width = val.bit_length()
-    width += 8 - ((width % 8) or 8)
-    fmt = '%%0%dx' % (width // 4)
-    s = binascii.unhexlify(fmt % val)
-    if endianness == 'little':
-        s = s[::-1]
 
-    return s
+def _load_key(private_key_path):
 
+    cache_key = _get_key_cache_key(private_key_path)
+    key = _KEY_CACHE.pop(cache_key, None)
 
-def _decrypt_password(rsa_key, password):
-    encrypted_data = base64.b64decode(password)
-    cipher_text = int(binascii.hexlify(encrypted_data), 16)
+    if key is None:
+        with open(cache_key[0], 'r') as key_file:
+            key_data = key_file.read()
+        try:
+            key = RSA.importKey(key_data)
+        except ValueError as e:
+            raise NonRecoverableError(
+                    'Could not import SSH Key: {0}'.format(str(e)))
+
+    _KEY_CACHE[cache_key] = key
+    while len(_KEY_CACHE) > constants.PRIVATE_KEY_CACHE_SIZE:
+        _KEY_CACHE.popitem(last=False)
 
-    plaintext = rsa_key.decrypt(cipher_text)
+    return key
 
-    decrypted_data = _long_to_bytes(plaintext)
-    unpadded_data = _pkcs1_unpad(decrypted_data)
 
-    return unpadded_data
+def _decrypt_password(rsa_key, password):
+    encrypted_data = base64.b64decode(password)
+
+    # decrypt returns the sentinel instead of raising on bad padding
+    return PKCS1_v1_5.new(rsa_key).decrypt(encrypted_data, None)
 
 
 def get_windows_passwd(private_key_path, password_data):
 
-    with open(private_key_path, 'r') as key_file:
-        key_lines = key_file.readlines()
-    try:
-        key = RSA.importKey(key_lines)
-    except ValueError as e:
-        raise NonRecoverableError(
-                'Could not import SSH Key: {0}'.format(str(e)))
+    key = _load_key(private_key_path)
 
     password = _decrypt_password(key, password_data)
 
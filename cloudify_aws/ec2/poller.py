@@ -0,0 +1,173 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import os
+import json
+import time
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Third-party Imports
+from boto import exception
+
+# Cloudify imports
+from cloudify import ctx
+from cloudify_aws import constants
+from cloudify.exceptions import NonRecoverableError
+
+
+class InstanceStatePoller(object):
+    """Polls the state of every instance that an operation on this host
+    is waiting for with one DescribeInstances call per tick.
+
+    Operations run in separate worker processes, so the ids being waited
+    for and the last result are shared through a locked JSON file per
+    account and region. The first operation that finds the result older
+    than a tick describes all the waited instances, the others read its
+    result. See get_state.
+    """
+
+    def __init__(self, client, path=None, tick=None):
+        self.client = client
+        self.path = path or self.get_path(client)
+        self.tick = constants.POLLER_TICK if tick is None else tick
+
+    @staticmethod
+    def get_path(client):
+        account = '{0}:{1}'.format(
+            getattr(client, 'aws_access_key_id', None),
+            getattr(getattr(client, 'region', None), 'name', None))
+        return os.path.join(
+            tempfile.gettempdir(),
+            constants.POLLER_FILE_NAME.format(
+                hashlib.md5(account.encode('utf-8')).hexdigest()))
+
+    def get_state(self, instance_id):
+        """Returns the state code of an instance, or None if the instance
+        is not in the account.
+
+        The file is only locked to decide who polls and to publish the
+        result. The poller marks the poll as in flight until a deadline
+        and describes without the lock, so the others keep reading the
+        last result meanwhile. An instance that was never described waits
+        for the poll in flight, or polls itself once the deadline passed.
+        """
+
+        while True:
+            now = time.time()
+
+            with self._locked() as data:
+                waiting = data.setdefault('waiting', {})
+                waiting[instance_id] = now
+                for waited_id, since in waiting.items():
+                    if now - since > constants.POLLER_EXPIRY:
+                        del waiting[waited_id]
+
+                states = data.get('states', {})
+                in_flight = data.get('in_flight_until', 0) > now
+                if instance_id in states and (
+                        in_flight or
+                        now - data.get('checked_at', 0) < self.tick):
+                    return states[instance_id]
+
+                if not in_flight:
+                    in_flight_until = now + constants.POLLER_IN_FLIGHT_TIMEOUT
+                    data['in_flight_until'] = in_flight_until
+                    instance_ids = list(waiting.keys())
+
+            if not in_flight:
+                return self._poll(instance_ids, in_flight_until, now).get(
+                    instance_id)
+
+            time.sleep(constants.POLLER_IN_FLIGHT_WAIT)
+
+    def release(self, instance_id):
+        """Stops polling an instance that is no longer waited for."""
+
+        with self._locked() as data:
+            data.get('waiting', {}).pop(instance_id, None)
+            data.get('states', {}).pop(instance_id, None)
+
+    def _poll(self, instance_ids, in_flight_until, checked_at):
+
+        try:
+            states = self._describe(instance_ids)
+        except Exception:
+            with self._locked() as data:
+                self._end_in_flight(data, in_flight_until)
+            raise
+
+        with self._locked() as data:
+            self._end_in_flight(data, in_flight_until)
+            data['states'] = states
+            data['checked_at'] = checked_at
+
+        return states
+
+    @staticmethod
+    def _end_in_flight(data, in_flight_until):
+        # A poll that outlived its deadline may have been taken over
+        if data.get('in_flight_until') == in_flight_until:
+            del data['in_flight_until']
+
+    def _describe(self, instance_ids):
+
+        states = {}
+        chunk_size = constants.POLLER_CHUNK_SIZE
+
+        for index in range(0, len(instance_ids), chunk_size):
+            chunk = instance_ids[index:index + chunk_size]
+            try:
+                reservations = self.client.get_all_reservations(
+                    filters={'instance-id': chunk})
+            except (exception.EC2ResponseError,
+                    exception.BotoServerError) as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
+            for reservation in reservations:
+                for instance in reservation.instances:
+                    states[instance.id] = instance.state_code
+
+        ctx.logger.debug('Described {0} waited instances.'
+                         .format(len(instance_ids)))
+
+        return states
+
+    @contextmanager
+    def _locked(self):
+
+        with open(self.path, 'a+') as state_file:
+            if fcntl:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    data = json.load(state_file)
+                except ValueError:
+                    data = {}
+                yield data
+                state_file.seek(0)
+                state_file.truncate()
+                json.dump(data, state_file)
+                state_file.flush()
+            finally:
+                if fcntl:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
@@ -12,7 +12,11 @@
 #    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
-import time
+
+# Built-in Imports
+import json
+import hashlib
+from collections import OrderedDict
 
 # Third-party Imports
 from boto import exception
@@ -21,7 +25,7 @@ from boto import exception
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify_aws.base import AwsBaseNode
-from cloudify_aws import utils, constants
+from cloudify_aws import cidr, utils, constants
 from cloudify.exceptions import NonRecoverableError
 
 
@@ -58,6 +62,8 @@ class SecurityGroup(AwsBaseNode):
             'argument': '{0}_ids'
             .format(constants.SECURITYGROUP['AWS_RESOURCE_TYPE'])
         }
+        self.shared = ctx.node.properties.get(
+            constants.SECURITYGROUP['SHARED_PROPERTY'], False)
 
     def create(self, args=None, **_):
 
@@ -72,9 +78,14 @@ class SecurityGroup(AwsBaseNode):
         )
 
         create_args = utils.update_args(create_args, args)
+        fingerprint = get_rules_fingerprint(
+            ctx.node.properties['rules'], create_args['vpc_id']) \
+            if self.shared else None
 
         if ctx.operation.retry_number == 0 and constants.EXTERNAL_RESOURCE_ID \
                 not in ctx.instance.runtime_properties:
+            if self.shared and self._use_shared_group(fingerprint):
+                return True
             try:
                 security_group = self.execute(
                         self.client.create_security_group, create_args,
@@ -94,6 +105,41 @@ class SecurityGroup(AwsBaseNode):
 
         self._create_group_rules(security_group)
 
+        if self.shared:
+            # Only groups with all their rules are found by the fingerprint
+            self.execute(self.client.create_tags, dict(
+                resource_ids=[security_group.id],
+                tags={constants.SECURITYGROUP['FINGERPRINT_TAG']:
+                      fingerprint}))
+            self.add_reference(
+                security_group.id,
+                constants.SECURITYGROUP['REFERENCE_TAG_PREFIX'])
+
+        return True
+
+    def _use_shared_group(self, fingerprint):
+        """Uses an existing group with the same rules in the same VPC,
+        if there is one.
+        """
+
+        groups = self.execute(
+            self.client.get_all_security_groups,
+            dict(filters={'tag:{0}'.format(
+                constants.SECURITYGROUP['FINGERPRINT_TAG']): fingerprint}))
+
+        for group in sorted(groups, key=lambda g: g.id):
+            if self.add_reference(
+                    group.id, constants.SECURITYGROUP['REFERENCE_TAG_PREFIX'],
+                    constants.SECURITYGROUP['FINGERPRINT_TAG']):
+                break
+        else:
+            return False
+
+        utils.set_external_resource_id(group.id, ctx.instance, external=False)
+        self.resource_id = group.id
+
+        ctx.logger.info('Sharing security group {0}.'.format(group.id))
+
         return True
 
     def created(self, args=None):
@@ -116,19 +162,48 @@ class SecurityGroup(AwsBaseNode):
 
     def delete(self, args=None, **_):
 
+        if self.shared:
+            references = self.release_reference(
+                self.resource_id,
+                constants.SECURITYGROUP['REFERENCE_TAG_PREFIX'],
+                constants.SECURITYGROUP['FINGERPRINT_TAG'])
+            if references:
+                ctx.logger.info(
+                    'Keeping shared security group {0}, still used by {1} '
+                    'others.'.format(self.resource_id, references))
+                return True
+
         delete_args = dict(group_id=self.resource_id)
         delete_args = utils.update_args(delete_args, args)
         ctx.logger.info('Deleting aws security group args: {0}'.format(delete_args))
         try:
-            return self.execute(self.client.delete_security_group,
-                                delete_args, raise_on_falsy=True)
-        except Exception as ex:
-            ctx.logger.warning('Deleting aws security group failed with ex: {0}'.format(type(ex)))
-            ctx.logger.warning('Failed to delete, ex: {0}'.format(type(ex)))
-            time.sleep(20)
-            ctx.logger.info('Giving another chance')
-            return self.execute(self.client.delete_security_group,
-                                delete_args, raise_on_falsy=True)
+            return self.client.delete_security_group(**delete_args)
+        except exception.EC2ResponseError as e:
+            if constants.SECURITYGROUP['DEPENDENCY_VIOLATION'] in str(e):
+                ctx.logger.info('Security group {0} is still in use.'
+                                .format(self.resource_id))
+                return False
+            raise NonRecoverableError('{0}'.format(str(e)))
+        except exception.BotoServerError as e:
+            raise NonRecoverableError('{0}'.format(str(e)))
+
+    def deleted(self, args=None):
+
+        ctx.logger.info(
+                'Attempting to delete {0} {1}.'
+                .format(self.aws_resource_type,
+                        self.cloudify_node_instance_id))
+
+        if not self.get_resource():
+            self.raise_forbidden_external_resource(self.resource_id)
+
+        if self.delete_external_resource_naively() or self.delete(args):
+            return self.post_delete()
+
+        return ctx.operation.retry(
+                message='Waiting for security group {0} to be released. '
+                        'Retrying...'.format(self.resource_id),
+                retry_after=constants.DELETE_RETRY_INTERVAL)
 
     def _get_connected_vpc(self):
 
@@ -156,7 +231,14 @@ class SecurityGroup(AwsBaseNode):
         from_port, to_port, and cidr_ip are not provided.
         """
 
-        for rule in ctx.node.properties['rules']:
+        rules = compact_rules(ctx.node.properties['rules'])
+
+        if len(rules) < len(ctx.node.properties['rules']):
+            ctx.logger.info(
+                'Compacted {0} security group rules into {1}.'
+                .format(len(ctx.node.properties['rules']), len(rules)))
+
+        for rule in rules:
 
             if 'src_group_id' in rule:
 
@@ -215,3 +297,144 @@ class SecurityGroup(AwsBaseNode):
         except (exception.EC2ResponseError,
                 exception.BotoServerError) as e:
             raise NonRecoverableError('{0}'.format(str(e)))
+
+
+def get_rules_fingerprint(rules, vpc_id):
+    """Returns a hash of the traffic that rules allow in a VPC, which is
+    the same for rules that compact to the same rules.
+    """
+
+    rules = sorted(json.dumps(rule, sort_keys=True, default=str)
+                   for rule in compact_rules(rules))
+
+    return hashlib.sha1(json.dumps([vpc_id, rules])).hexdigest()
+
+
+def compact_rules(rules):
+    """Returns rules that allow exactly the same traffic as the given
+    rules, in as few rules as it can.
+
+    The port ranges of a protocol and source that overlap or touch are
+    merged, then the CIDR blocks of a protocol and port range are
+    collapsed into the fewest blocks that cover the same addresses.
+    Last, the rules that a broader rule already allows are dropped.
+    Rules that cannot be compacted, like rules without exactly one
+    source, are passed through unchanged as copies.
+    """
+
+    port_protocols = constants.SECURITYGROUP['PORT_PROTOCOLS']
+    passed_through = []
+    # Port ranges by protocol and source
+    ranges = OrderedDict()
+
+    for rule in rules:
+        normalized = _normalize_rule(rule)
+        if normalized is None:
+            passed_through.append(dict(rule))
+            continue
+        protocol, from_port, to_port, source = normalized
+        merged = ranges.setdefault((protocol, source), [])
+        if protocol in port_protocols:
+            merged.append((from_port, to_port))
+        elif (from_port, to_port) not in merged:
+            merged.append((from_port, to_port))
+
+    # Sources by protocol, port range and source type
+    sources = OrderedDict()
+
+    for (protocol, (source_type, source)), port_ranges in ranges.items():
+        if protocol in port_protocols:
+            port_ranges = _merge_port_ranges(port_ranges)
+        for from_port, to_port in port_ranges:
+            sources.setdefault(
+                (protocol, from_port, to_port, source_type), []).append(
+                source)
+
+    compacted = []
+
+    for (protocol, from_port, to_port, source_type), source_list \
+            in sources.items():
+        if source_type == 'cidr_ip':
+            source_list = cidr.collapse(source_list)
+        for source in source_list:
+            compacted.append({'ip_protocol': protocol,
+                              'from_port': from_port,
+                              'to_port': to_port,
+                              source_type: source})
+
+    # Drop the rules that a broader rule already allows
+    compacted = [rule for rule in compacted
+                 if not [other for other in compacted
+                         if other is not rule and _covers(other, rule)]]
+
+    return compacted + passed_through
+
+
+def _normalize_rule(rule):
+    """Returns the (protocol, from port, to port, (source type, source))
+    of a rule, or None if the rule cannot be compacted.
+    """
+
+    if set(rule) != set(['ip_protocol', 'from_port', 'to_port',
+                         'cidr_ip']) and \
+            set(rule) != set(['ip_protocol', 'from_port', 'to_port',
+                              'src_group_id']):
+        return None
+
+    protocol = '{0}'.format(rule['ip_protocol']).lower()
+    protocol = constants.SECURITYGROUP['PROTOCOL_NAMES'].get(
+        protocol, protocol)
+
+    try:
+        from_port, to_port = int(rule['from_port']), int(rule['to_port'])
+    except (TypeError, ValueError):
+        return None
+
+    if 'cidr_ip' in rule:
+        try:
+            source = ('cidr_ip', cidr.format_cidr(
+                *cidr.parse_cidr(rule['cidr_ip'])))
+        except (AttributeError, ValueError):
+            return None
+    elif isinstance(rule['src_group_id'], basestring):
+        source = ('src_group_id', rule['src_group_id'])
+    else:
+        return None
+
+    return protocol, from_port, to_port, source
+
+
+def _covers(rule, other):
+
+    if rule['ip_protocol'] != other['ip_protocol'] or \
+            rule.get('src_group_id') != other.get('src_group_id'):
+        return False
+
+    if rule['ip_protocol'] in constants.SECURITYGROUP['PORT_PROTOCOLS']:
+        if not rule['from_port'] <= other['from_port'] or \
+                not other['to_port'] <= rule['to_port']:
+            return False
+    elif (rule['from_port'], rule['to_port']) != \
+            (other['from_port'], other['to_port']):
+        return False
+
+    if 'cidr_ip' not in rule or 'cidr_ip' not in other:
+        return 'cidr_ip' not in rule and 'cidr_ip' not in other
+
+    start, end = cidr.get_range(rule['cidr_ip'])
+    other_start, other_end = cidr.get_range(other['cidr_ip'])
+
+    return start <= other_start and other_end <= end
+
+
+def _merge_port_ranges(port_ranges):
+
+    merged = []
+
+    for from_port, to_port in sorted(port_ranges):
+        if merged and from_port <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(to_port, merged[-1][1]))
+        else:
+            merged.append((from_port, to_port))
+
+    return merged
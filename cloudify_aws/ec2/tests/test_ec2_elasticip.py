@@ -17,6 +17,7 @@
 import testtools
 
 # Third Party Imports
+import mock
 from moto import mock_ec2
 from boto.ec2 import EC2Connection
 from boto.vpc import VPCConnection
@@ -171,6 +172,205 @@ class TestElasticIP(testtools.TestCase):
         elasticip.create(ctx=ctx)
         self.assertIn('aws_resource_id', ctx.instance.runtime_properties)
 
+    def mock_pool_ctx(self, test_name, size=0):
+
+        ctx = self.mock_ctx(test_name)
+        ctx.node.properties['pool'] = {
+            'enabled': True,
+            'name': 'test_pool',
+            'size': size
+        }
+
+        return ctx
+
+    def get_pool_addresses(self, client):
+        tags = client.get_all_tags(
+            filters={'key': constants.ELASTICIP['POOL_TAG'],
+                     'value': 'test_pool'})
+        return set(tag.res_id for tag in tags)
+
+    @mock_ec2
+    def test_pool_claim_and_release(self):
+        """ This tests that a pooled address is claimed on create and
+        kept in the account on delete.
+        """
+
+        ctx = self.mock_pool_ctx('test_pool_claim_and_release', size=1)
+        current_ctx.set(ctx=ctx)
+        elasticip.create(ctx=ctx)
+        client = self.get_client()
+        allocation_id = ctx.instance.runtime_properties['allocation_id']
+        self.assertEqual('test_pool',
+                         ctx.instance.runtime_properties['pool'])
+        self.assertEqual(set([allocation_id]),
+                         self.get_pool_addresses(client))
+
+        # The pool is topped up after the claim, by the start operation
+        self.assertTrue(elasticip.top_up_pool(ctx=ctx))
+        self.assertEqual(2, len(self.get_pool_addresses(client)))
+        self.assertIn(allocation_id, self.get_pool_addresses(client))
+
+        elasticip.delete(ctx=ctx)
+        self.assertNotIn('aws_resource_id', ctx.instance.runtime_properties)
+        self.assertNotIn('allocation_id', ctx.instance.runtime_properties)
+        self.assertEqual(
+            [], client.get_all_tags(
+                filters={'key': constants.ELASTICIP['CLAIM_TAG']}))
+        self.assertIn(allocation_id, self.get_pool_addresses(client))
+
+    @mock_ec2
+    def test_pool_reuses_free_address(self):
+        """ This tests that a free pooled address is claimed instead of
+        allocating a new one, and that claimed addresses are skipped.
+        """
+
+        ctx = self.mock_pool_ctx('test_pool_reuses_free_address')
+        current_ctx.set(ctx=ctx)
+        client = self.get_client()
+        pool = elasticip.ElasticIPPool(client, 'test_pool')
+        taken = pool.allocate()
+        free = pool.allocate()
+        client.create_tags([taken.allocation_id],
+                           {constants.ELASTICIP['CLAIM_TAG']: 'other'})
+
+        elasticip.create(ctx=ctx)
+        self.assertEqual(free.allocation_id,
+                         ctx.instance.runtime_properties['allocation_id'])
+        self.assertEqual(free.public_ip,
+                         ctx.instance.runtime_properties['aws_resource_id'])
+        self.assertEqual(2, len(self.get_pool_addresses(client)))
+
+    def get_intent_tags(self, client):
+        return [(tag.res_id, tag.name) for tag in client.get_all_tags()
+                if tag.name.startswith(constants.ELASTICIP['INTENT_TAG'])]
+
+    def race(self, client, allocation_id, tags):
+        """Writes tags to the address right after the intent of the
+        owner, as another owner that claims it at the same time.
+        """
+
+        create_tags = client.create_tags
+
+        def create_tags_and_race(**kwargs):
+            result = create_tags(**kwargs)
+            if kwargs['resource_ids'] == [allocation_id] and \
+                    'cloudify-eip-intent:owner' in kwargs['tags']:
+                create_tags([allocation_id], tags)
+            return result
+
+        return mock.patch.object(client, 'create_tags',
+                                 side_effect=create_tags_and_race)
+
+    @mock_ec2
+    def test_pool_claim_lost_to_another_owner(self):
+        """ This tests that an owner that sees the claim of another owner
+        after its intent moves on, and that a new address is claimed as
+        it is allocated.
+        """
+
+        ctx = self.mock_pool_ctx('test_pool_claim_lost_to_another_owner')
+        current_ctx.set(ctx=ctx)
+        client = self.get_client()
+        pool = elasticip.ElasticIPPool(client, 'test_pool')
+        free = pool.allocate()
+
+        with self.race(client, free.allocation_id,
+                       {constants.ELASTICIP['CLAIM_TAG']: 'other'}):
+            address = elasticip.ElasticIPPool(
+                client, 'test_pool').claim('owner')
+
+        self.assertNotEqual(free.allocation_id, address.allocation_id)
+        claims = dict(
+            (tag.res_id, tag.value) for tag in client.get_all_tags(
+                filters={'key': constants.ELASTICIP['CLAIM_TAG']}))
+        self.assertEqual({free.allocation_id: 'other',
+                          address.allocation_id: 'owner'}, claims)
+        self.assertEqual([], self.get_intent_tags(client))
+
+    @mock_ec2
+    def test_pool_claim_contended(self):
+        """ This tests that an owner that sees the intent of another owner
+        does not claim the address, and removes its own intent.
+        """
+
+        ctx = self.mock_pool_ctx('test_pool_claim_contended')
+        current_ctx.set(ctx=ctx)
+        client = self.get_client()
+        pool = elasticip.ElasticIPPool(client, 'test_pool')
+        free = pool.allocate()
+        other_intent = 'cloudify-eip-intent:other'
+
+        with self.race(client, free.allocation_id, {other_intent: 'other'}):
+            address = elasticip.ElasticIPPool(
+                client, 'test_pool').claim('owner')
+
+        self.assertNotEqual(free.allocation_id, address.allocation_id)
+        self.assertEqual([(free.allocation_id, other_intent)],
+                         self.get_intent_tags(client))
+        self.assertEqual(
+            [address.allocation_id],
+            [tag.res_id for tag in client.get_all_tags(
+                filters={'key': constants.ELASTICIP['CLAIM_TAG']})])
+
+    @mock_ec2
+    def test_pool_claim_after_interrupted_claim(self):
+        """ This tests that the intent an owner left behind does not keep
+        it from claiming the address on retry, and is removed on release.
+        """
+
+        ctx = self.mock_pool_ctx('test_pool_claim_after_interrupted_claim')
+        current_ctx.set(ctx=ctx)
+        client = self.get_client()
+        pool = elasticip.ElasticIPPool(client, 'test_pool')
+        free = pool.allocate()
+        client.create_tags([free.allocation_id],
+                           {'cloudify-eip-intent:owner': 'owner'})
+
+        pool = elasticip.ElasticIPPool(client, 'test_pool')
+        self.assertEqual(free.allocation_id,
+                         pool.claim('owner').allocation_id)
+        self.assertEqual([], self.get_intent_tags(client))
+
+        client.create_tags([free.allocation_id],
+                           {'cloudify-eip-intent:owner': 'owner'})
+        pool.release(free.allocation_id, 'owner')
+        self.assertEqual([], client.get_all_tags(
+            filters={'resource-id': free.allocation_id,
+                     'key': constants.ELASTICIP['CLAIM_TAG']}))
+        self.assertEqual([], self.get_intent_tags(client))
+
+    @mock_ec2
+    def test_pool_top_up_failure(self):
+        """ This tests that a failed top up only leaves the pool short."""
+
+        ctx = self.mock_pool_ctx('test_pool_top_up_failure', size=2)
+        current_ctx.set(ctx=ctx)
+        with mock.patch.object(elasticip.ElasticIPPool, 'top_up',
+                               side_effect=NonRecoverableError('limit')):
+            self.assertFalse(elasticip.top_up_pool(ctx=ctx))
+
+        ctx = self.mock_ctx('test_pool_top_up_failure')
+        current_ctx.set(ctx=ctx)
+        self.assertFalse(elasticip.top_up_pool(ctx=ctx))
+
+    @mock_ec2
+    def test_pool_claim_is_idempotent(self):
+        """ This tests that an owner gets back the address it already
+        claimed.
+        """
+
+        ctx = self.mock_pool_ctx('test_pool_claim_is_idempotent')
+        current_ctx.set(ctx=ctx)
+        client = self.get_client()
+        pool = elasticip.ElasticIPPool(client, 'test_pool', size=2)
+        first = pool.claim('owner')
+        self.assertEqual(2, pool.top_up())
+        self.assertEqual(
+            first.allocation_id,
+            elasticip.ElasticIPPool(client, 'test_pool').claim(
+                'owner').allocation_id)
+        self.assertEqual(3, len(self.get_pool_addresses(client)))
+
     @mock_ec2
     def test_allocate_backward_compatibility(self):
         """ This tests that allocate adds the runtime_properties."""
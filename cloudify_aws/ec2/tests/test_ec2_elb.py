@@ -142,7 +142,8 @@ class TestLoadBalancer(testtools.TestCase):
 
     def mock_relationship_context(self, testname, elb_context=None,
                                   instance_context=None,
-                                  use_external_resource=False):
+                                  use_external_resource=False,
+                                  retry_number=0):
         """ Creates a mock relationship context for the elb
             tests
         """
@@ -160,7 +161,8 @@ class TestLoadBalancer(testtools.TestCase):
         relationship_context = MockCloudifyContext(
                 node_id=testname,
                 source=instance_context,
-                target=elb_context)
+                target=elb_context,
+                operation={'retry_number': retry_number})
 
         return relationship_context
 
@@ -210,6 +212,117 @@ class TestLoadBalancer(testtools.TestCase):
                               'instance_list'))
         self.assertIn(instance_id, self._get_elb_instances())
 
+    @mock_ec2
+    @mock_elb
+    def test_add_instance_to_elb_wait_for_health(self):
+        self._create_external_elb()
+        instance_id = self._create_external_instance().id
+        instance_ctx = self.mock_instance_ctx(
+                'source_test_add_instance_to_elb_wait_for_health',
+                instance_id=instance_id)
+        ctx = self.mock_relationship_context(
+                'test_add_instance_to_elb_wait_for_health',
+                instance_context=instance_ctx)
+        current_ctx.set(ctx=ctx)
+        self.assertTrue(elasticloadbalancer.associate(
+                wait_for_health=True, ctx=ctx))
+        self.assertIsNone(ctx.operation._operation_retry)
+        self.assertEqual(1,
+                         ctx.target.instance.runtime_properties.get(
+                                 'instance_list').count(instance_id))
+        self.assertIn(instance_id, self._get_elb_instances())
+
+    @mock_ec2
+    @mock_elb
+    def test_add_instance_to_elb_wait_for_health_retry(self):
+        self._create_external_elb()
+        instance_id = self._create_external_instance().id
+        instance_ctx = self.mock_instance_ctx(
+                'source_test_add_instance_to_elb_wait_for_health_retry',
+                instance_id=instance_id)
+        ctx = self.mock_relationship_context(
+                'test_add_instance_to_elb_wait_for_health_retry',
+                instance_context=instance_ctx)
+        current_ctx.set(ctx=ctx)
+        out_of_service = mock.Mock(instance_id=instance_id,
+                                   state='OutOfService')
+        test_elbinstanceconnection = self \
+            .create_elbinstanceconnection_for_checking()
+        with mock.patch.object(test_elbinstanceconnection.client,
+                               'describe_instance_health',
+                               return_value=[out_of_service]) as describe:
+            test_elbinstanceconnection.associated(wait_for_health=True)
+        self.assertEqual(1, describe.call_count)
+        self.assertEqual(
+            constants.HEALTH_CHECK_INTERVAL *
+            constants.HEALTH_CHECK_HEALTHY_THRESHOLD,
+            ctx.operation._operation_retry.retry_after)
+
+    @mock_ec2
+    @mock_elb
+    def test_wait_for_health_retry_does_not_register_again(self):
+        self._create_external_elb()
+        instance_id = self._create_external_instance().id
+        boto.connect_elb().register_instances('myelb', [instance_id])
+        instance_ctx = self.mock_instance_ctx(
+                'source_test_wait_for_health_retry_does_not_register_again',
+                instance_id=instance_id)
+        ctx = self.mock_relationship_context(
+                'test_wait_for_health_retry_does_not_register_again',
+                instance_context=instance_ctx, retry_number=3)
+        current_ctx.set(ctx=ctx)
+        test_elbinstanceconnection = self \
+            .create_elbinstanceconnection_for_checking()
+        with mock.patch.object(test_elbinstanceconnection.client,
+                               'register_instances') as register:
+            self.assertTrue(test_elbinstanceconnection.associated(
+                wait_for_health=True))
+        self.assertFalse(register.called)
+
+    def test_health_poll_interval(self):
+        ctx = self.mock_relationship_context('test_health_poll_interval')
+        current_ctx.set(ctx=ctx)
+        health_check = mock.Mock(interval=5, healthy_threshold=3,
+                                 unhealthy_threshold=4)
+        test_elbinstanceconnection = \
+            elasticloadbalancer.ElbInstanceConnection(client=mock.Mock())
+        test_elbinstanceconnection.load_balancers = {
+            'myelb': mock.Mock(health_check=health_check)}
+        test_elbinstanceconnection.target_resource_id = 'myelb'
+        self.assertEqual(
+            [15, 20, 20, 20, 20],
+            [test_elbinstanceconnection._get_health_poll_interval(n)
+             for n in range(5)])
+        health_check.unhealthy_threshold = 10
+        self.assertEqual(
+            [15, 30, 50, 50, 50],
+            [test_elbinstanceconnection._get_health_poll_interval(n)
+             for n in range(5)])
+
+    @mock_ec2
+    @mock_elb
+    def test_wait_for_health_skipped_for_external_instance(self):
+        self._create_external_elb()
+        instance_id = self._create_external_instance().id
+        instance_ctx = self.mock_instance_ctx(
+                'source_test_wait_for_health_skipped_for_external_instance',
+                instance_id=instance_id, use_external_resource=True)
+        ctx = self.mock_relationship_context(
+                'test_wait_for_health_skipped_for_external_instance',
+                instance_context=instance_ctx)
+        current_ctx.set(ctx=ctx)
+        test_elbinstanceconnection = self \
+            .create_elbinstanceconnection_for_checking()
+        with mock.patch.object(test_elbinstanceconnection,
+                               'get_source_resource',
+                               return_value=mock.Mock(id=instance_id)), \
+                mock.patch.object(test_elbinstanceconnection.client,
+                                  'describe_instance_health') as describe:
+            self.assertTrue(test_elbinstanceconnection.associated(
+                wait_for_health=True))
+        self.assertFalse(describe.called)
+        self.assertIsNone(ctx.operation._operation_retry)
+
     @mock_ec2
     @mock_elb
     def test_remove_instance_from_elb(self):
@@ -240,8 +353,21 @@ class TestLoadBalancer(testtools.TestCase):
                 use_external_resource=True,
                 instance_list=[])
         current_ctx.set(elb_ctx)
+        self._create_external_elb()
         self.assertTrue(elasticloadbalancer.delete(args=None, ctx=elb_ctx))
 
+    @mock_elb
+    def test_delete_external_elb_not_in_account(self):
+        elb_ctx = self.mock_elb_ctx(
+                'test_delete_external_elb_not_in_account',
+                use_external_resource=True,
+                instance_list=[])
+        current_ctx.set(elb_ctx)
+        ex = self.assertRaises(NonRecoverableError,
+                               elasticloadbalancer.delete,
+                               args=None, ctx=elb_ctx)
+        self.assertIn('Cannot use_external_resource', ex.message)
+
     @mock_elb
     def test_validation_not_external(self):
         """ Tests that creation_validation raises an error
@@ -259,6 +385,46 @@ class TestLoadBalancer(testtools.TestCase):
                                ctx=ctx)
         self.assertIn('Not external resource, but the supplied', ex.message)
 
+    @mock_elb
+    def test_validation_external_not_in_account(self):
+        """ Tests that creation_validation raises an error when
+        use_external_resource is true and the Elastic Load Balancer
+        does not exist in the account.
+        """
+
+        ctx = self.mock_elb_ctx('test_validation_external_not_in_account',
+                                use_external_resource=True,
+                                resource_id='myelb')
+        current_ctx.set(ctx=ctx)
+        ex = self.assertRaises(NonRecoverableError,
+                               elasticloadbalancer.creation_validation,
+                               ctx=ctx)
+        self.assertIn('does not exist in the account', ex.message)
+
+    @mock_elb
+    def test_get_load_balancers_by_name(self):
+        self._create_external_elb()
+        load_balancers = elasticloadbalancer.get_load_balancers_by_name(
+            boto.connect_elb())
+        self.assertEqual(['myelb'], load_balancers.keys())
+        load_balancers = elasticloadbalancer.get_load_balancers_by_name(
+            boto.connect_elb(), ['notmyelb'])
+        self.assertEqual({}, load_balancers)
+
+    @mock_elb
+    def test_unchanged_health_check_not_reconfigured(self):
+        ctx = self.mock_elb_ctx('test_unchanged_health_check')
+        current_ctx.set(ctx=ctx)
+        elasticloadbalancer.create(args=None, ctx=ctx)
+        test_elb = self.create_elb_for_checking()
+        lb = test_elb.get_resource()
+        with mock.patch.object(test_elb.client,
+                               'configure_health_check') as configure:
+            test_elb._add_health_check_to_elb(
+                lb, ctx.node.properties['health_checks'][0],
+                lb.health_check)
+        self.assertFalse(configure.called)
+
     @mock_elb
     def test_client_error_create_elb(self):
         with mock.patch('cloudify_aws.connection.ELBConnectionClient',
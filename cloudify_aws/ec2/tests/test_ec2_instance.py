@@ -14,22 +14,30 @@
 #    * limitations under the License.
 
 # Built-in Imports
+import os
+import gzip
 import uuid
+import base64
 import tempfile
 import testtools
+from StringIO import StringIO
 
 # Third Party Imports
 import mock
 from moto import mock_ec2
+from boto.ec2 import EC2Connection
 from boto.vpc import VPCConnection
 
 # Cloudify Imports is imported and used in operations
-from cloudify_aws.ec2 import instance
+from cloudify_aws.ec2 import instance, userdata, waiter
 from cloudify.state import current_ctx
 from cloudify.mocks import MockContext
 from cloudify.mocks import MockNodeContext
+from cloudify.mocks import MockRelationshipContext
+from cloudify.mocks import MockNodeInstanceContext
 from cloudify.context import BootstrapContext
-from cloudify_aws import constants, connection
+from cloudify_aws import constants, connection, utils, workflows
+from cloudify_aws.base import AwsBase
 from cloudify.mocks import MockCloudifyContext
 from cloudify.exceptions import NonRecoverableError
 
@@ -42,6 +50,10 @@ TEST_AVAILABILITY_ZONE = 'us-east-1b'
 
 class TestInstance(testtools.TestCase):
 
+    def setUp(self):
+        super(TestInstance, self).setUp()
+        userdata._PAYLOAD_CACHE.clear()
+
     def create_vpc_client(self):
         return VPCConnection()
 
@@ -217,6 +229,109 @@ class TestInstance(testtools.TestCase):
             self.assertEqual(ctx.instance.runtime_properties
                              [constants.ADMIN_PASSWORD_PROPERTY], 'pass')
 
+    @mock_ec2
+    def test_windows_password_not_polled_before_delay(self):
+        """tests that the password data is not polled for right after
+        the instance was launched.
+        """
+
+        ctx = self.mock_ctx('test_windows_password_not_polled_before_delay')
+        current_ctx.set(ctx=ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE)
+        ctx.instance.runtime_properties['aws_resource_id'] = \
+            reservation.instances[0].id
+        test_instance = self.create_instance_for_checking()
+        test_instance.client.get_password_data = mock.Mock()
+        password = test_instance._get_windows_password(
+                reservation.instances[0].id, 'key_path')
+        self.assertIsNone(password)
+        self.assertFalse(test_instance.client.get_password_data.called)
+        self.assertGreater(test_instance._password_retry_after, 0)
+        self.assertLessEqual(test_instance._password_retry_after,
+                             constants.WINDOWS_PASSWORD_DELAY)
+
+    @mock_ec2
+    def test_windows_password_poll_backoff(self):
+        """tests that empty password data polls are backed off
+        exponentially.
+        """
+
+        ctx = self.mock_ctx('test_windows_password_poll_backoff')
+        current_ctx.set(ctx=ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE)
+        instance_id = reservation.instances[0].id
+        ctx.instance.runtime_properties['aws_resource_id'] = instance_id
+        test_instance = self.create_instance_for_checking()
+        test_instance.client.get_password_data = mock.Mock(return_value='')
+        intervals = []
+        with mock.patch('cloudify_aws.ec2.instance.Instance'
+                        '._get_launched_at', return_value=0):
+            for _ in range(5):
+                ctx.instance.runtime_properties.get(
+                    constants.PASSWORD_POLL_PROPERTY, {})['next'] = 0
+                test_instance._get_windows_password(instance_id, 'key_path')
+                intervals.append(test_instance._password_retry_after)
+        self.assertEqual([15, 30, 60, 120, 120], intervals)
+        self.assertEqual(5, test_instance.client.get_password_data.call_count)
+
+    def test_windows_password_decrypt(self):
+        """tests that the password data is decrypted with the private key
+        and that the key is parsed once.
+        """
+
+        from Crypto.Cipher import PKCS1_v1_5
+        from Crypto.PublicKey import RSA
+        from cloudify_aws.ec2 import passwd
+
+        key = RSA.generate(1024)
+        password_data = base64.b64encode(
+            PKCS1_v1_5.new(key.publickey()).encrypt(b'secret'))
+        with tempfile.NamedTemporaryFile() as key_file:
+            key_file.write(key.exportKey())
+            key_file.flush()
+            with mock.patch('cloudify_aws.ec2.passwd.RSA.importKey',
+                            wraps=RSA.importKey) as import_key:
+                for _ in range(2):
+                    self.assertEqual(
+                        b'secret',
+                        passwd.get_windows_passwd(key_file.name,
+                                                  password_data))
+            self.assertEqual(1, import_key.call_count)
+
+    def test_private_key_cache(self):
+        """tests that links to the same key share one cache entry and that
+        the cache is bounded.
+        """
+
+        from Crypto.PublicKey import RSA
+        from cloudify_aws.ec2 import passwd
+
+        key_dir = tempfile.mkdtemp()
+        key_path = os.path.join(key_dir, 'agent.pem')
+        with open(key_path, 'w') as key_file:
+            key_file.write(RSA.generate(1024).exportKey())
+        link_path = os.path.join(key_dir, 'link.pem')
+        os.symlink(key_path, link_path)
+
+        self.addCleanup(passwd._KEY_CACHE.clear)
+        passwd._KEY_CACHE.clear()
+        self.assertIs(passwd._load_key(key_path),
+                      passwd._load_key(link_path))
+        self.assertEqual(1, len(passwd._KEY_CACHE))
+
+        with mock.patch('cloudify_aws.ec2.passwd.constants'
+                        '.PRIVATE_KEY_CACHE_SIZE', 1):
+            os.utime(key_path, (0, 0))
+            passwd._load_key(key_path)
+        self.assertEqual(1, len(passwd._KEY_CACHE))
+        self.assertEqual(0, list(passwd._KEY_CACHE.keys())[0][1])
+
     @mock_ec2
     def test_run_instances_clean(self):
         """ this tests that the instance create function
@@ -273,11 +388,66 @@ class TestInstance(testtools.TestCase):
         ctx.node.properties['parameters']['user_data'] = '#! EXISTING'
         current_ctx.set(ctx=ctx)
         test_instance = self.create_instance_for_checking()
+        handle_userdata_output = \
+            test_instance._handle_userdata(ctx.node.properties['parameters'])
+        user_data = gzip.GzipFile(
+            fileobj=StringIO(handle_userdata_output['user_data'])).read()
+        self.assertTrue(user_data.startswith('Content-Type: multi'))
+
+    @mock_ec2
+    def test_with_both_userdata_windows(self):
+        """ this tests that merged user data is not compressed for windows
+        """
+
+        ctx = self.mock_ctx('test_with_both_userdata_windows')
+        ctx.agent.init_script = lambda: '#! SCRIPT'
+        ctx.node.properties['agent_config']['install_method'] = 'init_script'
+        ctx.node.properties['parameters']['user_data'] = '#! EXISTING'
+        ctx.node.properties['os_family'] = 'windows'
+        current_ctx.set(ctx=ctx)
+        test_instance = self.create_instance_for_checking()
         handle_userdata_output = \
             test_instance._handle_userdata(ctx.node.properties['parameters'])
         self.assertTrue(handle_userdata_output['user_data'].startswith(
                 'Content-Type: multi'))
 
+    @mock_ec2
+    def test_userdata_built_once(self):
+        """ this tests that the agent script is rendered and the user data
+        is assembled once for identical inputs
+        """
+
+        ctx = self.mock_ctx('test_userdata_built_once')
+        ctx.agent.init_script = mock.Mock(return_value='#! SCRIPT')
+        ctx.node.properties['agent_config']['install_method'] = 'init_script'
+        current_ctx.set(ctx=ctx)
+        test_instance = self.create_instance_for_checking()
+        with mock.patch('cloudify_aws.ec2.userdata.compute'
+                        '.create_multi_mimetype_userdata',
+                        return_value='Content-Type: multi') as create:
+            outputs = [test_instance._handle_userdata(
+                {'user_data': '#! EXISTING'})['user_data']
+                for _ in range(2)]
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(1, ctx.agent.init_script.call_count)
+        self.assertEqual(1, create.call_count)
+
+    @mock_ec2
+    def test_agent_script_rendered_per_operation(self):
+        """ this tests that a later operation on the same node instance,
+        as in a heal, renders the agent script again
+        """
+
+        scripts = []
+        for script in ['#! SCRIPT', '#! NEW SCRIPT']:
+            ctx = self.mock_ctx('test_agent_script_rendered_per_operation')
+            ctx.agent.init_script = mock.Mock(return_value=script)
+            current_ctx.set(ctx=ctx)
+            scripts.append(userdata.get_agent_script())
+            self.assertEqual(script, userdata.get_agent_script())
+            self.assertEqual(1, ctx.agent.init_script.call_count)
+        self.assertEqual(['#! SCRIPT', '#! NEW SCRIPT'], scripts)
+
     @mock_ec2
     def test_without_userdata_clean(self):
         """ this tests that handle user data returns the expected output
@@ -398,6 +568,179 @@ class TestInstance(testtools.TestCase):
         state = instance_object.update()
         self.assertEqual(state, 'running')
 
+    @mock_ec2
+    def test_started_pending_uses_poller(self):
+        """ this tests that a retry of start takes the state from the
+        shared poller and schedules the next poll with the waiter.
+        """
+
+        ctx = self.mock_ctx('test_started_pending_uses_poller')
+        current_ctx.set(ctx=ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE)
+        instance_id = reservation.instances[0].id
+        ctx.instance.runtime_properties['aws_resource_id'] = instance_id
+        test_instance = self.create_instance_for_checking()
+        describe = mock.Mock(
+            wraps=test_instance.client.get_all_reservations)
+        test_instance.client.get_all_reservations = describe
+        with mock.patch('cloudify_aws.ec2.poller.InstanceStatePoller'
+                        '.get_state',
+                        return_value=constants.INSTANCE_STATE_PENDING), \
+                mock.patch('cloudify_aws.ec2.waiter.TransitionStats'
+                           '.estimate', return_value=None):
+            test_instance.started(start_retry_interval=7)
+        self.assertEqual(0, describe.call_count)
+        self.assertEqual(7, ctx.operation._operation_retry.retry_after)
+        self.assertIn(constants.INSTANCE_WAIT_PROPERTY,
+                      ctx.instance.runtime_properties)
+
+    @mock_ec2
+    def test_started_pending_uses_transition_history(self):
+        """ this tests that a start that takes its state from the poller
+        schedules the retry from the history of the AMI and instance type,
+        and records the transition under the same key once it is done.
+        """
+
+        ctx = self.mock_ctx('test_started_pending_uses_transition_history')
+        current_ctx.set(ctx=ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE)
+        ctx.instance.runtime_properties['aws_resource_id'] = \
+            reservation.instances[0].id
+        stats_path = os.path.join(tempfile.mkdtemp(), 'stats.json')
+        self.addCleanup(os.remove, stats_path)
+        stats = waiter.TransitionStats(stats_path)
+        key = '{0}:{1}:{2}'.format(TEST_AMI_IMAGE_ID, TEST_INSTANCE_TYPE,
+                                   constants.INSTANCE_STATE_STARTED)
+        stats.record(key, 20)
+
+        with mock.patch.dict(os.environ, {
+                constants.WAITER_STATS_PATH_ENV_VAR_NAME: stats_path}), \
+                mock.patch('cloudify_aws.ec2.poller.InstanceStatePoller'
+                           '.get_state',
+                           return_value=constants.INSTANCE_STATE_PENDING):
+            with mock.patch('time.time', return_value=100):
+                self.create_instance_for_checking().started(
+                    start_retry_interval=60)
+            self.assertEqual(
+                20, ctx.operation._operation_retry.retry_after)
+            with mock.patch('time.time', return_value=130):
+                self.create_instance_for_checking()._state_reached(
+                    constants.INSTANCE_STATE_STARTED)
+
+        self.assertEqual({key: [20, 30]}, stats.load())
+
+    @mock_ec2
+    def test_started_describes_once(self):
+        """ this tests that a started instance is described once
+        for all of its runtime properties.
+        """
+
+        ctx = self.mock_ctx('test_started_describes_once')
+        current_ctx.set(ctx=ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE)
+        instance_id = reservation.instances[0].id
+        ctx.instance.runtime_properties['aws_resource_id'] = instance_id
+        test_instance = self.create_instance_for_checking()
+        describe = mock.Mock(
+            wraps=test_instance.client.get_all_reservations)
+        test_instance.client.get_all_reservations = describe
+        with mock.patch('cloudify_aws.ec2.poller.InstanceStatePoller'
+                        '.get_state',
+                        return_value=constants.INSTANCE_STATE_STARTED):
+            test_instance.start()
+        self.assertEqual(1, describe.call_count)
+        self.assertIn('ip', ctx.instance.runtime_properties)
+
+    def test_operation_cache(self):
+        """ this tests that provider variables and relationships are
+        resolved once per operation context
+        """
+
+        ctx = self.mock_ctx('test_operation_cache')
+        ctx.provider_context['resources'] = {
+            constants.AGENTS_AWS_INSTANCE_PARAMETERS: {'key': 'value'}}
+        target = MockContext({'instance': MockNodeInstanceContext(
+            runtime_properties={constants.EXTERNAL_RESOURCE_ID: 'sg-1'})})
+        ctx.instance._relationships = [
+            MockRelationshipContext(
+                target, 'cloudify.aws.relationships.'
+                        'instance_connected_to_security_group'),
+            MockRelationshipContext(
+                target, 'cloudify.relationships.contained_in')]
+        current_ctx.set(ctx=ctx)
+
+        provider_variables = utils.get_provider_variables()
+        provider_variables[
+            constants.AGENTS_AWS_INSTANCE_PARAMETERS]['key'] = 'changed'
+        ctx.provider_context['resources'] = {}
+        self.assertEqual(
+            {'key': 'value'},
+            utils.get_provider_variables()[
+                constants.AGENTS_AWS_INSTANCE_PARAMETERS])
+
+        for _ in range(2):
+            self.assertEqual(
+                ['sg-1'], utils.get_target_external_resource_ids(
+                    constants.INSTANCE_SECURITY_GROUP_RELATIONSHIP,
+                    ctx.instance))
+        self.assertEqual(
+            1, len(utils.get_operation_cache()['relationships']))
+
+    def test_relationship_type_exact_match(self):
+        """ this tests that relationship types match by full name and
+        through the type hierarchy, not by substring or short name
+        """
+
+        ctx = self.mock_ctx('test_relationship_type_exact_match')
+        relationships = []
+        for resource_id, type_name in [
+                ('sg-1', 'instance_connected_to_security_group'),
+                ('sg-2', 'instance_connected_to_security_group_v2'),
+                ('sg-3', 'my.derived_connection')]:
+            target = MockContext({'instance': MockNodeInstanceContext(
+                runtime_properties={
+                    constants.EXTERNAL_RESOURCE_ID: resource_id})})
+            relationship = MockRelationshipContext(
+                target, 'cloudify.aws.relationships.' + type_name)
+            relationships.append(relationship)
+        relationships[2].type = 'my.derived_connection'
+        relationships[2].type_hierarchy = [
+            'cloudify.aws.relationships.instance_connected_to_security_group',
+            'my.derived_connection']
+        ctx.instance._relationships = relationships
+        current_ctx.set(ctx=ctx)
+
+        self.assertEqual(
+            ['sg-1', 'sg-3'], utils.get_target_external_resource_ids(
+                constants.INSTANCE_SECURITY_GROUP_RELATIONSHIP,
+                ctx.instance))
+        self.assertTrue(utils.is_of_type(relationships[2],
+                                         'my.derived_connection'))
+        self.assertFalse(utils.is_of_type(relationships[1],
+                                          'instance_connected_to'))
+        self.assertFalse(utils.is_of_type(
+            relationships[0], 'instance_connected_to_security_group'))
+        self.assertFalse(utils.get_target_external_resource_ids(
+            'instance_connected_to_security_group', ctx.instance))
+
+        # The same through the targets by relationship type of AwsBase
+        base = AwsBase(client=mock.Mock())
+        targets = base.get_related_targets_and_types(relationships)
+        self.assertEqual(
+            ['sg-1', 'sg-3'], sorted(base.get_target_ids_of_relationship_type(
+                constants.INSTANCE_SECURITY_GROUP_RELATIONSHIP, targets)))
+        self.assertEqual([], base.get_target_ids_of_relationship_type(
+            'instance_connected_to_security_group', targets))
+
     @mock_ec2
     def test_terminate_clean(self):
         """ this tests that the instance.terminate function
@@ -452,6 +795,53 @@ class TestInstance(testtools.TestCase):
                 NonRecoverableError, instance.Instance().stop, ctx=ctx)
         self.assertIn('InvalidInstanceID', ex.message)
 
+    @mock_ec2
+    def test_terminate_terminated(self):
+        """ this tests that delete only confirms the termination of an
+            instance that was already terminated
+        """
+
+        ctx = self.mock_ctx('test_terminate_terminated')
+        current_ctx.set(ctx=ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE)
+        instance_id = reservation.instances[0].id
+        ec2_client.terminate_instances(instance_ids=[instance_id])
+        ctx.instance.runtime_properties['aws_resource_id'] = instance_id
+        test_instance = self.create_instance_for_checking()
+        test_instance.client.terminate_instances = mock.Mock()
+        self.assertTrue(test_instance.delete())
+        self.assertFalse(test_instance.client.terminate_instances.called)
+        self.assertNotIn('aws_resource_id', ctx.instance.runtime_properties)
+
+    @mock_ec2
+    def test_delete_after_batch_terminate(self):
+        """ this tests that the delete operations after a bulk
+            termination only confirm it, without terminate calls
+        """
+
+        ctx = self.mock_ctx('test_delete_after_batch_terminate')
+        current_ctx.set(ctx=ctx)
+        ec2_client = connection.EC2ConnectionClient().client()
+        reservation = ec2_client.run_instances(
+                TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE,
+                min_count=2, max_count=2)
+        instance_ids = [i.id for i in reservation.instances]
+        workflows.batch_terminate({'{}': instance_ids})
+
+        for instance_id in instance_ids:
+            ctx = self.mock_ctx('test_delete_after_batch_terminate')
+            current_ctx.set(ctx=ctx)
+            ctx.instance.runtime_properties['aws_resource_id'] = instance_id
+            with mock.patch.object(EC2Connection,
+                                   'terminate_instances') as terminate:
+                instance.delete(ctx=ctx)
+            self.assertFalse(terminate.called)
+            self.assertNotIn('aws_resource_id',
+                             ctx.instance.runtime_properties)
+
     @mock_ec2
     def test_terminate_bad_id(self):
         """ this tests that a terminate fails when given an
@@ -0,0 +1,188 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import os
+import time
+import shutil
+import tempfile
+import testtools
+
+# Third Party Imports
+import mock
+from moto import mock_ec2
+from boto.ec2 import EC2Connection
+
+# Cloudify Imports is imported and used in operations
+from cloudify_aws import constants
+from cloudify_aws.ec2 import poller
+from cloudify.state import current_ctx
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+TEST_AMI_IMAGE_ID = 'ami-e214778a'
+TEST_INSTANCE_TYPE = 't1.micro'
+
+
+class TestInstanceStatePoller(testtools.TestCase):
+
+    def setUp(self):
+        super(TestInstanceStatePoller, self).setUp()
+        self.poller_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.poller_dir)
+        current_ctx.set(ctx=MockCloudifyContext(node_id='test_poller'))
+
+    def get_poller(self, client, tick=60):
+        return poller.InstanceStatePoller(
+            client, os.path.join(self.poller_dir, 'poller.json'), tick)
+
+    def run_instances(self, client, count):
+        reservation = client.run_instances(
+            TEST_AMI_IMAGE_ID, instance_type=TEST_INSTANCE_TYPE,
+            min_count=count, max_count=count)
+        return [instance.id for instance in reservation.instances]
+
+    @mock_ec2
+    def test_one_describe_per_tick(self):
+        client = EC2Connection()
+        first, second = self.run_instances(client, 2)
+        describe = mock.Mock(wraps=client.get_all_reservations)
+        client.get_all_reservations = describe
+
+        self.assertEqual(constants.INSTANCE_STATE_STARTED,
+                         self.get_poller(client).get_state(first))
+        self.assertEqual(constants.INSTANCE_STATE_STARTED,
+                         self.get_poller(client).get_state(second))
+        self.assertEqual(2, describe.call_count)
+
+        # Both instances are waited for now, one call serves them both
+        client.stop_instances([first, second])
+        test_poller = self.get_poller(client, tick=0)
+        self.assertEqual(constants.INSTANCE_STATE_STOPPED,
+                         test_poller.get_state(first))
+        self.assertEqual(3, describe.call_count)
+        self.assertEqual(constants.INSTANCE_STATE_STOPPED,
+                         self.get_poller(client).get_state(second))
+        self.assertEqual(3, describe.call_count)
+
+    @mock_ec2
+    def test_unknown_instance(self):
+        client = EC2Connection()
+        self.assertIsNone(self.get_poller(client).get_state('i-4339wSD9'))
+
+    @mock_ec2
+    def test_release(self):
+        client = EC2Connection()
+        instance_id, = self.run_instances(client, 1)
+        test_poller = self.get_poller(client)
+        test_poller.get_state(instance_id)
+        test_poller.release(instance_id)
+        with test_poller._locked() as data:
+            self.assertEqual({}, data['waiting'])
+            self.assertEqual({}, data['states'])
+
+    @mock_ec2
+    def test_expired_instances_not_polled(self):
+        client = EC2Connection()
+        first, second = self.run_instances(client, 2)
+        with mock.patch('time.time', return_value=0):
+            self.get_poller(client, tick=0).get_state(first)
+        with mock.patch('time.time',
+                        return_value=constants.POLLER_EXPIRY + 1):
+            self.get_poller(client, tick=0).get_state(second)
+        with self.get_poller(client)._locked() as data:
+            self.assertEqual([second], data['waiting'].keys())
+
+    def assert_unlocked(self, test_poller):
+        # A second open file description of the state file takes the
+        # lock only if no one holds it
+        with open(test_poller.path) as state_file:
+            poller.fcntl.flock(state_file,
+                               poller.fcntl.LOCK_EX | poller.fcntl.LOCK_NB)
+            poller.fcntl.flock(state_file, poller.fcntl.LOCK_UN)
+
+    @mock_ec2
+    def test_describe_outside_lock(self):
+        client = EC2Connection()
+        instance_id, = self.run_instances(client, 1)
+        test_poller = self.get_poller(client)
+        describe = test_poller._describe
+
+        def describe_unlocked(instance_ids):
+            self.assert_unlocked(test_poller)
+            with test_poller._locked() as data:
+                self.assertIn('in_flight_until', data)
+            return describe(instance_ids)
+
+        with mock.patch.object(test_poller, '_describe',
+                               side_effect=describe_unlocked) as _describe:
+            self.assertEqual(constants.INSTANCE_STATE_STARTED,
+                             test_poller.get_state(instance_id))
+        self.assertEqual(1, _describe.call_count)
+        with test_poller._locked() as data:
+            self.assertNotIn('in_flight_until', data)
+
+    def test_last_result_while_in_flight(self):
+        test_poller = self.get_poller(mock.Mock(), tick=0)
+        with test_poller._locked() as data:
+            data['states'] = {'i-1': constants.INSTANCE_STATE_STARTED}
+            data['in_flight_until'] = time.time() + 60
+
+        with mock.patch.object(test_poller, '_describe') as describe:
+            self.assertEqual(constants.INSTANCE_STATE_STARTED,
+                             test_poller.get_state('i-1'))
+        self.assertFalse(describe.called)
+
+    def test_wait_for_poll_in_flight(self):
+        test_poller = self.get_poller(mock.Mock())
+        with test_poller._locked() as data:
+            data['in_flight_until'] = time.time() + 60
+
+        def publish(_):
+            with test_poller._locked() as data:
+                del data['in_flight_until']
+                data['states'] = {'i-1': constants.INSTANCE_STATE_STOPPED}
+                data['checked_at'] = time.time()
+
+        with mock.patch.object(test_poller, '_describe') as describe, \
+                mock.patch('time.sleep', side_effect=publish) as sleep:
+            self.assertEqual(constants.INSTANCE_STATE_STOPPED,
+                             test_poller.get_state('i-1'))
+        self.assertFalse(describe.called)
+        sleep.assert_called_once_with(constants.POLLER_IN_FLIGHT_WAIT)
+
+    def test_take_over_expired_poll(self):
+        test_poller = self.get_poller(mock.Mock())
+        with test_poller._locked() as data:
+            data['in_flight_until'] = time.time() - 1
+
+        with mock.patch.object(
+                test_poller, '_describe',
+                return_value={'i-1': constants.INSTANCE_STATE_STARTED}):
+            self.assertEqual(constants.INSTANCE_STATE_STARTED,
+                             test_poller.get_state('i-1'))
+        with test_poller._locked() as data:
+            self.assertNotIn('in_flight_until', data)
+
+    def test_failed_poll_ends_in_flight(self):
+        test_poller = self.get_poller(mock.Mock())
+
+        with mock.patch.object(test_poller, '_describe',
+                               side_effect=NonRecoverableError('error')):
+            self.assertRaises(NonRecoverableError,
+                              test_poller.get_state, 'i-1')
+        with test_poller._locked() as data:
+            self.assertNotIn('in_flight_until', data)
+            self.assertEqual(['i-1'], data['waiting'].keys())
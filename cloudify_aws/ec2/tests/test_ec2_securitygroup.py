@@ -18,7 +18,9 @@ import uuid
 import testtools
 
 # Third Party Imports
+import mock
 from moto import mock_ec2
+from boto.exception import EC2ResponseError
 
 # Cloudify Imports is imported and used in operations
 from cloudify.state import current_ctx
@@ -155,6 +157,29 @@ class TestSecurityGroup(testtools.TestCase):
         securitygroup.SecurityGroup().deleted()
         self.assertNotIn('aws_resource_id', ctx.instance.runtime_properties)
 
+    @mock_ec2
+    def test_delete_in_use(self):
+        """This tests that deleting a group that is still in use
+        is retried.
+        """
+
+        test_properties = self.get_mock_properties()
+        ctx = self.security_group_mock('test_delete_in_use', test_properties)
+        current_ctx.set(ctx=ctx)
+        ec2_client = connection.EC2ConnectionClient().client()
+        group = ec2_client.create_security_group('test_delete_in_use',
+                                                 'this is test')
+        ctx.instance.runtime_properties['aws_resource_id'] = group.id
+        test_securitygroup = securitygroup.SecurityGroup()
+        test_securitygroup.client.delete_security_group = mock.Mock(
+            side_effect=EC2ResponseError(400, 'Bad Request', body={
+                'Code': 'DependencyViolation'}))
+        with mock.patch.object(ctx.operation, 'retry') as retry:
+            test_securitygroup.deleted()
+        self.assertEqual(constants.DELETE_RETRY_INTERVAL,
+                         retry.call_args[1]['retry_after'])
+        self.assertIn('aws_resource_id', ctx.instance.runtime_properties)
+
     @mock_ec2
     def test_create_duplicate(self):
         """This tests that when you give a name of an existing
@@ -293,6 +318,167 @@ class TestSecurityGroup(testtools.TestCase):
                 str(ec2_client.get_all_security_groups(
                         groupnames='test_create_group_rules')[0].rules))
 
+    def test_compact_rules(self):
+        """ This tests that rules are merged by port range and CIDR block
+        without changing the traffic they allow.
+        """
+
+        rules = [
+            {'ip_protocol': 'tcp', 'from_port': '80', 'to_port': '80',
+             'cidr_ip': '10.0.0.0/25'},
+            {'ip_protocol': '6', 'from_port': 81, 'to_port': 90,
+             'cidr_ip': '10.0.0.0/25'},
+            {'ip_protocol': 'tcp', 'from_port': 80, 'to_port': 90,
+             'cidr_ip': '10.0.0.128/25'},
+            {'ip_protocol': 'tcp', 'from_port': 85, 'to_port': 85,
+             'cidr_ip': '10.0.0.7/32'},
+            {'ip_protocol': 'tcp', 'from_port': 443, 'to_port': 443,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'icmp', 'from_port': 0, 'to_port': -1,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'icmp', 'from_port': 8, 'to_port': -1,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'tcp', 'from_port': 22, 'to_port': 22,
+             'src_group_id': 'sg-12345678'},
+            {'ip_protocol': 'tcp', 'from_port': 23, 'to_port': 23,
+             'src_group_id': 'sg-12345678'},
+            {'ip_protocol': 'tcp', 'from_port': 22, 'to_port': 22}
+        ]
+
+        compacted = securitygroup.compact_rules(rules)
+
+        self.assertEqual([
+            {'ip_protocol': 'tcp', 'from_port': 80, 'to_port': 90,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'tcp', 'from_port': 443, 'to_port': 443,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'icmp', 'from_port': 0, 'to_port': -1,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'icmp', 'from_port': 8, 'to_port': -1,
+             'cidr_ip': '10.0.0.0/24'},
+            {'ip_protocol': 'tcp', 'from_port': 22, 'to_port': 23,
+             'src_group_id': 'sg-12345678'},
+            {'ip_protocol': 'tcp', 'from_port': 22, 'to_port': 22}
+        ], compacted)
+        # Rules are authorized from the compacted list, which must not
+        # change the node properties
+        self.assertIsNot(rules[-1], compacted[-1])
+
+    @mock_ec2
+    def test_shared_group(self):
+        """ This tests that shared groups with the same rules are created
+        once, and deleted with the last node instance that uses them.
+        """
+
+        contexts = []
+        for index in range(2):
+            test_properties = self.get_mock_properties()
+            test_properties['shared'] = True
+            test_properties['resource_id'] = \
+                'test_shared_group_{0}'.format(index)
+            ctx = self.security_group_mock(
+                'test_shared_group_{0}'.format(index), test_properties)
+            if index:
+                test_properties['rules'].reverse()
+            current_ctx.set(ctx=ctx)
+            securitygroup.create(ctx=ctx)
+            contexts.append(ctx)
+
+        ec2_client = connection.EC2ConnectionClient().client()
+        group_ids = set(
+            ctx.instance.runtime_properties[constants.EXTERNAL_RESOURCE_ID]
+            for ctx in contexts)
+        self.assertEqual(1, len(group_ids))
+        group_id = group_ids.pop()
+
+        current_ctx.set(ctx=contexts[0])
+        securitygroup.delete(ctx=contexts[0])
+        self.assertTrue(ec2_client.get_all_security_groups(
+            group_ids=[group_id]))
+        current_ctx.set(ctx=contexts[1])
+        securitygroup.delete(ctx=contexts[1])
+        self.assertFalse([group for group in
+                          ec2_client.get_all_security_groups()
+                          if group.id == group_id])
+
+    def shared_group_mock(self, test_name):
+        test_properties = self.get_mock_properties()
+        test_properties['shared'] = True
+        test_properties['resource_id'] = test_name
+        ctx = self.security_group_mock(test_name, test_properties)
+        current_ctx.set(ctx=ctx)
+        return ctx
+
+    def get_reference_count(self, group_id):
+        ec2_client = connection.EC2ConnectionClient().client()
+        return len([tag for tag in ec2_client.get_all_tags(
+            filters={'resource-id': group_id})
+            if tag.name.startswith(
+                constants.SECURITYGROUP['REFERENCE_TAG_PREFIX'])])
+
+    @mock_ec2
+    def test_shared_group_joined_while_released(self):
+        """ This tests that a shared group is kept when another node
+        instance starts to use it while its last reference is released.
+        """
+
+        ctx = self.shared_group_mock('test_shared_group_joined_0')
+        securitygroup.create(ctx=ctx)
+        group_id = ctx.instance.runtime_properties[
+            constants.EXTERNAL_RESOURCE_ID]
+        ec2_client = connection.EC2ConnectionClient().client()
+        get_tags = securitygroup.SecurityGroup.get_tags
+        calls = []
+
+        def get_tags_joined(group, resource_id):
+            calls.append(resource_id)
+            if len(calls) == 2:
+                # Found by its fingerprint before the release removed it
+                ec2_client.create_tags([resource_id], {
+                    constants.SECURITYGROUP['REFERENCE_TAG_PREFIX'] +
+                    'other': ''})
+            return get_tags(group, resource_id)
+
+        with mock.patch.object(securitygroup.SecurityGroup, 'get_tags',
+                               get_tags_joined):
+            securitygroup.delete(ctx=ctx)
+
+        self.assertTrue(ec2_client.get_all_security_groups(
+            group_ids=[group_id]))
+        self.assertIn(
+            constants.SECURITYGROUP['FINGERPRINT_TAG'],
+            [tag.name for tag in ec2_client.get_all_tags(
+                filters={'resource-id': group_id})])
+        self.assertEqual(1, self.get_reference_count(group_id))
+
+    @mock_ec2
+    def test_shared_group_released_while_joined(self):
+        """ This tests that a node instance does not use a shared group
+        that its last user releases while it adds its reference.
+        """
+
+        ctx = self.shared_group_mock('test_shared_group_released_0')
+        securitygroup.create(ctx=ctx)
+        group_id = ctx.instance.runtime_properties[
+            constants.EXTERNAL_RESOURCE_ID]
+        ec2_client = connection.EC2ConnectionClient().client()
+        get_tags = securitygroup.SecurityGroup.get_tags
+
+        def get_tags_released(group, resource_id):
+            ec2_client.delete_tags(
+                [resource_id], [constants.SECURITYGROUP['FINGERPRINT_TAG']])
+            return get_tags(group, resource_id)
+
+        ctx = self.shared_group_mock('test_shared_group_released_1')
+        with mock.patch.object(securitygroup.SecurityGroup, 'get_tags',
+                               get_tags_released):
+            securitygroup.create(ctx=ctx)
+
+        self.assertNotEqual(
+            group_id,
+            ctx.instance.runtime_properties[constants.EXTERNAL_RESOURCE_ID])
+        self.assertEqual(1, self.get_reference_count(group_id))
+
     @mock_ec2
     def test_create_group_rules_no_src_group_id_or_cidr(self):
         """ This tests that either src_group_id or cidr_ip is
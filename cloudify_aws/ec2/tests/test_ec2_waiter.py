@@ -0,0 +1,110 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import os
+import shutil
+import tempfile
+import testtools
+
+# Third Party Imports
+import mock
+
+# Cloudify Imports is imported and used in operations
+from cloudify_aws import constants
+from cloudify_aws.ec2 import waiter
+from cloudify.state import current_ctx
+from cloudify.mocks import MockCloudifyContext
+
+TEST_AMI_IMAGE_ID = 'ami-e214778a'
+TEST_INSTANCE_TYPE = 't1.micro'
+
+
+class TestWaiter(testtools.TestCase):
+
+    def setUp(self):
+        super(TestWaiter, self).setUp()
+        self.stats_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stats_dir)
+        self.stats = waiter.TransitionStats(
+            os.path.join(self.stats_dir, 'stats.json'))
+        ctx = MockCloudifyContext(node_id='test_waiter')
+        current_ctx.set(ctx=ctx)
+        self.ctx = ctx
+
+    def get_waiter(self, max_interval=30):
+        return waiter.InstanceStateWaiter(
+            TEST_AMI_IMAGE_ID, TEST_INSTANCE_TYPE,
+            constants.INSTANCE_STATE_STARTED,
+            max_interval, stats=self.stats)
+
+    def test_stats_estimate_is_median(self):
+        self.assertIsNone(self.stats.estimate('key'))
+        for duration in [40, 10, 20]:
+            self.stats.record('key', duration)
+        self.assertEqual(20, self.stats.estimate('key'))
+
+    def test_stats_keep_recent_samples(self):
+        for duration in range(constants.WAITER_SAMPLES + 5):
+            self.stats.record('key', duration)
+        self.assertEqual(constants.WAITER_SAMPLES,
+                         len(self.stats.load()['key']))
+        self.assertEqual(5, min(self.stats.load()['key']))
+
+    def test_interval_without_history(self):
+        test_waiter = self.get_waiter(max_interval=17)
+        self.assertEqual(17, test_waiter.next_interval())
+        self.assertIn(constants.INSTANCE_WAIT_PROPERTY,
+                      self.ctx.instance.runtime_properties)
+
+    def test_interval_from_history(self):
+        test_waiter = self.get_waiter()
+        self.stats.record(test_waiter.key, 20)
+        with mock.patch('time.time', return_value=100):
+            self.assertEqual(20, test_waiter.next_interval())
+        with mock.patch('time.time', return_value=112):
+            self.assertEqual(8, test_waiter.next_interval())
+        with mock.patch('time.time', return_value=119.5):
+            self.assertEqual(constants.WAITER_MIN_INTERVAL,
+                             test_waiter.next_interval())
+        with mock.patch('time.time', return_value=130):
+            self.assertEqual(10, test_waiter.next_interval())
+        with mock.patch('time.time', return_value=300):
+            self.assertEqual(30, test_waiter.next_interval())
+
+    def test_done_records_transition(self):
+        test_waiter = self.get_waiter()
+        with mock.patch('time.time', return_value=100):
+            test_waiter.next_interval()
+        with mock.patch('time.time', return_value=142):
+            test_waiter.done()
+        self.assertNotIn(constants.INSTANCE_WAIT_PROPERTY,
+                         self.ctx.instance.runtime_properties)
+        self.assertEqual(42, self.stats.estimate(test_waiter.key))
+
+    def test_done_without_wait_records_nothing(self):
+        test_waiter = self.get_waiter()
+        test_waiter.done()
+        self.assertEqual({}, self.stats.load())
+
+    def test_waiter_without_instance_type_learns_nothing(self):
+        test_waiter = waiter.InstanceStateWaiter(
+            TEST_AMI_IMAGE_ID, None, constants.INSTANCE_STATE_STARTED,
+            30, stats=self.stats)
+        with mock.patch('time.time', return_value=100):
+            self.assertEqual(30, test_waiter.next_interval())
+        with mock.patch('time.time', return_value=142):
+            test_waiter.done()
+        self.assertEqual({}, self.stats.load())
@@ -0,0 +1,566 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import testtools
+
+# Third Party Imports
+import mock
+import networkx as nx
+from moto import mock_ec2
+from boto.ec2 import EC2Connection
+from boto.exception import EC2ResponseError
+
+# Cloudify Imports is imported and used in operations
+from cloudify_aws import utils, workflows
+from cloudify.exceptions import NonRecoverableError
+from cloudify.workflows.tasks import HandlerResult, NOPLocalWorkflowTask
+from cloudify.workflows.tasks_graph import TaskDependencyGraph
+
+INSTANCE_TYPE = 'cloudify.aws.nodes.Instance'
+TEST_AMI_IMAGE_ID = 'ami-e214778a'
+OTHER_AWS_CONFIG = {'aws_access_key_id': 'other',
+                    'aws_secret_access_key': 'other'}
+
+
+class MockWorkflowNodeInstance(object):
+    """A workflow node instance whose operations are no-op tasks that
+    remember what they stand for.
+    """
+
+    def __init__(self, workflow_ctx, instance_id, node_type,
+                 properties=None, runtime_properties=None):
+        self.workflow_ctx = workflow_ctx
+        self.id = instance_id
+        self.node = mock.Mock(
+            type=node_type,
+            type_hierarchy=['cloudify.nodes.Root', node_type],
+            properties=properties or {},
+            operations={})
+        self._node_instance = mock.Mock(
+            runtime_properties=runtime_properties or {})
+        self.relationships = []
+        self.tasks = []
+
+    def task(self, name):
+        task = NOPLocalWorkflowTask(self.workflow_ctx)
+        task.info = name
+        self.tasks.append(task)
+        return task
+
+    def execute_operation(self, operation, **_):
+        return self.task(operation)
+
+    def set_state(self, state):
+        return self.task('state {0}'.format(state))
+
+    def send_event(self, event):
+        return self.task('event {0}'.format(event))
+
+    def relate(self, target):
+        relationship = mock.Mock(target_id=target.id,
+                                 target_node_instance=target)
+        relationship.execute_source_operation.side_effect = \
+            lambda operation: self.task('source {0}'.format(operation))
+        relationship.execute_target_operation.side_effect = \
+            lambda operation: target.task('target {0}'.format(operation))
+        self.relationships.append(relationship)
+        return relationship
+
+
+def get_workflow_context():
+    """A workflow context whose graph is built but not executed."""
+
+    ctx = mock.Mock()
+    graph = TaskDependencyGraph(ctx)
+    graph.execute = mock.Mock()
+    ctx.graph_mode.return_value = graph
+
+    def local_task(local_task, kwargs=None, name=None, **_):
+        task = NOPLocalWorkflowTask(ctx)
+        task.info = name
+        task.kwargs = kwargs
+        return task
+
+    ctx.local_task.side_effect = local_task
+    return ctx
+
+
+class TestRefreshIp(testtools.TestCase):
+
+    def get_pairs(self, ctx, public_ips, instance_ids):
+        instances = []
+        for index, (public_ip, instance_id) in enumerate(
+                zip(public_ips, instance_ids)):
+            ip = MockWorkflowNodeInstance(
+                ctx, 'ip{0}'.format(index), 'cloudify.aws.nodes.ElasticIP',
+                runtime_properties={'aws_resource_id': public_ip})
+            host = MockWorkflowNodeInstance(
+                ctx, 'host{0}'.format(index), INSTANCE_TYPE,
+                runtime_properties={'aws_resource_id': instance_id})
+            host.relate(ip)
+            instances.extend([ip, host])
+        ctx.node_instances = instances
+        return [i for i in instances if i.id.startswith('host')]
+
+    def get_operations(self, host):
+        return [task.info.split('.')[-1] for task in host.tasks]
+
+    def get_lanes(self, graph):
+        return list(nx.weakly_connected_components(graph.graph))
+
+    @mock.patch.object(workflows, 'get_addresses_by_public_ip',
+                       return_value={})
+    def test_refresh_ip_max_concurrency(self, *_):
+        ctx = get_workflow_context()
+        self.get_pairs(ctx, ['10.0.0.{0}'.format(i) for i in range(25)],
+                       ['i-{0}'.format(i) for i in range(25)])
+
+        workflows.refresh_ip(ctx=ctx, max_concurrency=10)
+
+        graph = ctx.graph_mode.return_value
+        graph.execute.assert_called_once_with()
+        lanes = self.get_lanes(graph)
+        self.assertEqual(10, len(lanes))
+        self.assertEqual(25, sum(len(lane) for lane in lanes))
+
+        # Fewer pairs than max_concurrency get a lane each
+        ctx = get_workflow_context()
+        self.get_pairs(ctx, ['10.0.0.1', '10.0.0.2'], ['i-1', 'i-2'])
+        workflows.refresh_ip(ctx=ctx, max_concurrency=10)
+        self.assertEqual(
+            2, len(self.get_lanes(ctx.graph_mode.return_value)))
+
+    @mock_ec2
+    def test_refresh_ip(self):
+        client = EC2Connection()
+        instance_ids = self.run_instances(client, 4)
+        addresses = [client.allocate_address() for _ in range(3)]
+        # The first address is where it belongs, the second one moved to
+        # another instance and the third one lost its association
+        client.associate_address(instance_ids[0], addresses[0].public_ip)
+        client.associate_address(instance_ids[3], addresses[1].public_ip)
+        client.allocate_address()
+
+        ctx = get_workflow_context()
+        hosts = self.get_pairs(
+            ctx,
+            [address.public_ip for address in addresses] + ['10.0.0.1'],
+            instance_ids)
+
+        calls = []
+        with self.describe_addresses(calls):
+            workflows.refresh_ip(ctx=ctx, max_concurrency=10)
+
+        # One call for all addresses, including the one that was released
+        self.assertEqual(1, len(calls))
+        self.assertEqual(
+            sorted([address.public_ip for address in addresses] +
+                   ['10.0.0.1']),
+            sorted(calls[0]['public-ip']))
+
+        self.assertEqual(
+            [[], ['unlink', 'establish'], ['establish'], ['establish']],
+            [self.get_operations(host) for host in hosts])
+
+        # A pair is unlinked before it is established again
+        graph = ctx.graph_mode.return_value
+        unlink, establish = hosts[1].tasks
+        self.assertTrue(nx.has_path(graph.graph, establish.id, unlink.id))
+        self.assertEqual(3, len(self.get_lanes(graph)))
+
+    @mock_ec2
+    def test_refresh_ip_nothing_to_do(self):
+        client = EC2Connection()
+        instance_ids = self.run_instances(client, 1)
+        address = client.allocate_address()
+        client.associate_address(instance_ids[0], address.public_ip)
+
+        ctx = get_workflow_context()
+        hosts = self.get_pairs(ctx, [address.public_ip], instance_ids)
+        with self.describe_addresses([]):
+            workflows.refresh_ip(ctx=ctx)
+
+        self.assertEqual([], hosts[0].tasks)
+        self.assertFalse(ctx.graph_mode.called)
+
+    def run_instances(self, client, count):
+        reservation = client.run_instances(
+            TEST_AMI_IMAGE_ID, min_count=count, max_count=count)
+        return [instance.id for instance in reservation.instances]
+
+    def describe_addresses(self, calls):
+        # moto does not filter addresses, it returns all of them
+        get_all_addresses = EC2Connection.get_all_addresses
+
+        def describe(client, filters=None):
+            calls.append(filters)
+            return get_all_addresses(client)
+
+        return mock.patch.object(EC2Connection, 'get_all_addresses', describe)
+
+
+class TestTeardown(testtools.TestCase):
+
+    def get_workflow_context(self):
+        return get_workflow_context()
+
+    def get_deployment(self, ctx):
+        def instance(instance_id, node_type, **kwargs):
+            return MockWorkflowNodeInstance(
+                ctx, instance_id, node_type, **kwargs)
+
+        vpc = instance('vpc', 'cloudify.aws.nodes.VPC',
+                       runtime_properties={'aws_resource_id': 'vpc-1'})
+        subnet = instance('subnet', 'cloudify.aws.nodes.Subnet',
+                          runtime_properties={'aws_resource_id': 'subnet-1'})
+        group = instance('group', 'cloudify.aws.nodes.SecurityGroup',
+                         runtime_properties={'aws_resource_id': 'sg-1'})
+        host = instance('host', INSTANCE_TYPE,
+                        properties={'agent_config':
+                                    {'install_method': 'init_script'}},
+                        runtime_properties={'aws_resource_id': 'i-1'})
+        app = instance('app', 'cloudify.nodes.SoftwareComponent')
+        subnet.relate(vpc)
+        host.relate(group)
+        host.relate(subnet)
+        app.relate(host)
+        ctx.node_instances = [vpc, app, group, host, subnet]
+        return dict((i.id, i) for i in ctx.node_instances)
+
+    def get_subgraph(self, instance, name=None):
+        for task in instance.tasks:
+            subgraph = task.containing_subgraph
+            if subgraph and (name is None or subgraph.name == name):
+                return subgraph
+
+    def get_task(self, graph, info):
+        for _, data in graph.graph.nodes(data=True):
+            if data['task'].info == info:
+                return data['task']
+
+    def test_get_teardown_layers(self):
+        ctx = self.get_workflow_context()
+        instances = self.get_deployment(ctx)
+
+        self.assertEqual(
+            [['app'], ['host'], ['group'], ['subnet'], ['vpc']],
+            [[i.id for i in layer] for layer in
+             workflows.get_teardown_layers(ctx.node_instances)])
+
+        # A node instance that something later depends on moves with it
+        volume = MockWorkflowNodeInstance(
+            ctx, 'volume', 'cloudify.aws.nodes.Volume')
+        volume.relate(instances['host'])
+        self.assertEqual(
+            [['app'], ['host', 'volume'], ['group'], ['subnet'], ['vpc']],
+            [[i.id for i in layer] for layer in
+             workflows.get_teardown_layers(ctx.node_instances + [volume])])
+
+    def test_teardown_layer_order(self):
+        ctx = self.get_workflow_context()
+        instances = self.get_deployment(ctx)
+
+        workflows.teardown(ctx=ctx)
+
+        graph = ctx.graph_mode.return_value
+        graph.execute.assert_called_once_with()
+        terminate_task = self.get_task(graph, 'batch_terminate')
+        self.assertEqual({'{}': ['i-1']},
+                         terminate_task.kwargs['instance_ids_by_config'])
+
+        app = self.get_subgraph(instances['app'])
+        stop_host = self.get_subgraph(instances['host'], 'stop_host')
+        delete_host = self.get_subgraph(instances['host'], 'delete_host')
+        group = self.get_subgraph(instances['group'], 'group')
+        subnet = self.get_subgraph(instances['subnet'], 'subnet')
+        vpc = self.get_subgraph(instances['vpc'], 'vpc')
+
+        # Each step waits for the one before it, src depends on dst
+        order = [app, stop_host, terminate_task, delete_host, group,
+                 subnet, vpc]
+        for later, earlier in zip(order[1:], order[:-1]):
+            self.assertTrue(nx.has_path(graph.graph, later.id, earlier.id),
+                            '{0} before {1}'.format(earlier.name, later.name))
+        self.assertFalse(nx.has_path(graph.graph, app.id, vpc.id))
+
+        # The stop operation is skipped, the agent is removed
+        operations = [task.info for task in stop_host.tasks.values()]
+        self.assertNotIn('cloudify.interfaces.lifecycle.stop', operations)
+        self.assertIn('cloudify.interfaces.cloudify_agent.stop_amqp',
+                      operations)
+        self.assertIn('source {0}'.format(workflows.UNLINK_OPERATION),
+                      operations)
+
+    def test_teardown_failures_are_ignored(self):
+        ctx = self.get_workflow_context()
+        instances = self.get_deployment(ctx)
+
+        workflows.teardown(ctx=ctx)
+
+        graph = ctx.graph_mode.return_value
+        # Like the built-in uninstall, a failed task is reported and the
+        # teardown goes on
+        tasks = [task for name in ('stop_host', 'delete_host')
+                 for task in self.get_subgraph(
+                     instances['host'], name).tasks.values()]
+        with mock.patch.object(MockWorkflowNodeInstance,
+                               'send_event') as send_event:
+            actions = set(task.on_failure(task).action for task in tasks)
+        self.assertEqual(set([HandlerResult.HANDLER_IGNORE]), actions)
+        self.assertEqual(len(tasks), send_event.call_count)
+
+        # The instances that were not terminated in bulk are terminated by
+        # their delete operation
+        terminate_task = self.get_task(graph, 'batch_terminate')
+        self.assertEqual(HandlerResult.HANDLER_IGNORE,
+                         terminate_task.on_failure(terminate_task).action)
+        self.assertTrue(ctx.logger.warn.called)
+
+
+class TestBatchTerminate(testtools.TestCase):
+
+    def run_instances(self, count):
+        reservation = EC2Connection().run_instances(
+            TEST_AMI_IMAGE_ID, min_count=count, max_count=count)
+        return [instance.id for instance in reservation.instances]
+
+    def get_states(self, instance_ids):
+        return dict((instance.id, instance.state) for instance in
+                    EC2Connection().get_only_instances(instance_ids))
+
+    def terminate(self, calls, fail_with=None):
+        terminate_instances = EC2Connection.terminate_instances
+
+        def terminate(client, instance_ids=None, **kwargs):
+            calls.append(list(instance_ids))
+            if fail_with in instance_ids:
+                raise EC2ResponseError(400, 'Bad Request')
+            return terminate_instances(
+                client, instance_ids=instance_ids, **kwargs)
+
+        return mock.patch.object(EC2Connection, 'terminate_instances',
+                                 terminate)
+
+    @mock_ec2
+    @mock.patch.object(workflows, 'TERMINATE_CHUNK_SIZE', 2)
+    def test_batch_terminate_chunks_by_config(self):
+        instance_ids = self.run_instances(5)
+        other_ids = self.run_instances(1)
+        calls = []
+
+        with self.terminate(calls), \
+                mock.patch.object(workflows, 'get_client',
+                                  wraps=workflows.get_client) as get_client:
+            workflows.batch_terminate(workflows.get_instance_ids_by_config([
+                mock.Mock(node=mock.Mock(properties=properties),
+                          _node_instance=mock.Mock(runtime_properties={
+                              'aws_resource_id': instance_id}))
+                for properties, instance_id in
+                [({}, i) for i in instance_ids] +
+                [({'aws_config': OTHER_AWS_CONFIG}, i) for i in other_ids]]))
+
+        self.assertEqual(
+            sorted([instance_ids[:2], instance_ids[2:4], instance_ids[4:],
+                    other_ids]),
+            sorted(calls))
+        self.assertEqual(
+            sorted([{}, OTHER_AWS_CONFIG]),
+            sorted(call[0][0] for call in get_client.call_args_list))
+        self.assertEqual(
+            set(['terminated']),
+            set(self.get_states(instance_ids + other_ids).values()))
+
+    @mock_ec2
+    @mock.patch.object(workflows, 'TERMINATE_CHUNK_SIZE', 2)
+    def test_batch_terminate_chunk_failure(self):
+        instance_ids = self.run_instances(5)
+        calls = []
+
+        with self.terminate(calls, fail_with=instance_ids[2]):
+            error = self.assertRaises(
+                NonRecoverableError, workflows.batch_terminate,
+                {'{}': instance_ids})
+
+        # The chunks after the failed one are still terminated
+        self.assertEqual(3, len(calls))
+        self.assertIn(str(instance_ids[2:4]), error.message)
+        states = self.get_states(instance_ids)
+        self.assertEqual(
+            ['terminated', 'terminated', 'running', 'running', 'terminated'],
+            [states[instance_id] for instance_id in instance_ids])
+
+
+class TestDetectDrift(testtools.TestCase):
+
+    def get_instance(self, node_type, runtime_properties):
+        return MockWorkflowNodeInstance(
+            mock.Mock(), 'instance', node_type,
+            runtime_properties=runtime_properties)
+
+    def get_resource(self):
+        # Every attribute of a mock is a value of its own, the routes and
+        # load balancer instances have to be lists
+        return mock.Mock(routes=[], instances=[])
+
+    def test_get_drift(self):
+        for node_type, spec in workflows.DRIFT_RESOURCES.items():
+            resource = self.get_resource()
+            runtime_properties = dict(
+                (property_name, get_value(resource)) for
+                property_name, get_value in spec['properties'].items())
+            runtime_properties['aws_resource_id'] = 'resource-1'
+            instance = self.get_instance(node_type, runtime_properties)
+
+            self.assertEqual(node_type,
+                             workflows.get_drift_node_type(instance))
+            self.assertIsNone(workflows.get_drift(instance, spec, resource),
+                              node_type)
+            self.assertEqual({'missing': 'resource-1'},
+                             workflows.get_drift(instance, spec, None))
+
+            for property_name, get_value in spec['properties'].items():
+                if property_name in spec.get('normalize', {}):
+                    continue
+                expected = runtime_properties[property_name]
+                runtime_properties[property_name] = 'stale'
+                self.assertEqual(
+                    {'changed': {property_name: get_value(resource)}},
+                    workflows.get_drift(instance, spec, resource))
+
+                # Properties that were never stored are not compared
+                del runtime_properties[property_name]
+                self.assertIsNone(
+                    workflows.get_drift(instance, spec, resource))
+                runtime_properties[property_name] = expected
+
+    def test_get_drift_normalizes(self):
+        spec = workflows.DRIFT_RESOURCES['cloudify.aws.nodes.ElasticIP']
+        instance = self.get_instance('cloudify.aws.nodes.ElasticIP', {
+            'aws_resource_id': '10.0.0.1', 'instance_id': ''})
+        self.assertIsNone(workflows.get_drift(
+            instance, spec, mock.Mock(instance_id=None)))
+
+        node_type = 'cloudify.aws.nodes.ElasticLoadBalancer'
+        spec = workflows.DRIFT_RESOURCES[node_type]
+        instance = self.get_instance(node_type, {
+            'aws_resource_id': 'elb', 'instance_list': ['i-2', 'i-1']})
+        load_balancer = mock.Mock(
+            instances=[mock.Mock(id='i-1'), mock.Mock(id='i-2')])
+        self.assertIsNone(workflows.get_drift(instance, spec, load_balancer))
+
+    def test_get_drift_routes(self):
+        node_type = 'cloudify.aws.nodes.RouteTable'
+        spec = workflows.DRIFT_RESOURCES[node_type]
+
+        def route(destination_cidr_block, **targets):
+            return mock.Mock(**dict(
+                dict((key, None) for key in workflows.ROUTE_KEYS),
+                destination_cidr_block=destination_cidr_block, **targets))
+
+        route_table = mock.Mock(vpc_id='vpc-1', routes=[
+            route('10.0.0.0/16', gateway_id='local'),
+            route('0.0.0.0/0', gateway_id='igw-1'),
+            route('10.1.0.0/16', vpc_peering_connection_id='pcx-1')])
+        routes = [
+            {'destination_cidr_block': '10.1.0.0/16',
+             'vpc_peering_connection_id': 'pcx-1'},
+            {'destination_cidr_block': '0.0.0.0/0', 'gateway_id': 'igw-1'}]
+
+        # Both the current and the older format of the routes
+        for stored in (routes, utils.encode_routes(routes)):
+            instance = self.get_instance(node_type, {
+                'aws_resource_id': 'rtb-1', 'vpc_id': 'vpc-1',
+                'routes': stored})
+            self.assertIsNone(
+                workflows.get_drift(instance, spec, route_table))
+
+        instance = self.get_instance(node_type, {
+            'aws_resource_id': 'rtb-1', 'vpc_id': 'vpc-1',
+            'routes': routes[:1]})
+        self.assertEqual(
+            {'changed': {'routes': utils.encode_routes(routes)}},
+            workflows.get_drift(instance, spec, route_table))
+
+    def get_deployment(self, ctx):
+        client = EC2Connection()
+        reservation = client.run_instances(TEST_AMI_IMAGE_ID)
+        host = reservation.instances[0]
+        address = client.allocate_address()
+        client.associate_address(host.id, address.public_ip)
+        key_pair = client.create_key_pair('key')
+
+        def instance(instance_id, node_type, runtime_properties):
+            return MockWorkflowNodeInstance(
+                ctx, instance_id, node_type,
+                runtime_properties=runtime_properties)
+
+        ctx.node_instances = [
+            instance('host', INSTANCE_TYPE, {
+                'aws_resource_id': host.id,
+                'ip': host.private_ip_address}),
+            instance('ip', 'cloudify.aws.nodes.ElasticIP', {
+                'aws_resource_id': address.public_ip,
+                'instance_id': 'i-00000000'}),
+            instance('key', 'cloudify.aws.nodes.KeyPair', {
+                'aws_resource_id': key_pair.name}),
+            instance('lost_key', 'cloudify.aws.nodes.KeyPair', {
+                'aws_resource_id': 'lost'}),
+            # Not created yet, or not an AWS resource
+            instance('group', 'cloudify.aws.nodes.SecurityGroup', {}),
+            instance('app', 'cloudify.nodes.SoftwareComponent', {})]
+        return host.id
+
+    @mock_ec2
+    def test_detect_drift(self):
+        ctx = mock.Mock()
+        host_id = self.get_deployment(ctx)
+
+        with mock.patch.object(workflows, 'update_node_instance') as update:
+            report = workflows.detect_drift(ctx=ctx)
+
+        self.assertEqual(
+            {'ip': {'changed': {'instance_id': host_id}},
+             'lost_key': {'missing': 'lost'}},
+            report)
+        self.assertFalse(update.called)
+
+        messages = [call[0][0] for call in ctx.logger.info.call_args_list]
+        self.assertIn(
+            'drift ip: {{"changed": {{"instance_id": "{0}"}}}}'.format(
+                host_id),
+            messages)
+        self.assertIn('drift lost_key: {"missing": "lost"}', messages)
+        # One describe call per resource type
+        self.assertIn('2 of 4 node instances drifted (3 describe calls)',
+                      messages)
+
+    @mock_ec2
+    def test_detect_drift_reconcile(self):
+        ctx = mock.Mock()
+        host_id = self.get_deployment(ctx)
+        node_instance = mock.Mock(runtime_properties={
+            'aws_resource_id': 'ip', 'instance_id': 'i-00000000'})
+
+        with mock.patch.object(workflows, 'get_node_instance',
+                               return_value=node_instance) as get, \
+                mock.patch.object(workflows, 'update_node_instance') as update:
+            workflows.detect_drift(ctx=ctx, reconcile=True)
+
+        # Missing resources are only reported
+        get.assert_called_once_with('ip')
+        update.assert_called_once_with(node_instance)
+        self.assertEqual({'aws_resource_id': 'ip', 'instance_id': host_id},
+                         node_instance.runtime_properties)
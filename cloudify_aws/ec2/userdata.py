@@ -0,0 +1,99 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import json
+import gzip
+import hashlib
+from StringIO import StringIO
+from collections import OrderedDict
+
+# Cloudify imports
+from cloudify import ctx
+from cloudify import compute
+from cloudify_aws import constants, utils
+
+# Assembled payloads by the hash of their inputs
+_PAYLOAD_CACHE = OrderedDict()
+
+
+def get_agent_script():
+    """Returns the agent init script of the current node instance.
+
+    The script depends on the agent and manager settings at the time it
+    is rendered, so it is only kept for the current operation. A heal or
+    a reinstall renders it again.
+    """
+
+    cache = utils.get_operation_cache()
+
+    if 'agent_script' not in cache:
+        cache['agent_script'] = ctx.agent.init_script()
+
+    return cache['agent_script']
+
+
+def build(existing_userdata, agent_script, compress=True):
+    """Returns the user data to launch an instance with.
+
+    When both user data and an agent script are given, they are combined
+    into a multipart message, which is gzipped if compress is set.
+    cloud-init detects and decompresses gzipped user data. Identical
+    inputs, as for all the instances of a node without an agent script,
+    are assembled only once.
+    """
+
+    if not (existing_userdata and agent_script):
+        return existing_userdata or agent_script
+
+    key = _hash(existing_userdata, agent_script, compress)
+
+    return _cached(_PAYLOAD_CACHE, key, lambda: _build_multipart(
+        existing_userdata, agent_script, compress))
+
+
+def _build_multipart(existing_userdata, agent_script, compress):
+
+    userdata = compute.create_multi_mimetype_userdata(
+        [existing_userdata, agent_script])
+
+    if not compress:
+        return userdata
+
+    buf = StringIO()
+    # A fixed mtime keeps the payload identical for identical inputs
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gzip_file:
+        gzip_file.write(userdata)
+
+    return buf.getvalue()
+
+
+def _hash(*inputs):
+    return hashlib.sha1(
+        json.dumps(inputs, sort_keys=True, default=str)).hexdigest()
+
+
+def _cached(cache, key, build_value):
+
+    if key in cache:
+        value = cache.pop(key)
+    else:
+        value = build_value()
+
+    cache[key] = value
+    while len(cache) > constants.USERDATA_CACHE_SIZE:
+        cache.popitem(last=False)
+
+    return value
@@ -0,0 +1,147 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import os
+import json
+import time
+import tempfile
+
+# Cloudify imports
+from cloudify import ctx
+from cloudify_aws import constants
+
+
+def get_stats_path():
+    return os.environ.get(
+        constants.WAITER_STATS_PATH_ENV_VAR_NAME,
+        os.path.join(tempfile.gettempdir(),
+                     constants.WAITER_STATS_FILE_NAME))
+
+
+class TransitionStats(object):
+    """Durations of the instance state transitions observed on this host,
+    kept in a small JSON file keyed by AMI, instance type and state.
+
+    Concurrent operations may overwrite each other's samples. That only
+    costs a sample, the file itself is always replaced atomically.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_stats_path()
+
+    def load(self):
+        try:
+            with open(self.path) as stats_file:
+                return json.load(stats_file)
+        except (IOError, ValueError):
+            return {}
+
+    def estimate(self, key):
+        """Returns the median duration of a transition, or None if it
+        was never observed.
+        """
+
+        samples = sorted(self.load().get(key, []))
+
+        if not samples:
+            return None
+
+        return samples[len(samples) // 2]
+
+    def record(self, key, duration):
+
+        stats = self.load()
+        samples = stats.setdefault(key, [])
+        samples.append(round(duration, 1))
+        del samples[:-constants.WAITER_SAMPLES]
+
+        directory = os.path.dirname(self.path) or '.'
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as stats_file:
+                json.dump(stats, stats_file)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            ctx.logger.debug(
+                'Unable to save waiter stats to {0}: {1}'
+                .format(self.path, str(e)))
+
+
+class InstanceStateWaiter(object):
+    """Schedules the retries of an operation that waits for an instance
+    to reach a state.
+
+    The time the wait started is kept in the runtime properties, so that
+    it survives the retries. The next poll is scheduled for when the
+    instance is expected to reach the state, based on the transitions
+    previously observed for the same AMI and instance type. Once that
+    time has passed, the interval grows with the time already overdue.
+    Without an AMI or instance type there is no history to learn from,
+    and the max interval is used.
+    """
+
+    def __init__(self, image_id, instance_type, state,
+                 max_interval=None, stats=None):
+        self.key = '{0}:{1}:{2}'.format(image_id, instance_type, state) \
+            if image_id and instance_type else None
+        self.state = state
+        self.max_interval = max_interval or constants.WAITER_MAX_INTERVAL
+        self.stats = stats or TransitionStats()
+
+    def get_started_at(self):
+
+        wait = ctx.instance.runtime_properties.get(
+            constants.INSTANCE_WAIT_PROPERTY)
+
+        if wait and wait.get('state') == self.state:
+            return wait.get('since')
+
+        return None
+
+    def next_interval(self):
+        """Returns the number of seconds to wait before the next poll."""
+
+        now = time.time()
+        started_at = self.get_started_at()
+
+        if started_at is None:
+            started_at = now
+            ctx.instance.runtime_properties[
+                constants.INSTANCE_WAIT_PROPERTY] = \
+                {'state': self.state, 'since': now}
+
+        estimate = self.stats.estimate(self.key) if self.key else None
+
+        if estimate is None:
+            return self.max_interval
+
+        elapsed = now - started_at
+        remaining = estimate - elapsed
+        interval = remaining if remaining > 0 else elapsed - estimate
+
+        return int(max(constants.WAITER_MIN_INTERVAL,
+                       min(interval, self.max_interval)))
+
+    def done(self):
+        """Records how long the transition took, if it was waited for."""
+
+        started_at = self.get_started_at()
+
+        ctx.instance.runtime_properties.pop(
+            constants.INSTANCE_WAIT_PROPERTY, None)
+
+        if started_at is not None and self.key:
+            self.stats.record(self.key, time.time() - started_at)
@@ -15,10 +15,12 @@
 
 # Built-in Imports
 import os
+import time
 
 # Cloudify Imports
 from . import constants
 from cloudify import ctx
+from cloudify.state import current_ctx
 from cloudify.exceptions import NonRecoverableError
 
 
@@ -105,6 +107,34 @@ def unassign_runtime_property_from_resource(property_name, ctx_instance):
                                                           value))
 
 
+def encode_routes(routes):
+    """Returns routes as they are stored in the runtime properties: the
+    targets of the routes by their destination blocks. The route table
+    id is left out, it is the id of the node instance.
+
+    :param routes: A list of route dicts.
+    """
+
+    return dict(
+        (route['destination_cidr_block'],
+         dict((key, value) for key, value in route.items()
+              if key not in constants.ROUTE_ENCODED_KEYS))
+        for route in routes or [])
+
+
+def decode_routes(routes):
+    """Returns a list of route dicts from the routes runtime property,
+    which is a list of route dicts in blueprints that were installed by
+    older versions of the plugin.
+    """
+
+    if isinstance(routes, dict):
+        return [dict(target, destination_cidr_block=destination)
+                for destination, target in sorted(routes.items())]
+
+    return [dict(route) for route in routes or []]
+
+
 def use_external_resource(ctx_node_properties):
     """Checks if use_external_resource node property is true,
     logs the ID and answer to the debug log,
@@ -126,6 +156,92 @@ def use_external_resource(ctx_node_properties):
         return True
 
 
+def get_operation_cache():
+    """Returns a dict that lives as long as the current operation context.
+
+    Values that cannot change while an operation runs, like the provider
+    context and the relationships of a node instance, are resolved once
+    and kept here.
+    """
+
+    operation_ctx = current_ctx.get_ctx()
+    cache = getattr(operation_ctx, '_aws_operation_cache', None)
+
+    if cache is None:
+        cache = {}
+        setattr(operation_ctx, '_aws_operation_cache', cache)
+
+    return cache
+
+
+def get_type_index(type_hierarchy):
+    """Returns the names a node or relationship type answers to: the
+    full name of every type in its hierarchy. Indexes are shared by all
+    the entities with the same hierarchy.
+
+    :param type_hierarchy: A list of type names.
+    :returns a frozenset of type names.
+    """
+
+    key = tuple(type_hierarchy)
+    index = _TYPE_INDEXES.get(key)
+
+    if index is None:
+        index = _TYPE_INDEXES[key] = frozenset(key)
+
+    return index
+
+
+def get_type_hierarchy(entity):
+    """Returns the type hierarchy of a node or relationship, including
+    its own type.
+
+    :param entity: A node or relationship context.
+    """
+
+    type_hierarchy = list(getattr(entity, 'type_hierarchy', None) or [])
+    own_type = getattr(entity, 'type', None)
+    if own_type and own_type not in type_hierarchy:
+        type_hierarchy.append(own_type)
+
+    return type_hierarchy
+
+
+def is_of_type(entity, type_name):
+    """Checks whether a node or relationship is of a type, or derives
+    from it.
+
+    :param entity: A node or relationship context.
+    :param type_name: A full type name.
+    """
+
+    return type_name in get_type_index(get_type_hierarchy(entity))
+
+
+# Type name indexes by type hierarchy
+_TYPE_INDEXES = {}
+
+
+def get_relationship_index(ctx_instance):
+    """Indexes the relationships of a node instance in a single pass.
+
+    :param ctx_instance:  The Cloudify ctx context.
+    :returns a dict from every type name a relationship answers to,
+    to the relationships that answer to it.
+    """
+
+    indexes = get_operation_cache().setdefault('relationships', {})
+    index = indexes.get(ctx_instance.id)
+
+    if index is None:
+        index = indexes[ctx_instance.id] = {}
+        for r in ctx_instance.relationships:
+            for type_name in get_type_index(get_type_hierarchy(r)):
+                index.setdefault(type_name, []).append(r)
+
+    return index
+
+
 def get_target_external_resource_ids(relationship_type, ctx_instance):
     """Gets a list of target node ids connected via a relationship to a node.
 
@@ -141,16 +257,41 @@ def get_target_external_resource_ids(relationship_type, ctx_instance):
                         'because none are attached to this node.')
         return ids
 
-    for r in ctx_instance.relationships:
-        if relationship_type in r.type or \
-                        relationship_type in r.type_hierarchy:
-            ids.append(
-                    r.target.instance.runtime_properties[
-                        constants.EXTERNAL_RESOURCE_ID])
+    for r in get_relationship_index(ctx_instance).get(relationship_type, []):
+        ids.append(
+                r.target.instance.runtime_properties[
+                    constants.EXTERNAL_RESOURCE_ID])
 
     return ids
 
 
+def wait_for(get_value, is_ready, timeout=None):
+    """Polls a value until it is ready, sleeping twice as long after
+    every poll, up to a bound. This is for resources that usually settle
+    within a couple of seconds, which would otherwise cost a full
+    operation retry.
+
+    :param get_value: A function that returns the current value.
+    :param is_ready: A function that checks whether a value is ready.
+    :param timeout: Seconds to poll for, before giving up.
+    :returns the ready value, or None if it was not ready in time.
+    """
+
+    timeout = constants.READY_WAIT_TIMEOUT if timeout is None else timeout
+    deadline = time.time() + timeout
+    interval = constants.READY_WAIT_MIN_INTERVAL
+
+    while True:
+        value = get_value()
+        if is_ready(value):
+            return value
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, constants.READY_WAIT_MAX_INTERVAL)
+
+
 def get_resource_id():
     """Returns the resource id, if the user doesn't provide one,
     this will create one for them.
@@ -169,25 +310,41 @@ def get_resource_id():
     return '{0}-{1}'.format(ctx.deployment.id, ctx.instance.id)
 
 
+def get_reference_tag(prefix):
+    """Returns the key of the tag that marks a shared resource as used
+    by the current node instance.
+    """
+
+    return '{0}{1}:{2}'.format(prefix, ctx.deployment.id, ctx.instance.id)
+
+
 def get_provider_variables():
 
-    provider_config = ctx.provider_context.get('resources', {})
-
-    provider_context = {
-        constants.AGENTS_KEYPAIR:
-            provider_config.get(constants.AGENTS_KEYPAIR, {}).get('id'),
-        constants.AGENTS_SECURITY_GROUP:
-            provider_config.get(constants.AGENTS_SECURITY_GROUP,
-                                {}).get('id'),
-        constants.SUBNET['AWS_RESOURCE_TYPE']:
-            provider_config.get(constants.SUBNET['AWS_RESOURCE_TYPE'],
-                                {}).get('id'),
-        constants.VPC['AWS_RESOURCE_TYPE']:
-            provider_config.get(constants.VPC['AWS_RESOURCE_TYPE'],
-                                {}).get('id'),
-        constants.AGENTS_AWS_INSTANCE_PARAMETERS:
-            provider_config.get(constants.AGENTS_AWS_INSTANCE_PARAMETERS, {})
-    }
+    cache = get_operation_cache()
+
+    if 'provider_variables' not in cache:
+        provider_config = ctx.provider_context.get('resources', {})
+        cache['provider_variables'] = {
+            constants.AGENTS_KEYPAIR:
+                provider_config.get(constants.AGENTS_KEYPAIR, {}).get('id'),
+            constants.AGENTS_SECURITY_GROUP:
+                provider_config.get(constants.AGENTS_SECURITY_GROUP,
+                                    {}).get('id'),
+            constants.SUBNET['AWS_RESOURCE_TYPE']:
+                provider_config.get(constants.SUBNET['AWS_RESOURCE_TYPE'],
+                                    {}).get('id'),
+            constants.VPC['AWS_RESOURCE_TYPE']:
+                provider_config.get(constants.VPC['AWS_RESOURCE_TYPE'],
+                                    {}).get('id'),
+            constants.AGENTS_AWS_INSTANCE_PARAMETERS:
+                provider_config.get(
+                    constants.AGENTS_AWS_INSTANCE_PARAMETERS, {})
+        }
+
+    # Callers update the instance parameters, so hand out copies
+    provider_context = dict(cache['provider_variables'])
+    provider_context[constants.AGENTS_AWS_INSTANCE_PARAMETERS] = dict(
+        provider_context[constants.AGENTS_AWS_INSTANCE_PARAMETERS])
 
     return provider_context
 
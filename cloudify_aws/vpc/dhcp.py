@@ -13,11 +13,19 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+# Built-in Imports
+import json
+import hashlib
+
+# Third-party Imports
+from boto import exception
+
 # Cloudify imports
 from cloudify_aws import constants, connection, utils
 from cloudify_aws.base import AwsBaseNode, AwsBaseRelationship
 from cloudify import ctx
 from cloudify.decorators import operation
+from cloudify.exceptions import NonRecoverableError, RecoverableError
 
 
 @operation
@@ -88,6 +96,8 @@ class DhcpAssociation(AwsBaseRelationship):
 
 class DhcpOptions(AwsBaseNode):
 
+    wait_for_visible = True
+
     def __init__(self):
         super(DhcpOptions, self).__init__(
             constants.DHCP_OPTIONS['AWS_RESOURCE_TYPE'],
@@ -100,15 +110,53 @@ class DhcpOptions(AwsBaseNode):
             'argument':
             '{0}_ids'.format(constants.DHCP_OPTIONS['AWS_RESOURCE_TYPE'])
         }
+        self.reuse = ctx.node.properties.get(
+            constants.DHCP_OPTIONS['REUSE_PROPERTY'], False)
 
     def create(self, args):
         create_args = self.generate_create_args()
         create_args = utils.update_args(create_args, args)
+        if self.reuse:
+            return self.create_shared(create_args)
         dhcp_options = self.execute(self.client.create_dhcp_options,
                                     create_args, raise_on_falsy=True)
         self.resource_id = dhcp_options.id
         return True
 
+    def create_shared(self, create_args):
+        """Uses the option set with the same options, creating it only if
+        there is none. Sets are found by a tag with the hash of their
+        options, and every node instance that uses a set holds a
+        reference tag on it.
+        """
+
+        hash_tag = constants.DHCP_OPTIONS['HASH_TAG']
+        options_hash = get_options_hash(create_args)
+
+        existing = self.execute(
+            self.client.get_all_dhcp_options,
+            dict(filters={'tag:{0}'.format(hash_tag): options_hash}))
+
+        for dhcp_options in sorted(existing or [], key=lambda e: e.id):
+            if self.add_reference(
+                    dhcp_options.id,
+                    constants.DHCP_OPTIONS['REFERENCE_TAG_PREFIX'],
+                    hash_tag):
+                ctx.logger.info('Reusing DHCP options {0}.'
+                                .format(dhcp_options.id))
+                break
+        else:
+            dhcp_options = self.execute(self.client.create_dhcp_options,
+                                        create_args, raise_on_falsy=True)
+            self.execute(self.client.create_tags, dict(
+                resource_ids=[dhcp_options.id],
+                tags={hash_tag: options_hash}))
+            self.add_reference(dhcp_options.id,
+                               constants.DHCP_OPTIONS['REFERENCE_TAG_PREFIX'])
+
+        self.resource_id = dhcp_options.id
+        return True
+
     def generate_create_args(self):
         return dict(
             domain_name=ctx.node.properties['domain_name'],
@@ -124,5 +172,63 @@ class DhcpOptions(AwsBaseNode):
     def delete(self, args):
         delete_args = dict(dhcp_options_id=self.resource_id)
         delete_args = utils.update_args(delete_args, args)
+        if self.reuse:
+            return self.delete_shared(delete_args)
         return self.execute(self.client.delete_dhcp_options,
                             delete_args, raise_on_falsy=True)
+
+    def delete_shared(self, delete_args):
+        """Drops the reference of this node instance, and deletes the
+        option set once no node instance uses it. While a VPC is still
+        associated with the set the delete is retried, and the set can
+        be reused meanwhile.
+        """
+
+        hash_tag = constants.DHCP_OPTIONS['HASH_TAG']
+        tags = self.get_tags(self.resource_id)
+        lookup = {hash_tag: tags[hash_tag]} if hash_tag in tags else None
+
+        references = self.release_reference(
+            self.resource_id, constants.DHCP_OPTIONS['REFERENCE_TAG_PREFIX'],
+            hash_tag)
+
+        if references:
+            ctx.logger.info(
+                'Keeping DHCP options {0}, still used by {1} others.'
+                .format(self.resource_id, references))
+            return True
+
+        try:
+            return self.client.delete_dhcp_options(**delete_args)
+        except exception.EC2ResponseError as e:
+            if constants.DHCP_OPTIONS['DEPENDENCY_VIOLATION'] in str(e):
+                # Keep the set reusable, a node instance that reuses it
+                # before the retry keeps it from being deleted
+                if lookup:
+                    self.execute(self.client.create_tags, dict(
+                        resource_ids=[self.resource_id], tags=lookup))
+                raise RecoverableError(
+                    'DHCP options {0} are still associated with a VPC.'
+                    .format(self.resource_id),
+                    retry_after=constants.DELETE_RETRY_INTERVAL)
+            raise NonRecoverableError('{0}'.format(str(e)))
+        except exception.BotoServerError as e:
+            raise NonRecoverableError('{0}'.format(str(e)))
+
+
+def get_options_hash(create_args):
+    """Returns a hash of DHCP options that does not depend on the order
+    of the servers, the case of the names or on empty options.
+    """
+
+    options = {}
+
+    for key, value in create_args.items():
+        if isinstance(value, list):
+            value = sorted('{0}'.format(item).lower() for item in value)
+        elif value is not None:
+            value = '{0}'.format(value).lower()
+        if value:
+            options[key] = value
+
+    return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
@@ -13,20 +13,26 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+# Built-in Imports
+from Queue import Queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
 # Cloudify imports
 from cloudify_aws import constants, utils, connection
-from cloudify_aws.base import AwsBaseNode, AwsBaseRelationship
+from cloudify_aws.base import AwsBaseNode, AwsBaseRelationship, RouteMixin
 from cloudify import ctx
 from cloudify.decorators import operation
+from cloudify.exceptions import NonRecoverableError, RecoverableError
 
 
 @operation
 def creation_validation(**_):
-    if 'cloudify.aws.nodes.InternetGateway' in ctx.node.type_hierarchy:
+    if utils.is_of_type(ctx.node, 'cloudify.aws.nodes.InternetGateway'):
         return InternetGateway().creation_validation()
-    if 'cloudify.aws.nodes.VPNGateway' in ctx.node.type_hierarchy:
+    if utils.is_of_type(ctx.node, 'cloudify.aws.nodes.VPNGateway'):
         return VpnGateway().creation_validation()
-    if 'cloudify.aws.nodes.CustomerGateway' in ctx.node.type_hierarchy:
+    if utils.is_of_type(ctx.node, 'cloudify.aws.nodes.CustomerGateway'):
         return CustomerGateway().creation_validation()
 
 
@@ -94,7 +100,7 @@ def detach_gateway(args=None, **_):
     return GatewayVpcAttachment().disassociated(args)
 
 
-class VpnConnection(AwsBaseRelationship):
+class VpnConnection(AwsBaseRelationship, RouteMixin):
 
     def __init__(self, routes=None):
         super(VpnConnection, self).__init__(
@@ -115,27 +121,133 @@ class VpnConnection(AwsBaseRelationship):
             'argument':
             '{0}_ids'.format(constants.CUSTOMER_GATEWAY['AWS_RESOURCE_TYPE'])
         }
+        self.clients = [self.client]
 
     def associate(self, args):
-        associate_args = utils.update_args(
-            self.generate_associate_args(self.routes),
-            args)
-        vpn_connection = self.execute(self.client.create_vpn_connection,
-                                      associate_args, raise_on_falsy=True)
+        vpn_connection = self.get_vpn_connection()
+        if vpn_connection:
+            ctx.logger.info('Using the existing vpn connection {0}.'
+                            .format(vpn_connection.id))
+        else:
+            associate_args = utils.update_args(
+                self.generate_associate_args(self.routes),
+                args)
+            vpn_connection = self.execute(self.client.create_vpn_connection,
+                                          associate_args, raise_on_falsy=True)
         ctx.source.instance.runtime_properties['vpn_connection'] = \
             vpn_connection.id
         ctx.source.instance.runtime_properties['vpn_gateway'] = \
             vpn_connection.vpn_gateway_id
-        if 'routes' not in ctx.source.instance.runtime_properties.keys():
-            ctx.source.instance.runtime_properties['routes'] = []
-        if self.routes:
-            for route in self.routes:
-                args = self.generate_route_args(vpn_connection.id, route)
-                self.execute(self.client.create_vpn_connection_route,
-                             args, raise_on_falsy=True)
-                ctx.source.instance.runtime_properties['routes'].append(route)
+        self.update_routes(
+            vpn_connection,
+            self.aggregate_routes(self.routes) if self.routes else [])
         return True
 
+    def get_vpn_connection(self):
+        """Returns the vpn connection of the relationship if it was
+        already created and is not being deleted, otherwise None.
+        """
+
+        if not self.vpn_connection_id:
+            return None
+
+        vpn_connection = self.filter_for_single_resource(
+            self.client.get_all_vpn_connections,
+            dict(vpn_connection_ids=self.vpn_connection_id),
+            constants.VPN_CONNECTION['NOT_FOUND_ERROR'])
+
+        if not vpn_connection or vpn_connection.state in \
+                constants.VPN_CONNECTION['DELETED_STATES']:
+            return None
+
+        return vpn_connection
+
+    def update_routes(self, vpn_connection, routes):
+        """Makes the static routes of a vpn connection the given routes.
+
+        The routes of the connection are read once, and only the missing
+        routes are created and the extra routes deleted, concurrently.
+        The routes runtime property is written once, with the routes that
+        are in place, before the first failure is raised.
+        """
+
+        current = [route.destination_cidr_block
+                   for route in vpn_connection.static_routes or []
+                   if route.state not in
+                   constants.VPN_CONNECTION['DELETED_STATES']]
+        desired = OrderedDict(
+            (route['destination_cidr_block'], route) for route in routes)
+
+        to_create = [block for block in desired if block not in current]
+        to_delete = [block for block in current if block not in desired]
+
+        ctx.logger.info(
+            'Creating {0} and deleting {1} routes of vpn connection {2}.'
+            .format(len(to_create), len(to_delete), vpn_connection.id))
+
+        errors = self.call_for_routes(
+            'create_vpn_connection_route', vpn_connection.id, to_create)
+        errors.update(self.call_for_routes(
+            'delete_vpn_connection_route', vpn_connection.id, to_delete))
+
+        ctx.source.instance.runtime_properties['routes'] = \
+            [route for block, route in desired.items()
+             if block not in errors] + \
+            [dict(destination_cidr_block=block)
+             for block in to_delete if block in errors]
+
+        for block, error in errors.items():
+            ctx.logger.error('{0}: {1}'.format(block, str(error)))
+
+        if errors:
+            raise errors.values()[0]
+
+    def call_for_routes(self, fn, vpn_connection_id, destination_cidr_blocks):
+        """Calls a vpn connection route function of the client for every
+        block with a bounded pool of threads. boto connections are not
+        thread safe, so every worker has a client of its own.
+
+        :returns the errors by the blocks that failed.
+        """
+
+        errors = OrderedDict()
+
+        if not destination_cidr_blocks:
+            return errors
+
+        threads = min(len(destination_cidr_blocks),
+                      constants.VPN_CONNECTION['ROUTE_THREADS'])
+        # The workers have no ctx to build a client from
+        while len(self.clients) < threads:
+            self.clients.append(connection.VPCConnectionClient().client())
+        clients = Queue()
+        for client in self.clients[:threads]:
+            clients.put(client)
+
+        def call(block):
+            client = clients.get()
+            try:
+                self.execute(getattr(client, fn), self.generate_route_args(
+                    vpn_connection_id, dict(destination_cidr_block=block)),
+                    raise_on_falsy=True)
+            finally:
+                clients.put(client)
+
+        pool = ThreadPool(threads)
+        try:
+            results = [(block, pool.apply_async(call, (block,)))
+                       for block in destination_cidr_blocks]
+            for block, result in results:
+                try:
+                    result.get()
+                except Exception as e:
+                    errors[block] = e
+        finally:
+            pool.close()
+            pool.join()
+
+        return errors
+
     def generate_associate_args(self, routes):
 
         return dict(
@@ -154,14 +266,9 @@ class VpnConnection(AwsBaseRelationship):
         return args
 
     def disassociate(self, args):
-        if self.routes:
-            for route in self.routes:
-                args = self.generate_route_args(self.vpn_connection_id, route)
-                if self.execute(
-                        self.client.delete_vpn_connection_route,
-                        args, raise_on_falsy=True):
-                    ctx.source.instance.runtime_properties['routes'].remove(
-                        route)
+        vpn_connection = self.get_vpn_connection()
+        if vpn_connection:
+            self.update_routes(vpn_connection, [])
         disassociate_args = dict(vpn_connection_id=self.vpn_connection_id)
         disassociate_args = utils.update_args(disassociate_args, args)
         return self.execute(self.client.delete_vpn_connection,
@@ -190,6 +297,7 @@ class GatewayVpcAttachment(AwsBaseRelationship):
                 'argument':
                 '{0}_ids'.format(constants.VPN_GATEWAY['AWS_RESOURCE_TYPE'])
             }
+            self.not_found_error = constants.VPN_GATEWAY['NOT_FOUND_ERROR']
         else:
             self.attachment_function = self.client.attach_internet_gateway
             self.attachment_args = dict(
@@ -207,25 +315,83 @@ class GatewayVpcAttachment(AwsBaseRelationship):
                 '{0}_ids'.format(
                     constants.INTERNET_GATEWAY['AWS_RESOURCE_TYPE'])
             }
+            self.not_found_error = \
+                constants.INTERNET_GATEWAY['NOT_FOUND_ERROR']
 
     def associate(self, args):
-        attachment_args = utils.update_args(self.attachment_args, args)
-        return self.execute(self.attachment_function,
-                            attachment_args, raise_on_falsy=True)
+        # A retried operation waits for the attachment it already started
+        if self.get_attachment_state() == \
+                constants.GATEWAY_ATTACHMENT['DETACHED_STATE']:
+            attachment_args = utils.update_args(self.attachment_args, args)
+            self.execute(self.attachment_function,
+                         attachment_args, raise_on_falsy=True)
+        return self.wait_for_attachment_state(
+            constants.GATEWAY_ATTACHMENT['ATTACHED_STATES'])
 
     def disassociate(self, args):
-        detachment_args = utils.update_args(self.detachment_args, args)
-        return self.execute(self.detachment_function,
-                            detachment_args,
-                            raise_on_falsy=True)
+        if self.get_attachment_state() != \
+                constants.GATEWAY_ATTACHMENT['DETACHED_STATE']:
+            detachment_args = utils.update_args(self.detachment_args, args)
+            self.execute(self.detachment_function,
+                         detachment_args,
+                         raise_on_falsy=True)
+        return self.wait_for_attachment_state(
+            [constants.GATEWAY_ATTACHMENT['DETACHED_STATE']])
+
+    def get_attachment_state(self):
+        """Returns the state of the attachment of the gateway to the vpc,
+        which is detached if the gateway has no attachment to it.
+        """
+
+        gateway = self.filter_for_single_resource(
+            self.source_get_all_handler['function'],
+            {self.source_get_all_handler['argument']:
+                self.source_resource_id},
+            self.not_found_error)
+
+        if not gateway:
+            raise NonRecoverableError(
+                'Gateway {0} is not in this account.'
+                .format(self.source_resource_id))
+
+        for attachment in gateway.attachments:
+            if attachment.vpc_id == self.target_resource_id:
+                return attachment.state
+
+        return constants.GATEWAY_ATTACHMENT['DETACHED_STATE']
+
+    def wait_for_attachment_state(self, states):
+        """Waits for the attachment to reach one of the states, with one
+        describe call per poll, so that the routes through the gateway
+        and the deletion of the vpc do not race it.
+
+        The operation only waits a few seconds. A slower attachment is
+        left to operation retries, which do not hold the worker, and the
+        retried operation only waits for the change it already started.
+        """
+
+        state = utils.wait_for(
+            self.get_attachment_state, lambda state: state in states)
+
+        if not state:
+            raise RecoverableError(
+                'Gateway {0} did not become {1} in vpc {2} yet.'
+                .format(self.source_resource_id, ' or '.join(states),
+                        self.target_resource_id),
+                retry_after=constants.GATEWAY_ATTACHMENT['RETRY_INTERVAL'])
+
+        ctx.logger.debug('Gateway {0} is {1} in vpc {2}.'
+                         .format(self.source_resource_id, state,
+                                 self.target_resource_id))
+
+        return True
 
     def is_vpn_gateway(self):
-        if constants.VPN_GATEWAY['CLOUDIFY_NODE_TYPE'] in \
-                ctx.source.node.type_hierarchy \
-                and constants.CUSTOMER_GATEWAY['CLOUDIFY_NODE_TYPE'] \
-                not in ctx.source.node.type_hierarchy:
-            return True
-        return False
+        return utils.is_of_type(
+                ctx.source.node, constants.VPN_GATEWAY['CLOUDIFY_NODE_TYPE']) \
+            and not utils.is_of_type(
+                ctx.source.node,
+                constants.CUSTOMER_GATEWAY['CLOUDIFY_NODE_TYPE'])
 
     def post_associate(self):
         ctx.source.instance.runtime_properties['vpc_id'] = \
@@ -238,6 +404,8 @@ class GatewayVpcAttachment(AwsBaseRelationship):
 
 class InternetGateway(AwsBaseNode):
 
+    wait_for_visible = True
+
     def __init__(self):
         super(InternetGateway, self).__init__(
             constants.INTERNET_GATEWAY['AWS_RESOURCE_TYPE'],
@@ -0,0 +1,389 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+# Third-party Imports
+from boto import exception
+
+# Cloudify imports
+from cloudify_aws import cidr, constants, connection, utils
+from cloudify_aws.base import AwsBase
+from cloudify import ctx
+from cloudify.decorators import operation
+from cloudify.exceptions import NonRecoverableError, RecoverableError
+
+
+@operation
+def create_network_stack(**_):
+    return NetworkStack().created()
+
+
+@operation
+def delete_network_stack(**_):
+    return NetworkStack().deleted()
+
+
+class NetworkStack(AwsBase):
+    """The subnets, internet gateway, route tables and network ACLs of a
+    VPC, managed by a single node.
+
+    The VPC is described once, and the resources that do not depend on
+    each other are created and deleted concurrently. The ids are saved
+    to the runtime properties in a single write once the whole stack is
+    up. Tasks run in worker threads, where ctx is not available, so they
+    only call the client they are given. boto connections are not thread
+    safe, so every worker has its own.
+    """
+
+    def __init__(self, client=None, get_client=None):
+        self.get_client = get_client or \
+            (lambda: connection.VPCConnectionClient().client())
+        super(NetworkStack, self).__init__(
+            client=client or self.get_client()
+        )
+        self.clients = [self.client]
+
+    def created(self):
+
+        vpc = self.get_containing_vpc()
+        created = dict(vpc_id=vpc.id, internet_gateway_id=None,
+                       subnet_ids={}, route_table_ids={},
+                       network_acl_ids={})
+
+        ctx.logger.info('Creating the network stack of {0}.'.format(vpc.id))
+
+        try:
+            self.run(self.get_create_tasks(vpc, created))
+            self.run(self.get_connect_tasks(created))
+        except Exception:
+            ctx.logger.info('Removing the partially created network stack.')
+            try:
+                self.delete_resources(created)
+            except Exception as e:
+                ctx.logger.error(
+                    'Unable to remove the network stack: {0}'.format(str(e)))
+            raise
+
+        ctx.instance.runtime_properties.update(created)
+
+        ctx.logger.info(
+            'Created {0} subnets, {1} route tables and {2} network acls '
+            'in {3}.'.format(len(created['subnet_ids']),
+                             len(created['route_table_ids']),
+                             len(created['network_acl_ids']),
+                             vpc.id))
+
+        return True
+
+    def deleted(self):
+
+        resources = dict(
+            (name, ctx.instance.runtime_properties.get(name))
+            for name in constants.NETWORK_STACK['RUNTIME_PROPERTIES'])
+
+        ctx.logger.info('Deleting the network stack of {0}.'
+                        .format(resources['vpc_id']))
+
+        try:
+            in_use = self.delete_resources(resources)
+        finally:
+            # Only what is left is deleted again when the operation is
+            # retried
+            ctx.instance.runtime_properties.update(resources)
+
+        if in_use:
+            return ctx.operation.retry(
+                message='Network stack resources are still in use: {0}.'
+                .format(', '.join(in_use)),
+                retry_after=constants.DELETE_RETRY_INTERVAL)
+
+        utils.unassign_runtime_properties_from_resource(
+            constants.NETWORK_STACK['RUNTIME_PROPERTIES'], ctx.instance)
+
+        return True
+
+    def get_containing_vpc(self):
+
+        vpc_ids = utils.get_target_external_resource_ids(
+            constants.NETWORK_STACK_VPC_RELATIONSHIP, ctx.instance)
+
+        if not len(vpc_ids) == 1:
+            raise NonRecoverableError(
+                'network stack can only be contained in one vpc')
+
+        vpc = self.filter_for_single_resource(
+            self.client.get_all_vpcs,
+            {'vpc_ids': vpc_ids[0]},
+            constants.VPC['NOT_FOUND_ERROR']
+        )
+
+        if not vpc:
+            raise NonRecoverableError(
+                'vpc {0} is not in this account'.format(vpc_ids[0]))
+
+        return vpc
+
+    def get_create_tasks(self, vpc, created):
+
+        tasks = []
+
+        def create(resource_type, name, fn, args):
+            def task(client):
+                resource = self.execute(
+                    getattr(client, fn), args, raise_on_falsy=True)
+                if name is None:
+                    created[resource_type] = resource.id
+                else:
+                    created[resource_type][name] = resource.id
+            tasks.append(task)
+
+        for name, cidr_block, zone in self.get_subnets(vpc):
+            args = dict(vpc_id=vpc.id, cidr_block=cidr_block)
+            if zone:
+                args[constants.AVAILABILITY_ZONE] = zone
+            create('subnet_ids', name, 'create_subnet', args)
+
+        if ctx.node.properties['internet_gateway']:
+            create('internet_gateway_id', None,
+                   'create_internet_gateway', None)
+
+        for route_table in ctx.node.properties['route_tables']:
+            create('route_table_ids', route_table['name'],
+                   'create_route_table', dict(vpc_id=vpc.id))
+
+        for network_acl in ctx.node.properties['network_acls']:
+            create('network_acl_ids', network_acl['name'],
+                   'create_network_acl', dict(vpc_id=vpc.id))
+
+        return tasks
+
+    def get_subnets(self, vpc):
+        """Returns the name, CIDR block and availability zone of every
+        subnet of the stack. Subnets with a cidr_prefix instead of a
+        cidr_block get the first free block of the VPC.
+        """
+
+        subnets = ctx.node.properties['subnets']
+        allocator = None
+
+        if [subnet for subnet in subnets if not subnet.get('cidr_block')]:
+            used = [subnet.cidr_block for subnet in self.execute(
+                self.client.get_all_subnets,
+                dict(filters={'vpc-id': vpc.id}))]
+            used.extend(subnet['cidr_block'] for subnet in subnets
+                        if subnet.get('cidr_block'))
+            try:
+                allocator = cidr.CidrAllocator(vpc.cidr_block, used)
+            except ValueError as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
+
+        result = []
+
+        for subnet in subnets:
+            cidr_block = subnet.get('cidr_block')
+            if not cidr_block:
+                try:
+                    cidr_block = allocator.allocate(
+                        int(subnet.get(
+                            constants.SUBNET['CIDR_PREFIX_PROPERTY'], 0)))
+                except ValueError as e:
+                    raise NonRecoverableError(
+                        'subnet {0}: {1}'.format(subnet['name'], str(e)))
+                if not cidr_block:
+                    raise NonRecoverableError(
+                        'Unable to allocate a block for subnet {0} in {1}'
+                        .format(subnet['name'], vpc.id))
+            result.append((subnet['name'], cidr_block,
+                           subnet.get(constants.AVAILABILITY_ZONE)))
+
+        return result
+
+    def get_connect_tasks(self, created):
+
+        tasks = []
+        subnet_ids = created['subnet_ids']
+        gateway_id = created['internet_gateway_id']
+
+        def call(fn, **args):
+            tasks.append(lambda client: self.execute(
+                getattr(client, fn), args, raise_on_falsy=True))
+
+        def get_subnet_id(name):
+            if name not in subnet_ids:
+                raise NonRecoverableError(
+                    'network stack has no subnet named {0}'.format(name))
+            return subnet_ids[name]
+
+        if gateway_id:
+            call('attach_internet_gateway',
+                 internet_gateway_id=gateway_id, vpc_id=created['vpc_id'])
+
+        for route_table in ctx.node.properties['route_tables']:
+            route_table_id = created['route_table_ids'][route_table['name']]
+            routes = list(route_table.get('routes', []))
+            if route_table.get('internet_gateway'):
+                if not gateway_id:
+                    raise NonRecoverableError(
+                        'route table {0} routes to the internet gateway, '
+                        'but the network stack has none'
+                        .format(route_table['name']))
+                routes.append(dict(destination_cidr_block='0.0.0.0/0',
+                                   gateway_id=gateway_id))
+            for route in routes:
+                route = dict(route, route_table_id=route_table_id)
+                call('create_route', **route)
+            for name in route_table.get('subnets', []):
+                call('associate_route_table',
+                     route_table_id=route_table_id,
+                     subnet_id=get_subnet_id(name))
+
+        for network_acl in ctx.node.properties['network_acls']:
+            network_acl_id = \
+                created['network_acl_ids'][network_acl['name']]
+            for entry in network_acl.get('acl_network_entries', []):
+                entry = dict(entry, network_acl_id=network_acl_id)
+                call('create_network_acl_entry', **entry)
+            for name in network_acl.get('subnets', []):
+                call('associate_network_acl',
+                     network_acl_id=network_acl_id,
+                     subnet_id=get_subnet_id(name))
+
+        return tasks
+
+    def delete_resources(self, resources):
+        """Deletes the resources of a stack, removing them from the dict as
+        they are deleted.
+
+        :returns the ids of the resources that are still in use.
+        """
+
+        in_use = []
+        vpc_id = resources.get('vpc_id')
+
+        def delete(resource_type, name, fn, **args):
+            def task(client):
+                try:
+                    getattr(client, fn)(**args)
+                except exception.EC2ResponseError as e:
+                    if constants.NETWORK_STACK['DEPENDENCY_VIOLATION'] \
+                            in str(e):
+                        in_use.append(args.values()[0])
+                        return
+                    if 'NotFound' not in str(e):
+                        raise NonRecoverableError('{0}'.format(str(e)))
+                except exception.BotoServerError as e:
+                    raise NonRecoverableError('{0}'.format(str(e)))
+                if name is None:
+                    resources[resource_type] = None
+                else:
+                    del resources[resource_type][name]
+            return task
+
+        def delete_gateway(gateway_id):
+            remove = delete('internet_gateway_id', None,
+                            'delete_internet_gateway',
+                            internet_gateway_id=gateway_id)
+
+            def task(client):
+                # A gateway that is not attached fails to detach with
+                # Gateway.NotAttached, which is the state we want. While
+                # the VPC still has mapped public addresses it fails with
+                # DependencyViolation, and the delete is retried.
+                try:
+                    client.detach_internet_gateway(
+                        internet_gateway_id=gateway_id, vpc_id=vpc_id)
+                except exception.EC2ResponseError as e:
+                    if constants.NETWORK_STACK['DEPENDENCY_VIOLATION'] \
+                            in str(e):
+                        raise RecoverableError(
+                            'Internet gateway {0} is still in use: {1}'
+                            .format(gateway_id, str(e)),
+                            retry_after=constants.DELETE_RETRY_INTERVAL)
+                    if 'NotAttached' not in str(e) and \
+                            'NotFound' not in str(e):
+                        raise NonRecoverableError('{0}'.format(str(e)))
+                except exception.BotoServerError as e:
+                    raise NonRecoverableError('{0}'.format(str(e)))
+                remove(client)
+            return task
+
+        # Deleting the subnets removes their route table and network acl
+        # associations, after that the tables and acls can go
+        tasks = [delete('subnet_ids', name, 'delete_subnet',
+                        subnet_id=subnet_id)
+                 for name, subnet_id
+                 in (resources.get('subnet_ids') or {}).items()]
+        if resources.get('internet_gateway_id'):
+            tasks.append(delete_gateway(resources['internet_gateway_id']))
+        self.run(tasks)
+
+        tasks = [delete('route_table_ids', name, 'delete_route_table',
+                        route_table_id=route_table_id)
+                 for name, route_table_id
+                 in (resources.get('route_table_ids') or {}).items()]
+        tasks.extend(delete('network_acl_ids', name, 'delete_network_acl',
+                            network_acl_id=network_acl_id)
+                     for name, network_acl_id
+                     in (resources.get('network_acl_ids') or {}).items())
+        self.run(tasks)
+
+        return in_use
+
+    def run(self, tasks):
+        """Runs tasks concurrently, each with a client of its own worker.
+        Every task runs even if another one fails, and the first failure
+        is raised once all are done.
+        """
+
+        if not tasks:
+            return
+
+        threads = min(len(tasks), constants.NETWORK_STACK['THREADS'])
+        # Clients are created here, the workers have no ctx to read the
+        # aws configuration from
+        while len(self.clients) < threads:
+            self.clients.append(self.get_client())
+        clients = Queue()
+        for client in self.clients[:threads]:
+            clients.put(client)
+
+        def run_task(task):
+            client = clients.get()
+            try:
+                task(client)
+            finally:
+                clients.put(client)
+
+        pool = ThreadPool(threads)
+        try:
+            results = [pool.apply_async(run_task, (task,)) for task in tasks]
+            errors = []
+            for result in results:
+                try:
+                    result.get()
+                except Exception as e:
+                    errors.append(e)
+        finally:
+            pool.close()
+            pool.join()
+
+        for error in errors:
+            ctx.logger.error('{0}'.format(str(error)))
+
+        if errors:
+            raise errors[0]
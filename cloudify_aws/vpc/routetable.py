@@ -152,6 +152,8 @@ class RouteTableSubnetAssociation(AwsBaseRelationship):
 
 class RouteTable(AwsBaseNode, RouteMixin):
 
+    wait_for_visible = True
+
     def __init__(self, routes=None):
         super(RouteTable, self).__init__(
             constants.ROUTE_TABLE['AWS_RESOURCE_TYPE'],
@@ -165,7 +167,7 @@ class RouteTable(AwsBaseNode, RouteMixin):
             '{0}_ids'.format(constants.ROUTE_TABLE['AWS_RESOURCE_TYPE'])
         }
         self.routes = \
-            ctx.instance.runtime_properties.get('routes') \
+            utils.decode_routes(ctx.instance.runtime_properties['routes']) \
             if 'routes' \
             in ctx.instance.runtime_properties.keys() else routes
 
@@ -203,7 +205,8 @@ class RouteTable(AwsBaseNode, RouteMixin):
     def post_create(self):
         vpc = self.get_containing_vpc()
         ctx.instance.runtime_properties['vpc_id'] = vpc.id
-        ctx.instance.runtime_properties['routes'] = self.routes
+        ctx.instance.runtime_properties['routes'] = \
+            utils.encode_routes(self.routes)
         utils.set_external_resource_id(self.resource_id, ctx.instance)
         ctx.logger.info(
             'Added {0} {1} to Cloudify.'
@@ -13,8 +13,14 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+# Built-in Imports
+import time
+
+# Third-party Imports
+from boto import exception
+
 # Cloudify imports
-from cloudify_aws import constants, connection, utils
+from cloudify_aws import cidr, constants, connection, utils
 from cloudify_aws.base import AwsBaseNode
 from cloudify_aws.utils import set_external_resource_id
 from cloudify import ctx
@@ -44,6 +50,8 @@ def delete_subnet(args=None, **_):
 
 class Subnet(AwsBaseNode):
 
+    wait_for_visible = True
+
     def __init__(self):
         super(Subnet, self).__init__(
             constants.SUBNET['AWS_RESOURCE_TYPE'],
@@ -55,6 +63,7 @@ class Subnet(AwsBaseNode):
             'function': self.client.get_all_subnets,
             'argument': '{0}_ids'.format(constants.SUBNET['AWS_RESOURCE_TYPE'])
         }
+        self.vpc_cidr_block = None
 
     def create(self, args=None):
         '''Override for resource create operation'''
@@ -62,17 +71,22 @@ class Subnet(AwsBaseNode):
             # Create the resource
             create_args = utils.update_args(
                 self._generate_creation_args(), args)
-            subnet = self.execute(self.client.create_subnet,
-                                  create_args, raise_on_falsy=True)
+            if create_args['cidr_block']:
+                subnet = self.execute(self.client.create_subnet,
+                                      create_args, raise_on_falsy=True)
+            else:
+                subnet = self._create_with_allocated_cidr(create_args)
             self.resource_id = subnet.id
         else:
             # Get the resource object
             subnet = self.get_resource()
-        # If the operation is still pending, set the ID and retry
+        # If the subnet is still pending, wait for it a moment, then
+        # set the ID and retry
         if hasattr(subnet, 'state'):
             ctx.logger.debug('AWS resource {0} returned a state of "{1}"'
                              .format(self.resource_id, subnet.state))
-            if subnet.state == 'pending':
+            if subnet.state == 'pending' and not utils.wait_for(
+                    self.get_resource, self._is_settled):
                 set_external_resource_id(self.resource_id, ctx.instance)
                 return ctx.operation.retry(
                     message='Waiting to verify that AWS resource {0} '
@@ -84,6 +98,10 @@ class Subnet(AwsBaseNode):
             return False
         return True
 
+    @staticmethod
+    def _is_settled(subnet):
+        return subnet is not None and subnet.state != 'pending'
+
     def _generate_creation_args(self):
 
         relationships = \
@@ -107,6 +125,13 @@ class Subnet(AwsBaseNode):
             cidr_block=ctx.node.properties['cidr_block']
         )
 
+        if not create_args['cidr_block']:
+            self.vpc_cidr_block = vpc.cidr_block
+            if not ctx.node.properties.get(
+                    constants.SUBNET['CIDR_PREFIX_PROPERTY']):
+                raise NonRecoverableError(
+                    'subnet requires either a cidr_block or a cidr_prefix')
+
         if ctx.node.properties[constants.AVAILABILITY_ZONE]:
             create_args.update(
                 {
@@ -117,6 +142,122 @@ class Subnet(AwsBaseNode):
 
         return create_args
 
+    def _create_with_allocated_cidr(self, create_args):
+        """Creates the subnet in the first free block of the VPC with the
+        cidr_prefix length. Without an availability_zone, the subnets are
+        spread over the zones of the region in turn.
+
+        The block is claimed with a tag on the VPC before the subnet is
+        created, so that concurrent operations pick different blocks. The
+        claim is not atomic: two operations that write it at the same time
+        may both read their own claim back. Then both create the subnet,
+        and the one that loses gets InvalidSubnet.Conflict and moves on
+        to the next block.
+        """
+
+        vpc_id = create_args['vpc_id']
+        prefix = int(ctx.node.properties[
+            constants.SUBNET['CIDR_PREFIX_PROPERTY']])
+        owner = '{0}:{1}'.format(ctx.deployment.id, ctx.instance.id)
+
+        subnets = self.execute(self.client.get_all_subnets,
+                               dict(filters={'vpc-id': vpc_id}))
+        claims = self._get_cidr_claims(vpc_id)
+
+        try:
+            allocator = cidr.CidrAllocator(
+                self.vpc_cidr_block,
+                [subnet.cidr_block for subnet in subnets] + claims.keys())
+        except ValueError as e:
+            raise NonRecoverableError('{0}'.format(str(e)))
+
+        if constants.AVAILABILITY_ZONE not in create_args:
+            zones = sorted(zone.name for zone in self.execute(
+                self.client.get_all_zones,
+                dict(filters={'state': 'available'})))
+            if zones:
+                create_args[constants.AVAILABILITY_ZONE] = \
+                    zones[(len(subnets) + len(claims)) % len(zones)]
+
+        for _ in range(constants.SUBNET['ALLOCATION_ATTEMPTS']):
+            try:
+                cidr_block = allocator.allocate(prefix)
+            except ValueError as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
+            if not cidr_block:
+                break
+            claim = self._claim_cidr(vpc_id, cidr_block, owner)
+            if not claim:
+                continue
+            create_args['cidr_block'] = cidr_block
+            try:
+                subnet = self.client.create_subnet(**create_args)
+            except exception.EC2ResponseError as e:
+                # Another operation claimed the block at the same time
+                if constants.SUBNET['CONFLICT_ERROR'] in str(e):
+                    continue
+                raise NonRecoverableError('{0}'.format(str(e)))
+            except exception.BotoServerError as e:
+                raise NonRecoverableError('{0}'.format(str(e)))
+            finally:
+                self._release_cidr(vpc_id, cidr_block, claim)
+            ctx.logger.info('Allocated {0} in {1} for subnet {2}.'
+                            .format(cidr_block, vpc_id, subnet.id))
+            ctx.instance.runtime_properties['cidr_block'] = cidr_block
+            return subnet
+
+        raise NonRecoverableError(
+            'Unable to allocate a free /{0} block in vpc {1}'
+            .format(prefix, vpc_id))
+
+    def _get_cidr_claims(self, vpc_id):
+        """Returns the blocks of a VPC that are claimed by operations that
+        are creating subnets, by the time they were claimed at.
+        """
+
+        claim_prefix = constants.SUBNET['CLAIM_TAG_PREFIX']
+        tags = self.execute(self.client.get_all_tags,
+                            dict(filters={'resource-id': vpc_id}))
+        now = time.time()
+        claims = {}
+
+        for tag in tags:
+            if not tag.name.startswith(claim_prefix):
+                continue
+            try:
+                claimed_at = float(tag.value.rpartition('@')[2])
+            except ValueError:
+                continue
+            # The claims of operations that died are ignored after a while
+            if now - claimed_at < constants.SUBNET['CLAIM_EXPIRY']:
+                claims[tag.name[len(claim_prefix):]] = claimed_at
+
+        return claims
+
+    def _claim_cidr(self, vpc_id, cidr_block, owner):
+        """Tags a block of a VPC as claimed by owner.
+
+        :returns the value of the claim, or None if another operation
+        claimed the block since.
+        """
+
+        key = constants.SUBNET['CLAIM_TAG_PREFIX'] + cidr_block
+        value = '{0}@{1}'.format(owner, time.time())
+
+        self.execute(self.client.create_tags,
+                     dict(resource_ids=[vpc_id], tags={key: value}))
+
+        tags = self.execute(self.client.get_all_tags, dict(
+            filters={'resource-id': vpc_id, 'key': key}))
+
+        return value if tags and tags[0].value == value else None
+
+    def _release_cidr(self, vpc_id, cidr_block, claim):
+        # Only this claim is deleted, not one that replaced it
+        key = constants.SUBNET['CLAIM_TAG_PREFIX'] + cidr_block
+        self.execute(self.client.delete_tags,
+                     dict(resource_ids=[vpc_id], tags={key: claim}))
+
     def start(self, args):
         return True
 
@@ -125,3 +266,8 @@ class Subnet(AwsBaseNode):
         delete_args = utils.update_args(delete_args, args)
         return self.execute(self.client.delete_subnet,
                             delete_args, raise_on_falsy=True)
+
+    def post_delete(self):
+        utils.unassign_runtime_property_from_resource(
+            'cidr_block', ctx.instance)
+        return super(Subnet, self).post_delete()
@@ -14,22 +14,33 @@
 #    * limitations under the License.
 
 # Built-in Imports
+import itertools
 import mock
+import socket
+import testtools
+import threading
+import time
 
 # Third-party Imports
+from boto.exception import EC2ResponseError
 from moto import mock_ec2
 
 # Cloudify Imports
-from cloudify_aws import constants
-from cloudify_aws.vpc import vpc, subnet, routetable, dhcp
+from cloudify_aws import cidr, constants, workflows
+from cloudify_aws.vpc import (
+    vpc, subnet, routetable, dhcp, networkstack, gateway)
 from vpc_testcase import VpcTestCase
 from cloudify.state import current_ctx
-from cloudify.exceptions import NonRecoverableError
+from cloudify.mocks import (
+    MockCloudifyContext, MockContext, MockNodeInstanceContext,
+    MockRelationshipContext)
+from cloudify.exceptions import NonRecoverableError, RecoverableError
 
 VPC_TYPE = 'cloudify.aws.nodes.VPC'
 SUBNET_TYPE = 'cloudify.aws.nodes.Subnet'
 DHCP_OPTIONS_TYPE = 'cloudify.aws.nodes.DHCPOptions'
 ROUTE_TABLE_TYPE = 'cloudify.aws.nodes.RouteTable'
+NETWORK_STACK_TYPE = 'cloudify.aws.nodes.NetworkStack'
 TEST_VPC_CIDR = '10.10.10.0/16'
 TEST_SUBNET_CIDR = '10.10.10.0/24'
 
@@ -154,6 +165,121 @@ class TestSubnetModule(VpcTestCase):
         self.assertEquals(subnet_object.tags.get('deployment_id'),
                           ctx.deployment.id)
 
+    @mock.patch('cloudify_aws.utils.time.sleep')
+    def test_create_pending_subnet(self, sleep):
+        ctx = self.get_mock_subnet_node_instance_context(
+            'test_create_pending_subnet')
+        ctx.operation._operation_context['retry_number'] = 1
+        ctx.instance.runtime_properties['aws_resource_id'] = 'subnet-0123abcd'
+        pending = mock.Mock(id='subnet-0123abcd', state='pending')
+        available = mock.Mock(id='subnet-0123abcd', state='available')
+        with mock.patch('cloudify_aws.vpc.subnet.Subnet.get_resource',
+                        side_effect=[pending, pending, available]):
+            self.assertTrue(subnet.create_subnet(args=None, ctx=ctx))
+        sleep.assert_called_once_with(constants.READY_WAIT_MIN_INTERVAL)
+
+        with mock.patch('cloudify_aws.vpc.subnet.Subnet.get_resource',
+                        return_value=pending), \
+                mock.patch.object(constants, 'READY_WAIT_TIMEOUT', 0), \
+                mock.patch.object(ctx.operation, 'retry') as retry:
+            subnet.create_subnet(args=None, ctx=ctx)
+        self.assertTrue(retry.called)
+
+    @mock.patch('cloudify_aws.utils.wait_for', return_value=None)
+    def test_post_start_waits_for_visible_subnet(self, wait_for):
+        ctx = self.get_mock_subnet_node_instance_context(
+            'test_post_start_waits_for_visible_subnet')
+        ctx.instance.runtime_properties['aws_resource_id'] = 'subnet-0123abcd'
+        with mock.patch.object(ctx.operation, 'retry') as retry:
+            subnet.Subnet().post_start()
+        self.assertTrue(wait_for.called)
+        self.assertTrue(retry.called)
+
+        # Other nodes are not waited for
+        self.assertFalse(vpc.Vpc.wait_for_visible)
+        with mock.patch.object(subnet.Subnet, 'wait_for_visible', False), \
+                mock.patch('cloudify_aws.vpc.subnet.Subnet.get_resource') \
+                as get_resource:
+            self.assertTrue(subnet.Subnet().post_start())
+        get_resource.assert_called_once_with()
+        self.assertEqual(1, wait_for.call_count)
+
+    @mock_ec2
+    def test_create_allocated_cidr(self):
+        vpc_client = self.create_client()
+        existing_vpc = vpc_client.create_vpc(TEST_VPC_CIDR)
+        vpc_client.create_subnet(existing_vpc.id, '10.10.0.0/24')
+        cidr_blocks = []
+        zones = set()
+        for index in range(2):
+            ctx = self.get_mock_subnet_node_instance_context(
+                'test_create_allocated_cidr_{0}'.format(index),
+                {'cidr_block': ''})
+            ctx.node.properties['cidr_prefix'] = 24
+            ctx.operation._operation_context['retry_number'] = 0
+            with mock.patch(
+                    'cloudify_aws.base.AwsBase'
+                    '.get_target_ids_of_relationship_type',
+                    return_value=[existing_vpc.id]):
+                subnet.create_subnet(args=None, ctx=ctx)
+            cidr_blocks.append(ctx.instance.runtime_properties['cidr_block'])
+            zones.add(vpc_client.get_all_subnets(
+                ctx.instance.runtime_properties['aws_resource_id'])[0]
+                .availability_zone)
+        self.assertEqual(['10.10.1.0/24', '10.10.2.0/24'], cidr_blocks)
+        self.assertEqual(2, len(zones))
+        self.assertFalse([tag for tag in vpc_client.get_all_tags(
+            filters={'resource-id': existing_vpc.id})
+            if tag.name.startswith('cloudify-cidr-claim:')])
+
+        subnet.delete_subnet(args=None, ctx=ctx)
+        self.assertNotIn('cidr_block', ctx.instance.runtime_properties)
+
+    @mock_ec2
+    def test_release_cidr_keeps_other_claims(self):
+        vpc_client = self.create_client()
+        existing_vpc = vpc_client.create_vpc(TEST_VPC_CIDR)
+        self.get_mock_subnet_node_instance_context(
+            'test_release_cidr_keeps_other_claims', {'cidr_block': ''})
+        subnet_node = subnet.Subnet()
+        claim = subnet_node._claim_cidr(
+            existing_vpc.id, '10.10.1.0/24', 'owner')
+        key = constants.SUBNET['CLAIM_TAG_PREFIX'] + '10.10.1.0/24'
+        # Another operation replaced the claim
+        vpc_client.create_tags([existing_vpc.id], {key: 'other@0'})
+
+        subnet_node._release_cidr(existing_vpc.id, '10.10.1.0/24', claim)
+
+        self.assertEqual(['other@0'], [tag.value for tag in vpc_client
+                                       .get_all_tags(filters={'key': key})])
+
+
+class TestCidr(testtools.TestCase):
+
+    def test_allocate(self):
+        allocator = cidr.CidrAllocator(
+            '10.0.0.0/16', ['10.0.0.0/24', '10.0.2.0/23', '10.0.1.128/25'])
+        self.assertEqual('10.0.4.0/24', allocator.allocate(24))
+        self.assertEqual('10.0.1.0/25', allocator.allocate(25))
+        self.assertEqual('10.0.6.0/23', allocator.allocate(23))
+        self.assertFalse(allocator.is_free('10.0.1.0/25'))
+        self.assertTrue(allocator.is_free('10.0.8.0/24'))
+
+    def test_allocate_full(self):
+        allocator = cidr.CidrAllocator('10.0.0.0/24')
+        self.assertEqual(
+            ['10.0.0.0/26', '10.0.0.64/26', '10.0.0.128/26',
+             '10.0.0.192/26', None],
+            [allocator.allocate(26) for _ in range(5)])
+        self.assertRaises(ValueError, allocator.allocate, 16)
+
+    def test_parse_cidr(self):
+        self.assertEqual('10.10.0.0/16',
+                         cidr.format_cidr(*cidr.parse_cidr('10.10.10.0/16')))
+        self.assertRaises(ValueError, cidr.parse_cidr, '10.0.0/16')
+        self.assertTrue(cidr.overlaps('10.0.0.0/16', '10.0.3.0/24'))
+        self.assertFalse(cidr.overlaps('10.0.0.0/24', '10.0.1.0/24'))
+
 
 class TestRouteTableModule(VpcTestCase):
 
@@ -232,6 +358,72 @@ class TestRouteTableModule(VpcTestCase):
         self.assertNotIn(ctx.instance.runtime_properties,
                          constants.EXTERNAL_RESOURCE_ID)
 
+    @mock_ec2
+    def test_routes_runtime_property(self, *_):
+        client = self.create_client()
+        vpc = self.create_vpc(client)
+        route_table = self.create_route_table(client, vpc)
+        ctx = \
+            self.get_mock_route_table_node_instance_context(
+                'test_routes_runtime_property', vpc)
+        gateway = client.create_internet_gateway()
+        # Written by older versions of the plugin
+        ctx.instance.runtime_properties['routes'] = [
+            dict(route_table_id=route_table.id,
+                 destination_cidr_block='10.1.0.0/24',
+                 gateway_id=gateway.id)]
+        route = dict(destination_cidr_block='10.2.0.0/24',
+                     gateway_id=gateway.id)
+        route_table_node = routetable.RouteTable()
+
+        route_table_node.create_route(route_table.id, route, ctx.instance)
+
+        self.assertEqual(
+            {'10.1.0.0/24': {'gateway_id': gateway.id},
+             '10.2.0.0/24': {'gateway_id': gateway.id}},
+            ctx.instance.runtime_properties['routes'])
+
+        route_table_node.delete_route(route_table.id, route, ctx.instance)
+
+        self.assertEqual(
+            [dict(destination_cidr_block='10.1.0.0/24',
+                  gateway_id=gateway.id)],
+            routetable.utils.decode_routes(
+                ctx.instance.runtime_properties['routes']))
+
+    @mock_ec2
+    def test_aggregate_routes(self, *_):
+        client = self.create_client()
+        vpc = self.create_vpc(client)
+        route_table = self.create_route_table(client, vpc)
+        ctx = \
+            self.get_mock_route_table_node_instance_context(
+                'test_aggregate_routes', vpc)
+        gateway = client.create_internet_gateway()
+        client.create_route(route_table_id=route_table.id,
+                            destination_cidr_block='10.2.0.0/24',
+                            gateway_id=gateway.id)
+        ctx.instance.runtime_properties['routes'] = []
+
+        routes = [
+            dict(destination_cidr_block=block,
+                 vpc_peering_connection_id='pcx-0123abcd')
+            for block in ['10.1.0.0/25', '10.1.0.128/25',
+                          '10.2.0.0/25', '10.2.0.128/25']]
+        routes.append(dict(destination_cidr_block='10.1.1.0/24',
+                           gateway_id=gateway.id))
+
+        aggregated = routetable.RouteTable().aggregate_routes(
+            routes, route_table.id)
+
+        # The 10.2.0.0/24 route to the gateway keeps the /25 blocks
+        self.assertEqual(
+            ['10.1.0.0/24', '10.2.0.0/25', '10.2.0.128/25', '10.1.1.0/24'],
+            [route['destination_cidr_block'] for route in aggregated])
+        self.assertEqual(gateway.id, aggregated[-1]['gateway_id'])
+        self.assertEqual(3, len(routetable.RouteTable().aggregate_routes(
+            routes)))
+
 
 class TestDhcpModule(VpcTestCase):
 
@@ -250,6 +442,34 @@ class TestDhcpModule(VpcTestCase):
 
         return node_context
 
+    @mock_ec2
+    def test_vpc_with_dhcp_options_has_no_drift(self, *_):
+        vpc_client = self.create_client()
+        existing_vpc = self.create_vpc(vpc_client)
+        default_dhcp_options_id = existing_vpc.dhcp_options_id
+        dhcp_options = vpc_client.create_dhcp_options()
+        vpc_client.associate_dhcp_options(dhcp_options.id, existing_vpc.id)
+        runtime_properties = {
+            constants.EXTERNAL_RESOURCE_ID: existing_vpc.id,
+            'default_dhcp_options_id': default_dhcp_options_id}
+        instance = mock.Mock(
+            node=mock.Mock(type_hierarchy=['cloudify.nodes.Root', VPC_TYPE],
+                           properties={}),
+            relationships=[mock.Mock(
+                type=constants.DHCP_VPC_RELATIONSHIP,
+                target_id='dhcp_options')],
+            _node_instance=mock.Mock(runtime_properties=runtime_properties))
+        spec = workflows.DRIFT_RESOURCES[
+            workflows.get_drift_node_type(instance)]
+
+        resources = workflows.describe_resources(spec, {})
+
+        self.assertIsNone(workflows.get_drift(
+            instance, spec, resources[existing_vpc.id]))
+        self.assertEqual(
+            default_dhcp_options_id,
+            runtime_properties['default_dhcp_options_id'])
+
     @mock_ec2
     def test_start_dhcp_options(self, *_):
 
@@ -285,3 +505,656 @@ class TestDhcpModule(VpcTestCase):
         error = self.assertRaises(
             NonRecoverableError, dhcp.delete_dhcp_options, ctx=ctx)
         self.assertIn('returned False', error.message)
+
+    @mock_ec2
+    def test_reuse_dhcp_options(self):
+        client = self.create_client()
+        contexts = []
+        for index, servers in enumerate([['10.0.0.2', '10.0.0.3'],
+                                         ['10.0.0.3', '10.0.0.2']]):
+            ctx = self.get_mock_dhcp_node_instance_context(
+                'test_reuse_dhcp_options_{0}'.format(index))
+            ctx.node.properties.update(
+                self.dhcp_options_node_template_properties(
+                    {'domain_name': 'Example.com',
+                     'domain_name_servers': servers}))
+            ctx.node.properties['reuse'] = True
+            dhcp.create_dhcp_options(ctx=ctx)
+            contexts.append(ctx)
+
+        dhcp_options_ids = set(
+            ctx.instance.runtime_properties[constants.EXTERNAL_RESOURCE_ID]
+            for ctx in contexts)
+        self.assertEqual(1, len(dhcp_options_ids))
+        self.assertEqual(1, len(client.get_all_dhcp_options()))
+
+        current_ctx.set(ctx=contexts[0])
+        dhcp.delete_dhcp_options(ctx=contexts[0])
+        self.assertEqual(1, len(client.get_all_dhcp_options()))
+        current_ctx.set(ctx=contexts[1])
+        # moto does not report the deletion as successful
+        with mock.patch('boto.vpc.VPCConnection.delete_dhcp_options',
+                        return_value=True) as delete_dhcp_options:
+            dhcp.delete_dhcp_options(ctx=contexts[1])
+        delete_dhcp_options.assert_called_once_with(
+            dhcp_options_id=dhcp_options_ids.pop())
+
+    @mock_ec2
+    def test_reuse_dhcp_options_retried_while_vpc_associated(self):
+        client = self.create_client()
+        ctx = self.get_mock_dhcp_node_instance_context(
+            'test_reuse_dhcp_options_retried_while_vpc_associated')
+        ctx.node.properties.update(
+            self.dhcp_options_node_template_properties(
+                {'domain_name': 'example.com'}))
+        ctx.node.properties['reuse'] = True
+        dhcp.create_dhcp_options(ctx=ctx)
+        dhcp_options_id = \
+            ctx.instance.runtime_properties[constants.EXTERNAL_RESOURCE_ID]
+
+        with mock.patch('boto.vpc.VPCConnection.delete_dhcp_options',
+                        side_effect=EC2ResponseError(400, 'Bad Request', body={
+                            'Code': 'DependencyViolation'})):
+            error = self.assertRaises(
+                RecoverableError, dhcp.delete_dhcp_options, ctx=ctx)
+        self.assertEqual(constants.DELETE_RETRY_INTERVAL, error.retry_after)
+
+        # The set is still found by a node instance that reuses it before
+        # the retry
+        self.assertEqual(
+            [constants.DHCP_OPTIONS['HASH_TAG']],
+            [tag.name for tag in client.get_all_tags(
+                filters={'resource-id': dhcp_options_id})])
+
+        # Once the VPC is gone the retry deletes the set, moto does not
+        # report the deletion as successful
+        with mock.patch('boto.vpc.VPCConnection.delete_dhcp_options',
+                        return_value=True) as delete_dhcp_options:
+            dhcp.delete_dhcp_options(ctx=ctx)
+        delete_dhcp_options.assert_called_once_with(
+            dhcp_options_id=dhcp_options_id)
+        self.assertEqual([], client.get_all_tags(
+            filters={'resource-id': dhcp_options_id}))
+        self.assertNotIn(constants.EXTERNAL_RESOURCE_ID,
+                         ctx.instance.runtime_properties)
+
+
+class TestNetworkStackModule(VpcTestCase):
+
+    def get_mock_network_stack_node_instance_context(self, test_name, vpc_id):
+
+        node_context = self.mock_node_context(
+            test_name,
+            self.get_mock_node_properties({
+                'subnets': [
+                    {'name': 'public', 'cidr_block': '10.10.0.0/24'},
+                    {'name': 'private', 'cidr_prefix': 24}],
+                'internet_gateway': True,
+                'route_tables': [
+                    {'name': 'public', 'subnets': ['public'],
+                     'internet_gateway': True}],
+                'network_acls': [
+                    {'name': 'private', 'subnets': ['private'],
+                     'acl_network_entries': [
+                         {'rule_number': 100, 'protocol': 6,
+                          'rule_action': 'allow', 'egress': False,
+                          'cidr_block': '10.10.0.0/16',
+                          'port_range_from': 22, 'port_range_to': 22}]}]
+            })
+        )
+
+        node_context.node.type = NETWORK_STACK_TYPE
+        node_context.node.type_hierarchy = \
+            [node_context.node.type, 'cloudify.nodes.Root']
+        node_context.instance._relationships = [MockRelationshipContext(
+            MockContext({'instance': MockNodeInstanceContext(
+                runtime_properties={
+                    constants.EXTERNAL_RESOURCE_ID: vpc_id})}),
+            constants.NETWORK_STACK_VPC_RELATIONSHIP)]
+
+        current_ctx.set(ctx=node_context)
+
+        return node_context
+
+    # moto keeps a single in-process backend whose updates are not locked,
+    # it is only consistent when the calls are made one at a time. The
+    # concurrent path is covered with mocked clients below.
+    @mock.patch.dict(constants.NETWORK_STACK, THREADS=1)
+    @mock_ec2
+    def test_create_and_delete_network_stack(self):
+        vpc_client = self.create_client()
+        existing_vpc = vpc_client.create_vpc(TEST_VPC_CIDR)
+        ctx = self.get_mock_network_stack_node_instance_context(
+            'test_create_and_delete_network_stack', existing_vpc.id)
+
+        networkstack.create_network_stack(ctx=ctx)
+
+        properties = ctx.instance.runtime_properties
+        self.assertEqual(existing_vpc.id, properties['vpc_id'])
+        subnets = dict((s.id, s.cidr_block) for s in
+                       vpc_client.get_all_subnets(
+                           filters={'vpc-id': existing_vpc.id}))
+        self.assertEqual(
+            {properties['subnet_ids']['public']: '10.10.0.0/24',
+             properties['subnet_ids']['private']: '10.10.1.0/24'},
+            subnets)
+        gateway = vpc_client.get_all_internet_gateways(
+            properties['internet_gateway_id'])[0]
+        self.assertEqual(existing_vpc.id, gateway.attachments[0].vpc_id)
+        route_table = vpc_client.get_all_route_tables(
+            properties['route_table_ids']['public'])[0]
+        self.assertIn(properties['internet_gateway_id'],
+                      [route.gateway_id for route in route_table.routes])
+        self.assertEqual(
+            [properties['subnet_ids']['public']],
+            [a.subnet_id for a in route_table.associations])
+        network_acl = vpc_client.get_all_network_acls(
+            properties['network_acl_ids']['private'])[0]
+        self.assertEqual(
+            [properties['subnet_ids']['private']],
+            [a.subnet_id for a in network_acl.associations])
+
+        # AWS drops the associations of deleted subnets, moto does not
+        vpc_client.disassociate_route_table(route_table.associations[0].id)
+        networkstack.delete_network_stack(ctx=ctx)
+
+        self.assertFalse(vpc_client.get_all_subnets(
+            filters={'vpc-id': existing_vpc.id}))
+        self.assertFalse(vpc_client.get_all_internet_gateways())
+        self.assertFalse(vpc_client.get_all_route_tables(
+            filters={'vpc-id': existing_vpc.id, 'association.main': 'false'}))
+        self.assertNotIn('subnet_ids', ctx.instance.runtime_properties)
+
+    @mock.patch.dict(constants.NETWORK_STACK, THREADS=1)
+    @mock_ec2
+    def test_create_network_stack_rolls_back(self):
+        vpc_client = self.create_client()
+        existing_vpc = vpc_client.create_vpc(TEST_VPC_CIDR)
+        ctx = self.get_mock_network_stack_node_instance_context(
+            'test_create_network_stack_rolls_back', existing_vpc.id)
+        ctx.node.properties['route_tables'][0]['subnets'] = ['missing']
+
+        error = self.assertRaises(
+            NonRecoverableError, networkstack.create_network_stack, ctx=ctx)
+
+        self.assertIn('no subnet named missing', error.message)
+        self.assertFalse(vpc_client.get_all_subnets(
+            filters={'vpc-id': existing_vpc.id}))
+        self.assertNotIn('subnet_ids', ctx.instance.runtime_properties)
+
+    def get_mock_clients(self, vpc_id):
+        clients = []
+        ids = itertools.count()
+        lock = threading.Lock()
+        running = set()
+
+        def get_client():
+            client = mock.Mock()
+
+            def call(*args, **kwargs):
+                # Fails when two workers use the same client at once
+                with lock:
+                    self.assertNotIn(client, running)
+                    running.add(client)
+                time.sleep(0.01)
+                with lock:
+                    running.remove(client)
+                return mock.Mock(id='resource-{0}'.format(next(ids)))
+
+            client.configure_mock(**dict(
+                (name, mock.Mock(side_effect=call)) for name in [
+                    'create_subnet', 'create_internet_gateway',
+                    'create_route_table', 'create_network_acl',
+                    'attach_internet_gateway', 'create_route',
+                    'associate_route_table', 'create_network_acl_entry',
+                    'associate_network_acl', 'delete_subnet',
+                    'detach_internet_gateway', 'delete_internet_gateway',
+                    'delete_route_table', 'delete_network_acl']))
+            client.get_all_vpcs.return_value = [
+                mock.Mock(id=vpc_id, cidr_block=TEST_VPC_CIDR)]
+            client.get_all_subnets.return_value = []
+            clients.append(client)
+            return client
+
+        return clients, get_client
+
+    @mock.patch.dict(constants.NETWORK_STACK, THREADS=4)
+    def test_network_stack_workers_have_own_clients(self):
+        self.get_mock_network_stack_node_instance_context(
+            'test_network_stack_workers_have_own_clients', 'vpc-0123abcd')
+        clients, get_client = self.get_mock_clients('vpc-0123abcd')
+
+        stack = networkstack.NetworkStack(get_client=get_client)
+        self.assertTrue(stack.created())
+        stack.deleted()
+
+        self.assertEqual(4, len(clients))
+        workers = [c for c in clients if c.create_subnet.called]
+        self.assertGreater(len(workers), 1)
+        self.assertEqual(2, sum(c.create_subnet.call_count for c in clients))
+        self.assertEqual(2, sum(c.delete_subnet.call_count for c in clients))
+
+    @mock.patch.dict(constants.NETWORK_STACK, THREADS=4)
+    def test_network_stack_rolls_back_on_any_error(self):
+        ctx = self.get_mock_network_stack_node_instance_context(
+            'test_network_stack_rolls_back_on_any_error', 'vpc-0123abcd')
+        clients, get_client = self.get_mock_clients('vpc-0123abcd')
+
+        def get_failing_client():
+            client = get_client()
+            client.create_network_acl.side_effect = socket.error('reset')
+            return client
+
+        stack = networkstack.NetworkStack(get_client=get_failing_client)
+        self.assertRaises(socket.error, stack.created)
+
+        self.assertEqual(2, sum(c.delete_subnet.call_count for c in clients))
+        self.assertEqual(
+            1, sum(c.delete_internet_gateway.call_count for c in clients))
+        self.assertEqual(
+            1, sum(c.delete_route_table.call_count for c in clients))
+        self.assertNotIn('subnet_ids', ctx.instance.runtime_properties)
+
+    @mock.patch.dict(constants.NETWORK_STACK, THREADS=4)
+    def test_network_stack_gateway_in_use_is_retried(self):
+        ctx = self.get_mock_network_stack_node_instance_context(
+            'test_network_stack_gateway_in_use_is_retried', 'vpc-0123abcd')
+        clients, get_client = self.get_mock_clients('vpc-0123abcd')
+
+        def get_in_use_client():
+            client = get_client()
+            client.detach_internet_gateway.side_effect = EC2ResponseError(
+                400, 'Bad Request', body={'Code': 'DependencyViolation'})
+            return client
+
+        stack = networkstack.NetworkStack(get_client=get_in_use_client)
+        self.assertTrue(stack.created())
+        error = self.assertRaises(RecoverableError, stack.deleted)
+
+        self.assertEqual(constants.DELETE_RETRY_INTERVAL, error.retry_after)
+        self.assertFalse(any(c.delete_internet_gateway.called
+                             for c in clients))
+        # The retry only deletes what is left
+        properties = ctx.instance.runtime_properties
+        self.assertEqual({}, properties['subnet_ids'])
+        self.assertTrue(properties['internet_gateway_id'])
+
+
+class TestVpnConnectionModule(VpcTestCase):
+
+    def get_mock_vpn_connection_relationship_context(
+            self, test_name, customer_gateway_id, vpn_gateway_id):
+
+        customer_gateway_context = MockContext({
+            'node': MockContext({
+                'properties': {
+                    constants.AWS_CONFIG_PROPERTY: {},
+                    'use_external_resource': False,
+                    'resource_id': '',
+                    'type': 'ipsec.1',
+                    'bgp_asn': 65000
+                }
+            }),
+            'instance': MockContext({
+                'runtime_properties': {
+                    constants.EXTERNAL_RESOURCE_ID: customer_gateway_id
+                }
+            })
+        })
+
+        vpn_gateway_context = MockContext({
+            'node': MockContext({
+                'properties': {
+                    constants.AWS_CONFIG_PROPERTY: {},
+                    'use_external_resource': False,
+                    'resource_id': ''
+                }
+            }),
+            'instance': MockContext({
+                'runtime_properties': {
+                    constants.EXTERNAL_RESOURCE_ID: vpn_gateway_id
+                }
+            })
+        })
+
+        ctx = MockCloudifyContext(
+            node_id=test_name,
+            source=customer_gateway_context,
+            target=vpn_gateway_context)
+        current_ctx.set(ctx=ctx)
+
+        return ctx
+
+    def get_mock_vpn_connection(self, destination_cidr_blocks):
+        return mock.Mock(
+            id='vpn-0123abcd',
+            vpn_gateway_id='vgw-0123abcd',
+            static_routes=[
+                mock.Mock(destination_cidr_block=block, state='available')
+                for block in destination_cidr_blocks])
+
+    @mock_ec2
+    def test_update_routes(self):
+        ctx = self.get_mock_vpn_connection_relationship_context(
+            'test_update_routes', 'cgw-0123abcd', 'vgw-0123abcd')
+        vpn_connection = self.get_mock_vpn_connection(
+            ['10.0.0.0/24', '10.9.0.0/24'])
+        routes = [dict(destination_cidr_block=block)
+                  for block in ['10.0.0.0/24', '10.1.0.0/24', '10.2.0.0/24']]
+
+        with mock.patch('boto.vpc.VPCConnection.create_vpn_connection_route',
+                        return_value=True) as create_route, \
+                mock.patch(
+                    'boto.vpc.VPCConnection.delete_vpn_connection_route',
+                    return_value=True) as delete_route:
+            gateway.VpnConnection().update_routes(vpn_connection, routes)
+
+        self.assertEqual(
+            ['10.1.0.0/24', '10.2.0.0/24'],
+            sorted(call[1]['destination_cidr_block']
+                   for call in create_route.call_args_list))
+        delete_route.assert_called_once_with(
+            destination_cidr_block='10.9.0.0/24',
+            vpn_connection_id='vpn-0123abcd')
+        self.assertEqual(
+            routes, ctx.source.instance.runtime_properties['routes'])
+
+    @mock_ec2
+    def test_update_routes_failure(self):
+        ctx = self.get_mock_vpn_connection_relationship_context(
+            'test_update_routes_failure', 'cgw-0123abcd', 'vgw-0123abcd')
+        vpn_connection = self.get_mock_vpn_connection([])
+        routes = [dict(destination_cidr_block=block)
+                  for block in ['10.1.0.0/24', '10.2.0.0/24']]
+
+        def create_route(destination_cidr_block, **_):
+            return destination_cidr_block != '10.2.0.0/24'
+
+        with mock.patch('boto.vpc.VPCConnection.create_vpn_connection_route',
+                        side_effect=create_route):
+            self.assertRaises(
+                NonRecoverableError,
+                gateway.VpnConnection().update_routes,
+                vpn_connection, routes)
+
+        self.assertEqual(
+            routes[:1], ctx.source.instance.runtime_properties['routes'])
+
+    @mock_ec2
+    def test_update_routes_unexpected_failure(self):
+        ctx = self.get_mock_vpn_connection_relationship_context(
+            'test_update_routes_unexpected_failure',
+            'cgw-0123abcd', 'vgw-0123abcd')
+        vpn_connection = self.get_mock_vpn_connection(['10.9.0.0/24'])
+        routes = [dict(destination_cidr_block=block)
+                  for block in ['10.1.0.0/24', '10.2.0.0/24']]
+
+        def create_route(destination_cidr_block, **_):
+            if destination_cidr_block == '10.2.0.0/24':
+                raise socket.error('Connection reset by peer')
+            return True
+
+        with mock.patch('boto.vpc.VPCConnection.create_vpn_connection_route',
+                        side_effect=create_route), \
+                mock.patch(
+                    'boto.vpc.VPCConnection.delete_vpn_connection_route',
+                    return_value=True):
+            self.assertRaises(
+                socket.error,
+                gateway.VpnConnection().update_routes,
+                vpn_connection, routes)
+
+        self.assertEqual(
+            routes[:1], ctx.source.instance.runtime_properties['routes'])
+
+    @mock.patch.dict(constants.VPN_CONNECTION, ROUTE_THREADS=4)
+    def test_update_routes_workers_have_own_clients(self):
+        self.get_mock_vpn_connection_relationship_context(
+            'test_update_routes_workers_have_own_clients',
+            'cgw-0123abcd', 'vgw-0123abcd')
+        vpn_connection = self.get_mock_vpn_connection([])
+        routes = [dict(destination_cidr_block='10.{0}.0.0/24'.format(i))
+                  for i in range(8)]
+        clients = []
+        lock = threading.Lock()
+        running = set()
+
+        def get_client():
+            client = mock.Mock()
+
+            def create_route(**_):
+                # Fails when two workers use the same client at once
+                with lock:
+                    self.assertNotIn(client, running)
+                    running.add(client)
+                time.sleep(0.01)
+                with lock:
+                    running.remove(client)
+                return True
+
+            client.create_vpn_connection_route.side_effect = create_route
+            clients.append(client)
+            return client
+
+        with mock.patch('cloudify_aws.connection.VPCConnectionClient.client',
+                        side_effect=get_client):
+            gateway.VpnConnection().update_routes(vpn_connection, routes)
+
+        self.assertEqual(4, len(clients))
+        self.assertEqual(8, sum(c.create_vpn_connection_route.call_count
+                                for c in clients))
+
+
+class TestGatewayAttachmentModule(VpcTestCase):
+
+    def get_mock_attachment_relationship_context(
+            self, test_name, gateway_type, gateway_id, vpc_id):
+
+        gateway_context = MockContext({
+            'node': MockContext({
+                'type': gateway_type,
+                'type_hierarchy': [gateway_type, 'cloudify.nodes.Root'],
+                'properties': {
+                    constants.AWS_CONFIG_PROPERTY: {},
+                    'use_external_resource': False,
+                    'resource_id': ''
+                }
+            }),
+            'instance': MockContext({
+                'runtime_properties': {
+                    constants.EXTERNAL_RESOURCE_ID: gateway_id
+                }
+            })
+        })
+
+        vpc_context = MockContext({
+            'node': MockContext({
+                'properties': {
+                    constants.AWS_CONFIG_PROPERTY: {},
+                    'use_external_resource': False,
+                    'resource_id': ''
+                }
+            }),
+            'instance': MockContext({
+                'runtime_properties': {
+                    constants.EXTERNAL_RESOURCE_ID: vpc_id
+                }
+            })
+        })
+
+        ctx = MockCloudifyContext(
+            node_id=test_name,
+            source=gateway_context,
+            target=vpc_context)
+        current_ctx.set(ctx=ctx)
+
+        return ctx
+
+    @mock_ec2
+    def test_attach_and_detach_gateway(self):
+        vpc_client = self.create_client()
+        existing_vpc = self.create_vpc(vpc_client)
+        vpn_gateway = self.create_vpn_gateway(vpc_client)
+        ctx = self.get_mock_attachment_relationship_context(
+            'test_attach_and_detach_gateway',
+            constants.VPN_GATEWAY['CLOUDIFY_NODE_TYPE'],
+            vpn_gateway.id, existing_vpc.id)
+
+        gateway.attach_gateway(ctx=ctx)
+
+        attachments = vpc_client.get_all_vpn_gateways(
+            vpn_gateway_ids=[vpn_gateway.id])[0].attachments
+        self.assertEqual(['attached'], [a.state for a in attachments])
+        self.assertEqual(
+            existing_vpc.id, ctx.source.instance.runtime_properties['vpc_id'])
+
+        # A retried attach does not attach the gateway again
+        gateway.attach_gateway(ctx=ctx)
+        gateway.detach_gateway(ctx=ctx)
+
+        self.assertFalse(vpc_client.get_all_vpn_gateways(
+            vpn_gateway_ids=[vpn_gateway.id])[0].attachments)
+
+    @mock_ec2
+    def test_attach_gateway_waits(self):
+        vpc_client = self.create_client()
+        existing_vpc = self.create_vpc(vpc_client)
+        internet_gateway = self.create_internet_gateway(vpc_client)
+        self.get_mock_attachment_relationship_context(
+            'test_attach_gateway_waits',
+            constants.INTERNET_GATEWAY['CLOUDIFY_NODE_TYPE'],
+            internet_gateway.id, existing_vpc.id)
+        attachment = gateway.GatewayVpcAttachment()
+
+        with mock.patch.object(
+                attachment, 'get_attachment_state',
+                side_effect=['detached', 'attaching', 'available']), \
+                mock.patch('time.sleep') as sleep:
+            self.assertTrue(attachment.associate(None))
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual(
+            [existing_vpc.id],
+            [a.vpc_id for a in vpc_client.get_all_internet_gateways(
+                internet_gateway_ids=[internet_gateway.id])[0].attachments])
+
+        # A slow detach is only waited for a few seconds, the rest is
+        # left to operation retries
+        clock = [0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with mock.patch.object(
+                attachment, 'get_attachment_state',
+                return_value='detaching') as get_attachment_state, \
+                mock.patch('time.sleep', side_effect=sleep), \
+                mock.patch('time.time', side_effect=lambda: clock[0]):
+            error = self.assertRaises(
+                RecoverableError, attachment.disassociate, None)
+        self.assertEqual(constants.GATEWAY_ATTACHMENT['RETRY_INTERVAL'],
+                         error.retry_after)
+        self.assertEqual(constants.READY_WAIT_TIMEOUT, clock[0])
+        self.assertGreater(get_attachment_state.call_count, 1)
+
+
+class TestVpcPeeringConnectionModule(VpcTestCase):
+
+    def get_mock_peering_relationship_context(
+            self, test_name, route_table_id, vpc_id, peer_vpc_id):
+
+        route_table_context = MockContext({
+            'node': MockContext({
+                'properties': {
+                    constants.AWS_CONFIG_PROPERTY: {},
+                    'use_external_resource': False,
+                    'resource_id': ''
+                }
+            }),
+            'instance': MockNodeInstanceContext(runtime_properties={
+                constants.EXTERNAL_RESOURCE_ID: route_table_id,
+                'vpc_id': vpc_id
+            })
+        })
+
+        vpc_context = MockContext({
+            'node': MockContext({
+                'properties': {
+                    constants.AWS_CONFIG_PROPERTY: {},
+                    'use_external_resource': False,
+                    'resource_id': ''
+                }
+            }),
+            'instance': MockNodeInstanceContext(runtime_properties={
+                constants.EXTERNAL_RESOURCE_ID: peer_vpc_id
+            })
+        })
+
+        ctx = MockCloudifyContext(
+            node_id=test_name,
+            source=route_table_context,
+            target=vpc_context)
+        current_ctx.set(ctx=ctx)
+
+        return ctx
+
+    @mock_ec2
+    def test_vpc_peering_connections_runtime_property(self):
+        ctx = self.get_mock_peering_relationship_context(
+            'test_vpc_peering_connections_runtime_property',
+            'rtb-0123abcd', 'vpc-0123abcd', 'vpc-4567abcd')
+        peering = vpc.VpcPeeringConnection(
+            routes=[dict(destination_cidr_block='10.1.0.0/24')])
+        peering.resource_id = 'pcx-0123abcd'
+
+        peering.post_associate()
+
+        self.assertEqual(
+            {'pcx-0123abcd': {'vpc_id': 'vpc-0123abcd',
+                              'vpc_peer_id': 'vpc-4567abcd',
+                              'routes': ['10.1.0.0/24']}},
+            ctx.source.instance.runtime_properties[
+                'vpc_peering_connections'])
+        self.assertNotIn(
+            'routes', ctx.target.instance.runtime_properties[
+                'vpc_peering_connections']['pcx-0123abcd'])
+        peering = vpc.VpcPeeringConnection()
+        self.assertEqual(
+            'pcx-0123abcd', peering.source_vpc_peering_connection_id)
+        self.assertEqual(
+            'pcx-0123abcd', peering.target_vpc_peering_connection_id)
+
+    @mock_ec2
+    def test_legacy_vpc_peering_connections_runtime_property(self):
+        ctx = self.get_mock_peering_relationship_context(
+            'test_legacy_vpc_peering_connections_runtime_property',
+            'rtb-0123abcd', 'vpc-0123abcd', 'vpc-4567abcd')
+        route = dict(destination_cidr_block='10.1.0.0/24',
+                     route_table_id='rtb-0123abcd',
+                     vpc_peering_connection_id='pcx-0123abcd')
+        # Written by older versions of the plugin
+        ctx.source.instance.runtime_properties[
+            'vpc_peering_connections'] = [
+            dict(vpc_peering_connection_id='pcx-0123abcd',
+                 vpc_id='vpc-0123abcd', vpc_peer_id='vpc-4567abcd',
+                 routes=[route])]
+
+        peering = vpc.VpcPeeringConnection()
+        self.assertEqual(
+            'pcx-0123abcd', peering.source_vpc_peering_connection_id)
+
+        with mock.patch.object(peering, 'delete_route') as delete_route:
+            peering.delete_routes()
+        delete_route.assert_called_once_with(
+            'rtb-0123abcd', dict(destination_cidr_block='10.1.0.0/24'),
+            route_table_ctx_instance=ctx.source.instance)
+
+        peering.resource_id = 'pcx-4567abcd'
+        peering.routes = []
+        peering.post_associate()
+        self.assertEqual(
+            ['pcx-0123abcd', 'pcx-4567abcd'],
+            sorted(ctx.source.instance.runtime_properties[
+                'vpc_peering_connections']))
+        self.assertEqual(
+            'pcx-0123abcd', vpc.VpcPeeringConnection()
+            .source_vpc_peering_connection_id)
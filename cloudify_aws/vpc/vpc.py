@@ -13,6 +13,9 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
+# Built-in Imports
+from collections import OrderedDict
+
 # Third-party Imports
 from boto import exception
 
@@ -123,6 +126,9 @@ class VpcPeeringConnection(AwsBaseRelationship, RouteMixin):
                          associate_args, raise_on_falsy=True)
         self.resource_id = vpc_peering_connection.id
 
+        self.routes = self.aggregate_routes(
+            self.routes, self.source_route_table_id)
+
         for route in self.routes:
             route.update(
                 route_table_id=self.source_route_table_id,
@@ -153,35 +159,70 @@ class VpcPeeringConnection(AwsBaseRelationship, RouteMixin):
                             disassociate_args, raise_on_falsy=True)
 
     def post_associate(self):
-        cx = dict(
-            vpc_peering_connection_id=self.resource_id,
-            vpc_id=self.source_vpc_id,
-            vpc_peer_id=self.target_vpc_id,
-            routes=self.routes
-        )
-        if 'vpc_peering_connections' \
-                not in ctx.source.instance.runtime_properties:
-            ctx.source.instance.runtime_properties[
-                'vpc_peering_connections'] = []
-        ctx.source.instance.runtime_properties[
-            'vpc_peering_connections'].append(cx)
-        if 'vpc_peering_connections' \
-                not in ctx.target.instance.runtime_properties:
-            ctx.target.instance.runtime_properties[
-                'vpc_peering_connections'] = []
-        ctx.target.instance.runtime_properties[
-            'vpc_peering_connections'].append(cx)
+        # The routes are in the routes of the source route table, the
+        # connection only refers to them by their destination blocks
+        self.add_vpc_peering_connection(
+            ctx.source.instance,
+            routes=[route['destination_cidr_block'] for route in self.routes])
+        self.add_vpc_peering_connection(ctx.target.instance)
         return True
 
+    def add_vpc_peering_connection(self, ctx_instance, **record):
+        connections = self.get_vpc_peering_connections(ctx_instance)
+        index = ctx_instance.runtime_properties.get(
+            'vpc_peering_connection_index')
+        if index is None:
+            index = {}
+            added = connections.keys() + [self.resource_id]
+        else:
+            added = [self.resource_id]
+        connections[self.resource_id] = dict(
+            record, vpc_id=self.source_vpc_id, vpc_peer_id=self.target_vpc_id)
+        ctx_instance.runtime_properties['vpc_peering_connections'] = \
+            dict(connections)
+        # The first connection of a vpc is the one that is looked up
+        for connection_id in added:
+            for property_name in ['vpc_id', 'vpc_peer_id']:
+                index.setdefault(property_name, {}).setdefault(
+                    connections[connection_id][property_name],
+                    connection_id)
+        ctx_instance.runtime_properties['vpc_peering_connection_index'] = \
+            index
+
+    @staticmethod
+    def get_vpc_peering_connections(ctx_instance):
+        """Returns the vpc peering connections of a node instance by id.
+
+        Older versions of the plugin stored a list of connections, each
+        with a copy of its routes. Those are read into the same form.
+        """
+
+        connections = \
+            ctx_instance.runtime_properties.get('vpc_peering_connections')
+
+        if isinstance(connections, dict):
+            return connections
+
+        return OrderedDict(
+            (connection['vpc_peering_connection_id'], dict(
+                vpc_id=connection['vpc_id'],
+                vpc_peer_id=connection['vpc_peer_id'],
+                routes=[route['destination_cidr_block']
+                        for route in connection.get('routes') or []]))
+            for connection in connections or [])
+
     def delete_routes(self):
         vpc_peering_connections = \
-            ctx.source.instance.runtime_properties \
-            .get('vpc_peering_connections')
-        for vpc_peering_connection in vpc_peering_connections:
-            ctx.logger.info('{0}'.format(vpc_peering_connection))
-            for route in vpc_peering_connection['routes']:
+            self.get_vpc_peering_connections(ctx.source.instance)
+        for connection_id, vpc_peering_connection in \
+                vpc_peering_connections.items():
+            ctx.logger.info('Deleting the routes of {0}.'
+                            .format(connection_id))
+            for destination_cidr_block in \
+                    vpc_peering_connection.get('routes', []):
                 self.delete_route(
-                    self.source_route_table_id, route,
+                    self.source_route_table_id,
+                    dict(destination_cidr_block=destination_cidr_block),
                     route_table_ctx_instance=ctx.source.instance)
 
     def get_vpc_peering_connection_id(self, ctx_instance,
@@ -191,14 +232,16 @@ class VpcPeeringConnection(AwsBaseRelationship, RouteMixin):
             ctx_instance.runtime_properties \
             .get('vpc_peering_connections')
 
-        if not vpc_peering_connections:
+        if isinstance(vpc_peering_connections, list):
+            for vpc_peering_connection in vpc_peering_connections:
+                if vpc_id in vpc_peering_connection[property_name]:
+                    return vpc_peering_connection['vpc_peering_connection_id']
             return None
 
-        for vpc_peering_connection in vpc_peering_connections:
-            if vpc_id in vpc_peering_connection[property_name]:
-                return vpc_peering_connection['vpc_peering_connection_id']
+        index = ctx_instance.runtime_properties.get(
+            'vpc_peering_connection_index') or {}
 
-        return None
+        return index.get(property_name, {}).get(vpc_id)
 
     def accept_vpc_peering_connection(self, args):
 
@@ -291,6 +334,14 @@ class Vpc(AwsBaseNode):
         vpc = self.execute(self.client.create_vpc,
                            create_args, raise_on_falsy=True)
         self.resource_id = vpc.id
+
+        # The VPC is usually available within a second. Retrying the
+        # operation would create another VPC, so this only waits.
+        if getattr(vpc, 'state', None) == 'pending' and not utils.wait_for(
+                self.get_resource,
+                lambda resource: resource and resource.state != 'pending'):
+            ctx.logger.warn('VPC {0} is still pending.'.format(vpc.id))
+
         ctx.instance.runtime_properties['default_dhcp_options_id'] = \
             vpc.dhcp_options_id
 
@@ -2,39 +2,622 @@
 # Copyright (c) 2017 Faaspot Technologies Ltd. All rights reserved
 #
 
+import json
+from operator import attrgetter
+
+from boto import exception
+from boto.ec2 import EC2Connection
+from boto.ec2.elb import ELBConnection
+from boto.vpc import VPCConnection
+
+from cloudify import constants as cloudify_constants
 from cloudify.decorators import workflow
-from cloudify.plugins import lifecycle
-from cloudify.manager import get_node_instance
+from cloudify.plugins.lifecycle import (
+    set_send_node_event_on_error_handler, uninstall_node_instance_subgraph)
+from cloudify.workflows.tasks import HandlerResult, NOPLocalWorkflowTask
+from cloudify.workflows.tasks_graph import forkjoin
+from cloudify.exceptions import NonRecoverableError
+from cloudify.manager import get_node_instance, update_node_instance
+
+from cloudify_aws import connection, utils
+from cloudify_aws.ec2.elasticloadbalancer import get_load_balancers_by_name
 
 
 HOST_NODE_TYPE = 'cloudify.aws.nodes.Instance'
 ELASTICIP_NODE_TYPE = 'cloudify.aws.nodes.ElasticIP'
 EXTERNAL_RESOURCE_ID = 'aws_resource_id'
 RESOURCE_ID = 'resource_id'
+AWS_CONFIG_PROPERTY = 'aws_config'
+ESTABLISH_OPERATION = 'cloudify.interfaces.relationship_lifecycle.establish'
+UNLINK_OPERATION = 'cloudify.interfaces.relationship_lifecycle.unlink'
 
 
 @workflow
-def refresh_ip(ctx, **kwargs):
+def refresh_ip(ctx, max_concurrency=10, **kwargs):
     ctx.logger.info("Starting 'refresh_ip' workflow")
-    host_instance = None
-    ip_instance = None
 
-    for instance in set(ctx.node_instances):
-        if ELASTICIP_NODE_TYPE in instance.node.type_hierarchy:
-            ip_instance = instance
-        elif HOST_NODE_TYPE in instance.node.type_hierarchy:
-            host_instance = instance
+    pairs = get_elasticip_host_pairs(ctx)
 
-    if not ip_instance or not host_instance:
+    if not pairs:
         ctx.logger.info('Missing components for refresh ip..')
         return
 
-    # host_runtime_properties = get_node_instance(host_instance.id).runtime_properties)
-    # ip_runtime_properties = get_node_instance(ip_instance.id).runtime_properties)
-    ctx.logger.info("Going to reinstall node: {0}".format(ip_instance.id))
-    lifecycle.reinstall_node_instances(graph=ctx.graph_mode(),
-                                       node_instances=[ip_instance],
-                                       related_nodes=[host_instance],
-                                       ignore_failure=False)
-    # ip_runtime_properties = get_node_instance(ip_instance.id).runtime_properties)
+    addresses = get_addresses_by_public_ip(pairs)
+
+    stale = []
+    for ip_instance, host_instance, relationship in pairs:
+        public_ip = get_resource_id(ip_instance)
+        instance_id = get_resource_id(host_instance)
+        address = addresses.get(public_ip)
+        if address and address.instance_id == instance_id:
+            ctx.logger.debug('{0} is already associated with {1}'
+                             .format(public_ip, instance_id))
+            continue
+        stale.append((relationship, address))
+
+    ctx.logger.info('{0} of {1} elastic ips need to be re-associated'
+                    .format(len(stale), len(pairs)))
+
+    if not stale:
+        ctx.logger.info('completed')
+        return
+
+    graph = ctx.graph_mode()
+    lanes = [graph.sequence()
+             for _ in range(max(1, min(int(max_concurrency), len(stale))))]
+
+    for index, (relationship, address) in enumerate(stale):
+        tasks = []
+        if address and address.instance_id:
+            tasks.append(
+                relationship.execute_source_operation(UNLINK_OPERATION))
+        tasks.append(
+            relationship.execute_source_operation(ESTABLISH_OPERATION))
+        lanes[index % len(lanes)].add(*tasks)
+
+    graph.execute()
+    ctx.logger.info('completed')
+
+
+def get_elasticip_host_pairs(ctx):
+    """Returns a (elastic ip instance, host instance, relationship) tuple
+    for every host that is connected to an elastic ip.
+    """
+
+    pairs = []
+
+    for instance in ctx.node_instances:
+        if not utils.is_of_type(instance.node, HOST_NODE_TYPE):
+            continue
+        for relationship in instance.relationships:
+            target = relationship.target_node_instance
+            if utils.is_of_type(target.node, ELASTICIP_NODE_TYPE):
+                pairs.append((target, instance, relationship))
+
+    return pairs
+
+
+def get_addresses_by_public_ip(pairs):
+    """Describes the elastic ips of all pairs, with one call per
+    aws_config, and indexes them by public ip.
+    """
+
+    public_ips_by_config = {}
+
+    for ip_instance, _, _ in pairs:
+        aws_config = ip_instance.node.properties.get(AWS_CONFIG_PROPERTY)
+        key = json.dumps(aws_config or {}, sort_keys=True)
+        public_ips_by_config.setdefault(key, set()).add(
+            get_resource_id(ip_instance))
+
+    addresses = {}
+
+    for key, public_ips in public_ips_by_config.items():
+        client = get_client(json.loads(key))
+        try:
+            found = client.get_all_addresses(
+                filters={'public-ip': list(public_ips)})
+        except (exception.EC2ResponseError,
+                exception.BotoServerError) as e:
+            raise NonRecoverableError('{0}'.format(str(e)))
+        for address in found:
+            if address.public_ip in public_ips:
+                addresses[address.public_ip] = address
+
+    return addresses
+
+
+@workflow
+def detect_drift(ctx, reconcile=False, **kwargs):
+    ctx.logger.info("Starting 'detect_drift' workflow")
+
+    instances_by_type = {}
+    for instance in ctx.node_instances:
+        node_type = get_drift_node_type(instance)
+        if node_type and get_resource_id(instance):
+            instances_by_type.setdefault(node_type, []).append(instance)
+
+    indexes = {}
+    report = {}
+
+    for node_type, instances in instances_by_type.items():
+        spec = DRIFT_RESOURCES[node_type]
+        for instance in instances:
+            aws_config = instance.node.properties.get(AWS_CONFIG_PROPERTY)
+            index_key = (json.dumps(aws_config or {}, sort_keys=True),
+                         spec['describe'])
+            if index_key not in indexes:
+                indexes[index_key] = describe_resources(spec, aws_config)
+            drift = get_drift(
+                instance, spec, indexes[index_key].get(
+                    get_resource_id(instance)))
+            if drift:
+                report[instance.id] = drift
+
+    for instance_id, drift in sorted(report.items()):
+        ctx.logger.info('drift {0}: {1}'.format(
+            instance_id, json.dumps(drift, sort_keys=True)))
+
+    ctx.logger.info(
+        '{0} of {1} node instances drifted ({2} describe calls)'.format(
+            len(report),
+            sum(len(instances) for instances in instances_by_type.values()),
+            len(indexes)))
+
+    if reconcile:
+        for instance_id, drift in report.items():
+            changes = drift.get('changed')
+            if changes:
+                reconcile_runtime_properties(ctx, instance_id, changes)
+
+    return report
+
+
+@workflow
+def teardown(ctx, **kwargs):
+    """Uninstalls the deployment one AWS dependency layer at a time.
+
+    Every node instance of a layer is uninstalled in parallel, and the
+    next layer starts once the whole layer is gone. Relationships still
+    order the node instances within a layer.
+
+    The EC2 instances of a layer are not stopped and terminated one by
+    one. Once their agents are stopped and their relationships unlinked,
+    they are all terminated together, and their delete operations only
+    wait for the termination.
+    """
+
+    ctx.logger.info("Starting 'teardown' workflow")
+
+    layers = get_teardown_layers(ctx.node_instances)
+
+    graph = ctx.graph_mode()
+    # The first and last subgraph of every node instance
+    subgraphs = {}
+    terminated = set()
+    barrier = None
+
+    for index, layer in enumerate(layers):
+        ctx.logger.info('teardown layer {0}: {1} node instances'
+                        .format(index, len(layer)))
+
+        hosts = [instance for instance in layer
+                 if is_terminated_in_bulk(instance)]
+        if hosts:
+            terminate_task = ctx.local_task(
+                batch_terminate,
+                kwargs={'instance_ids_by_config':
+                        get_instance_ids_by_config(hosts)},
+                name='batch_terminate')
+            # The delete operation terminates the instances that were not
+            # terminated in bulk
+            terminate_task.on_failure = ignore_batch_terminate_failure
+            graph.add_task(terminate_task)
+
+        for instance in layer:
+            if instance in hosts:
+                subgraphs[instance.id] = \
+                    teardown_host_subgraphs(instance, graph)
+                graph.add_dependency(terminate_task,
+                                     subgraphs[instance.id][0])
+                graph.add_dependency(subgraphs[instance.id][1],
+                                     terminate_task)
+                terminated.add(instance.id)
+            else:
+                subgraph = uninstall_node_instance_subgraph(instance, graph)
+                subgraphs[instance.id] = (subgraph, subgraph)
+            if barrier:
+                graph.add_dependency(subgraphs[instance.id][0], barrier)
+
+        barrier = NOPLocalWorkflowTask(ctx)
+        graph.add_task(barrier)
+        for instance in layer:
+            graph.add_dependency(barrier, subgraphs[instance.id][1])
+
+    for layer in layers:
+        for instance in layer:
+            for relationship in instance.relationships:
+                target_id = relationship.target_id
+                if target_id not in subgraphs or target_id == instance.id:
+                    continue
+                # Instances that are terminated together are not ordered
+                if instance.id in terminated and target_id in terminated:
+                    continue
+                graph.add_dependency(subgraphs[target_id][0],
+                                     subgraphs[instance.id][1])
+
+    graph.execute()
     ctx.logger.info('completed')
+
+
+def teardown_host_subgraphs(instance, graph):
+    """Splits the uninstall of an EC2 instance around its termination.
+
+    The first subgraph stops the agent and unlinks the relationships. The
+    stop operation is skipped, since the instance is terminated anyway.
+    The second subgraph runs the delete operation. As in the built-in
+    uninstall, a failed task is reported and the teardown goes on.
+    """
+
+    stop_subgraph = graph.subgraph('stop_{0}'.format(instance.id))
+    stop_subgraph.sequence().add(
+        instance.set_state('stopping'),
+        instance.send_event('Stopping node'),
+        instance.execute_operation('cloudify.interfaces.monitoring.stop'),
+        *(get_agent_stop_tasks(instance) +
+          [instance.set_state('stopped')] +
+          get_unlink_tasks(instance)))
+
+    delete_subgraph = graph.subgraph('delete_{0}'.format(instance.id))
+    delete_subgraph.sequence().add(
+        instance.set_state('deleting'),
+        instance.send_event('Deleting node'),
+        instance.execute_operation('cloudify.interfaces.lifecycle.delete'),
+        instance.set_state('deleted'))
+
+    for subgraph in (stop_subgraph, delete_subgraph):
+        for task in subgraph.tasks.values():
+            set_send_node_event_on_error_handler(task, instance)
+
+    return stop_subgraph, delete_subgraph
+
+
+def get_agent_stop_tasks(instance):
+    """Returns the tasks that stop and remove the agent of a host, the
+    same ones the built-in uninstall runs.
+    """
+
+    tasks = [
+        instance.execute_operation(
+            'cloudify.interfaces.monitoring_agent.stop'),
+        instance.execute_operation(
+            'cloudify.interfaces.monitoring_agent.uninstall')]
+
+    install_method = get_agent_install_method(instance.node.properties)
+
+    if install_method == cloudify_constants.AGENT_INSTALL_METHOD_NONE:
+        return tasks
+
+    if install_method in cloudify_constants.AGENT_INSTALL_METHODS_SCRIPTS:
+        stop, delete = ('cloudify.interfaces.cloudify_agent.stop_amqp',
+                        'cloudify.interfaces.cloudify_agent.delete')
+    elif 'cloudify.interfaces.worker_installer.stop' in \
+            instance.node.operations:
+        stop, delete = ('cloudify.interfaces.worker_installer.stop',
+                        'cloudify.interfaces.worker_installer.uninstall')
+    else:
+        stop, delete = ('cloudify.interfaces.cloudify_agent.stop',
+                        'cloudify.interfaces.cloudify_agent.delete')
+
+    return tasks + [
+        instance.send_event('Stopping agent'),
+        instance.execute_operation(stop),
+        instance.send_event('Deleting agent'),
+        instance.execute_operation(delete)]
+
+
+def get_agent_install_method(properties):
+    install_agent = properties.get('install_agent')
+    if install_agent is False:
+        return cloudify_constants.AGENT_INSTALL_METHOD_NONE
+    if install_agent is True:
+        return cloudify_constants.AGENT_INSTALL_METHOD_REMOTE
+    return (properties.get('agent_config') or {}).get('install_method')
+
+
+def get_unlink_tasks(instance):
+    # Both ends of a relationship are unlinked together, the last
+    # relationship first
+    return [forkjoin(relationship.execute_source_operation(UNLINK_OPERATION),
+                     relationship.execute_target_operation(UNLINK_OPERATION))
+            for relationship in reversed(instance.relationships)]
+
+
+def ignore_batch_terminate_failure(task):
+    task.workflow_context.logger.warn(
+        'Bulk termination failed, the instances are terminated one by one')
+    return HandlerResult.ignore()
+
+
+def is_terminated_in_bulk(instance):
+    properties = instance.node.properties
+    return utils.is_of_type(instance.node, HOST_NODE_TYPE) and \
+        not properties.get('use_external_resource') and \
+        bool(get_resource_id(instance))
+
+
+def get_instance_ids_by_config(instances):
+    instance_ids_by_config = {}
+    for instance in instances:
+        aws_config = instance.node.properties.get(AWS_CONFIG_PROPERTY)
+        key = json.dumps(aws_config or {}, sort_keys=True)
+        instance_ids_by_config.setdefault(key, []).append(
+            get_resource_id(instance))
+    return instance_ids_by_config
+
+
+def batch_terminate(instance_ids_by_config):
+    """Terminates instances with one call per aws_config and chunk of
+    TERMINATE_CHUNK_SIZE ids.
+
+    A failed chunk does not stop the others. The ids of the failed chunks
+    are raised once all calls are made, and their delete operations
+    terminate them one by one.
+    """
+
+    failed = []
+    errors = []
+
+    for key, instance_ids in instance_ids_by_config.items():
+        client = get_client(json.loads(key))
+        for index in range(0, len(instance_ids), TERMINATE_CHUNK_SIZE):
+            chunk = instance_ids[index:index + TERMINATE_CHUNK_SIZE]
+            try:
+                client.terminate_instances(instance_ids=chunk)
+            except (exception.EC2ResponseError,
+                    exception.BotoServerError) as e:
+                failed.extend(chunk)
+                errors.append(str(e))
+
+    if failed:
+        raise NonRecoverableError(
+            'Unable to terminate instances {0}: {1}'.format(
+                failed, '; '.join(errors)))
+
+
+def get_teardown_layers(node_instances):
+    """Groups node instances into the layers they are torn down in.
+
+    A node instance starts in the layer of its type, and is moved to a
+    later layer if the source of one of its relationships is torn down
+    later, so that a relationship never points to an earlier layer.
+    """
+
+    node_instances = list(node_instances)
+    layer_by_id = dict((instance.id, get_teardown_layer(instance))
+                       for instance in node_instances)
+
+    for _ in node_instances:
+        changed = False
+        for instance in node_instances:
+            for relationship in instance.relationships:
+                target_id = relationship.target_id
+                if target_id in layer_by_id and \
+                        layer_by_id[target_id] < layer_by_id[instance.id]:
+                    layer_by_id[target_id] = layer_by_id[instance.id]
+                    changed = True
+        if not changed:
+            break
+
+    layers = [[] for _ in range(len(TEARDOWN_LAYERS) + 1)]
+    for instance in node_instances:
+        layers[layer_by_id[instance.id]].append(instance)
+
+    return [layer for layer in layers if layer]
+
+
+def get_teardown_layer(instance):
+    # Node types that are not AWS resources, like the software running
+    # on the hosts, go first
+    for index, node_types in enumerate(TEARDOWN_LAYERS):
+        for node_type in node_types:
+            if utils.is_of_type(instance.node, node_type):
+                return index + 1
+    return 0
+
+
+def get_drift_node_type(instance):
+    for node_type in reversed(instance.node.type_hierarchy):
+        if node_type in DRIFT_RESOURCES:
+            return node_type
+    return None
+
+
+def describe_resources(spec, aws_config):
+    """Describes every resource of a type with one (paged) call and
+    indexes the result by the id stored in aws_resource_id.
+    """
+
+    client = get_client(aws_config, *DRIFT_CLIENTS[spec['client']])
+    get_id = attrgetter(spec['id'])
+
+    try:
+        resources = spec['describe'](client)
+    except (exception.EC2ResponseError,
+            exception.BotoServerError) as e:
+        raise NonRecoverableError('{0}'.format(str(e)))
+
+    return dict((get_id(resource), resource) for resource in resources)
+
+
+def get_drift(instance, spec, resource):
+    """Compares the runtime properties of a node instance with the
+    described resource and returns the differences, if any.
+    """
+
+    if resource is None:
+        return {'missing': get_resource_id(instance)}
+
+    runtime_properties = instance._node_instance.runtime_properties
+    changed = {}
+
+    for property_name, get_value in spec['properties'].items():
+        if property_name not in runtime_properties:
+            continue
+        expected = runtime_properties[property_name]
+        actual = get_value(resource)
+        compare = spec.get('normalize', {}).get(property_name, normalize)
+        if compare(expected) != compare(actual):
+            changed[property_name] = actual
+
+    return {'changed': changed} if changed else None
+
+
+def reconcile_runtime_properties(ctx, instance_id, changes):
+    node_instance = get_node_instance(instance_id)
+    node_instance.runtime_properties.update(changes)
+    update_node_instance(node_instance)
+    ctx.logger.info('Updated {0} of {1}'.format(
+        sorted(changes.keys()), instance_id))
+
+
+def normalize(value):
+    if isinstance(value, (list, tuple)):
+        return sorted(normalize(item) for item in value)
+    if isinstance(value, dict):
+        return sorted((key, normalize(item)) for key, item in value.items()
+                      if item is not None)
+    return value or None
+
+
+def describe_reservations(client):
+    instances = []
+    next_token = None
+    while True:
+        reservations = client.get_all_reservations(
+            max_results=DESCRIBE_PAGE_SIZE, next_token=next_token)
+        for reservation in reservations:
+            instances.extend(reservation.instances)
+        next_token = getattr(reservations, 'next_token', None)
+        if not next_token:
+            return instances
+
+
+def get_routes(route_table):
+    return utils.encode_routes(
+        [dict((key, getattr(route, key)) for key in ROUTE_KEYS
+              if getattr(route, key, None))
+         for route in route_table.routes
+         if route.gateway_id != 'local'])
+
+
+def normalize_routes(routes):
+    return normalize([dict((key, route.get(key)) for key in ROUTE_KEYS)
+                      for route in utils.decode_routes(routes)])
+
+
+def get_instance_list(load_balancer):
+    return [instance.id for instance in load_balancer.instances]
+
+
+DESCRIBE_PAGE_SIZE = 1000
+TERMINATE_CHUNK_SIZE = 1000
+ROUTE_KEYS = ['destination_cidr_block', 'gateway_id', 'instance_id',
+              'interface_id', 'vpc_peering_connection_id']
+
+TEARDOWN_LAYERS = [
+    ['cloudify.aws.nodes.Instance'],
+    ['cloudify.aws.nodes.ElasticIP', 'cloudify.aws.nodes.Volume',
+     'cloudify.aws.nodes.ElasticLoadBalancer', 'cloudify.aws.nodes.KeyPair'],
+    ['cloudify.aws.nodes.SecurityGroup', 'cloudify.aws.nodes.RouteTable',
+     'cloudify.aws.nodes.ACL', 'cloudify.aws.nodes.DHCPOptions'],
+    ['cloudify.aws.nodes.Subnet', 'cloudify.aws.nodes.InternetGateway',
+     'cloudify.aws.nodes.VPNGateway', 'cloudify.aws.nodes.CustomerGateway',
+     'cloudify.aws.nodes.NetworkStack'],
+    ['cloudify.aws.nodes.VPC'],
+]
+
+DRIFT_CLIENTS = {
+    'vpc': (connection.VPCConnectionClient, VPCConnection),
+    'elb': (connection.ELBConnectionClient, ELBConnection)
+}
+
+DRIFT_RESOURCES = {
+    'cloudify.aws.nodes.Instance': dict(
+        client='vpc', describe=describe_reservations, id='id',
+        properties={
+            'ip': attrgetter('private_ip_address'),
+            'public_ip_address': attrgetter('ip_address'),
+            'private_dns_name': attrgetter('private_dns_name'),
+            'public_dns_name': attrgetter('public_dns_name'),
+            'placement': attrgetter('placement'),
+            'vpc_id': attrgetter('vpc_id'),
+            'subnet_id': attrgetter('subnet_id')}),
+    'cloudify.aws.nodes.ElasticIP': dict(
+        client='vpc', describe=VPCConnection.get_all_addresses,
+        id='public_ip',
+        properties={
+            'allocation_id': attrgetter('allocation_id'),
+            'instance_id': attrgetter('instance_id')}),
+    'cloudify.aws.nodes.Volume': dict(
+        client='vpc', describe=VPCConnection.get_all_volumes, id='id',
+        properties={
+            'zone': attrgetter('zone'),
+            'instance_id': attrgetter('attach_data.instance_id')}),
+    'cloudify.aws.nodes.KeyPair': dict(
+        client='vpc', describe=VPCConnection.get_all_key_pairs, id='name',
+        properties={}),
+    'cloudify.aws.nodes.SecurityGroup': dict(
+        client='vpc', describe=VPCConnection.get_all_security_groups,
+        id='id', properties={}),
+    # default_dhcp_options_id is the set that unlinking DHCPOptions
+    # restores, not the set that is associated now
+    'cloudify.aws.nodes.VPC': dict(
+        client='vpc', describe=VPCConnection.get_all_vpcs, id='id',
+        properties={}),
+    'cloudify.aws.nodes.Subnet': dict(
+        client='vpc', describe=VPCConnection.get_all_subnets, id='id',
+        properties={}),
+    'cloudify.aws.nodes.RouteTable': dict(
+        client='vpc', describe=VPCConnection.get_all_route_tables, id='id',
+        properties={
+            'vpc_id': attrgetter('vpc_id'),
+            'routes': get_routes},
+        normalize={'routes': normalize_routes}),
+    'cloudify.aws.nodes.ACL': dict(
+        client='vpc', describe=VPCConnection.get_all_network_acls, id='id',
+        properties={'vpc_id': attrgetter('vpc_id')}),
+    'cloudify.aws.nodes.InternetGateway': dict(
+        client='vpc', describe=VPCConnection.get_all_internet_gateways,
+        id='id', properties={}),
+    'cloudify.aws.nodes.VPNGateway': dict(
+        client='vpc', describe=VPCConnection.get_all_vpn_gateways, id='id',
+        properties={}),
+    'cloudify.aws.nodes.CustomerGateway': dict(
+        client='vpc', describe=VPCConnection.get_all_customer_gateways,
+        id='id', properties={}),
+    'cloudify.aws.nodes.DHCPOptions': dict(
+        client='vpc', describe=VPCConnection.get_all_dhcp_options, id='id',
+        properties={}),
+    'cloudify.aws.nodes.ElasticLoadBalancer': dict(
+        client='elb',
+        describe=lambda client: get_load_balancers_by_name(client).values(),
+        id='name',
+        properties={'instance_list': get_instance_list}),
+}
+
+
+def get_client(aws_config, client_class=connection.EC2ConnectionClient,
+               default_connection=EC2Connection):
+    # There is no operation context in a workflow to read the node
+    # aws_config from, so fall back to the boto config file directly.
+    connection_client = client_class()
+    aws_config = aws_config or connection_client._get_aws_config_from_file()
+    if not aws_config:
+        return default_connection()
+    return connection_client.client(aws_config=aws_config)
+
+
+def get_resource_id(instance):
+    return instance._node_instance.runtime_properties.get(
+        EXTERNAL_RESOURCE_ID) or instance.node.properties.get(RESOURCE_ID)
@@ -13,9 +13,9 @@
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
 
-import copy
 from time import sleep
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from boto.ec2 import get_region
 from boto.ec2 import EC2Connection
@@ -27,6 +27,40 @@ from cosmo_tester.framework.handlers import (
     BaseHandler,
     BaseCloudifyInputsConfigReader)
 
+# Resource family, client type and listing method
+INVENTORY = [
+    ('instances', 'ec2', '_instances'),
+    ('key_pairs', 'ec2', '_key_pairs'),
+    ('elasticips', 'ec2', '_elasticips'),
+    ('security_groups', 'ec2', '_security_groups'),
+    ('volumes', 'ec2', '_volumes'),
+    ('snapshots', 'ec2', '_snapshots'),
+    ('load_balancers', 'elb', '_elbs'),
+    ('vpcs', 'vpc', '_vpcs'),
+    ('subnets', 'vpc', '_subnets'),
+    ('internet_gateways', 'vpc', '_internet_gateways'),
+    ('vpn_gateways', 'vpc', '_vpn_gateways'),
+    ('customer_gateways', 'vpc', '_customer_gateways'),
+    ('network_acls', 'vpc', '_network_acls'),
+    ('dhcp_options_sets', 'vpc', '_dhcp_options_sets'),
+    ('route_tables', 'vpc', '_route_tables')
+]
+
+# Resource families in the order they can be removed in
+REMOVAL_STAGES = [
+    ['instances', 'load_balancers', 'key_pairs', 'snapshots'],
+    ['elasticips', 'volumes'],
+    ['security_groups', 'customer_gateways', 'route_tables',
+     'network_acls'],
+    ['vpn_gateways', 'subnets', 'internet_gateways'],
+    ['vpcs'],
+    ['dhcp_options_sets']
+]
+
+REMOVAL_THREADS = 20
+TERMINATE_CHUNK_SIZE = 1000
+TERMINATE_ATTEMPTS = 30
+
 
 class EC2CleanupContext(BaseHandler.CleanupContext):
     def __init__(self, context_name, env):
@@ -168,240 +202,198 @@ class EC2Handler(BaseHandler):
         return connect_to_elb_region(elb_region, **credentials)
 
     def ec2_infra_state(self):
+        """Lists the resources of every family, one family per thread."""
 
-        ec2_client = self.ec2_client()
-        vpc_client = self.vpc_client()
-        elb_client = self.elb_client()
+        pool = ThreadPool(len(INVENTORY))
+        try:
+            families = pool.map(self._inventory, INVENTORY)
+        finally:
+            pool.close()
 
-        return {
-            'instances': dict(self._instances(ec2_client)),
-            'key_pairs': dict(self._key_pairs(ec2_client)),
-            'elasticips': dict(self._elasticips(ec2_client)),
-            'security_groups': dict(self._security_groups(ec2_client)),
-            'volumes': dict(self._volumes(ec2_client)),
-            'snapshots': dict(self._snapshots(ec2_client)),
-            'load_balancers': dict(self._elbs(elb_client)),
-            'vpcs': dict(self._vpcs(vpc_client)),
-            'subnets': dict(self._subnets(vpc_client)),
-            'internet_gateways': dict(self._internet_gateways(vpc_client)),
-            'vpn_gateways': dict(self._vpn_gateways(vpc_client)),
-            'customer_gateways': dict(self._customer_gateways(vpc_client)),
-            'network_acls': dict(self._network_acls(vpc_client)),
-            'dhcp_options_sets': dict(self._dhcp_options_sets(vpc_client)),
-            'route_tables': dict(self._route_tables(vpc_client))
-        }
+        return dict(families)
 
     def ec2_infra_state_delta(self, before, after):
 
-        after = copy.deepcopy(after)
-
         return {
-            prop: self._remove_keys(after[prop], before[prop].keys())
+            prop: dict((resource_id, after[prop][resource_id])
+                       for resource_id in
+                       set(after[prop]) - set(before[prop]))
             for prop in before.keys()
         }
 
     def remove_ec2_resources(self, resources_to_remove):
+        """Removes the resources stage by stage, so that nothing is
+        removed before the resources that depend on it. The resources of
+        a stage are removed in parallel.
+        """
 
-        ec2_client = self.ec2_client()
-        vpc_client = self.vpc_client()
-        elb_client = self.elb_client()
-
-        instances = self._instances(ec2_client)
-        key_pairs = self._key_pairs(ec2_client)
-        elasticips = self._elasticips(ec2_client)
-        security_groups = self._security_groups(ec2_client)
-        volumes = self._volumes(ec2_client)
-        snapshots = self._snapshots(ec2_client)
-        load_balancers = self._elbs(elb_client)
-        vpcs = self._vpcs(vpc_client)
-        subnets = self._subnets(vpc_client)
-        internet_gateways = self._internet_gateways(vpc_client)
-        vpn_gateways = self._vpn_gateways(vpc_client)
-        customer_gateways = self._customer_gateways(vpc_client)
-        network_acls = self._network_acls(vpc_client)
-        dhcp_options_sets = self._dhcp_options_sets(vpc_client)
-        route_tables = self._route_tables(vpc_client)
-
-        failed = {
-            'instances': {},
-            'key_pairs': {},
-            'elasticips': {},
-            'security_groups': {},
-            'volumes': {},
-            'snapshots': {},
-            'load_balancers': {},
-            'vpcs': {},
-            'subnets': {},
-            'internet_gateways': {},
-            'vpn_gateways': {},
-            'customer_gateways': {},
-            'network_acls': {},
-            'dhcp_options_sets': {},
-            'route_tables': {}
-        }
+        current_state = self.ec2_infra_state()
 
-        for instance_id, _ in instances:
-            if instance_id in resources_to_remove['instances']:
-                with self._handled_exception(instance_id, failed, 'instances'):
-                    specific_instance = \
-                        ec2_client.get_only_instances(instance_id)
-                    if instance_id not in \
-                            [instance.id for instance in specific_instance]:
-                        continue
-                    instance = specific_instance[0]
-                    instance.terminate()
-                    # We need to make sure that the instance is terminated
-                    # or VPC stuff is going to fail.
-                    for segment in range(5):
-                        if 'terminated' not in instance.update():
-                            # Terminate is idempotent
-                            instance.terminate()
-                            sleep(10)
-
-                    if 'terminated' not in instance.state:
-                        raise RuntimeError(
-                            'The test failed because '
-                            'instance would not terminate.')
-
-        for kp_name, _ in key_pairs:
-            if kp_name in resources_to_remove['key_pairs']:
-                with self._handled_exception(kp_name, failed, 'key_pairs'):
-                    ec2_client.delete_key_pair(kp_name)
-
-        for elasticip_id, elasticip in elasticips:
-            if elasticip_id in resources_to_remove['elasticips']:
-                with self._handled_exception(
-                        elasticip_id, failed, 'elasticips'):
-                    ec2_client.get_all_addresses(elasticip_id)[0].release()
-
-        for security_group_id, _ in security_groups:
-            if security_group_id in resources_to_remove['security_groups']:
-                with self._handled_exception(
-                        security_group_id, failed, 'security_groups'):
-                    ec2_client.get_all_security_groups(
-                        group_ids=[security_group_id])[0].delete()
-
-        for volume_id, _ in volumes:
-            if volume_id in resources_to_remove['volumes']:
-                with self._handled_exception(
-                        volume_id, failed, 'volumes'):
-                    volumes = []
-                    try:
-                        volumes = ec2_client.get_all_volumes(volume_id)
-                    except EC2ResponseError:
+        failed = dict((family, {}) for family, _, _ in INVENTORY)
+
+        pool = ThreadPool(REMOVAL_THREADS)
+        try:
+            for stage in REMOVAL_STAGES:
+                tasks = []
+                for family in stage:
+                    resource_ids = \
+                        set(current_state[family]) & \
+                        set(resources_to_remove.get(family, {}))
+                    if not resource_ids:
                         continue
-                    for volume in volumes:
-                        if 'in-use' in volume.status:
-                            volume.detach(force=True)
-                        volume.delete()
-
-        for snapshot_id, _ in snapshots:
-            if snapshot_id in resources_to_remove['snapshots']:
-                with self._handled_exception(
-                        snapshot_id, failed, 'snapshots'):
-                    ec2_client.get_all_snapshots(snapshot_id)[0].delete()
-
-        for elb_name, _ in load_balancers:
-            if elb_name in resources_to_remove['load_balancers']:
-                with self._handled_exception(
-                        elb_name, failed, 'load_balancers'):
-                    elb_client.get_all_load_balancers(elb_name)[0].delete()
-
-        for customer_gateway_id, _ in customer_gateways:
-            if customer_gateway_id in resources_to_remove['customer_gateways']:
-                with self._handled_exception(customer_gateway_id,
-                                             failed,
-                                             'customer_gateways'):
-                    for vpnx in vpc_client.get_all_vpn_connections():
-                        if customer_gateway_id in vpnx.customer_gateway_id:
-                            vpnx.delete()
-                    vpc_client.delete_customer_gateway(customer_gateway_id)
-
-        for vpn_gateway_id, _ in vpn_gateways:
-            if vpn_gateway_id in resources_to_remove['vpn_gateways']:
-                with self._handled_exception(vpn_gateway_id,
-                                             failed,
-                                             'vpn_gateways'):
-                    vgws = vpc_client.get_all_vpn_gateways(vpn_gateway_id)
-                    for vgw in vgws:
-                        for attachment in vgw.attachments:
-                            try:
-                                vpc_client.detach_vpn_gateway(
-                                    vgw.id, attachment.vpc_id)
-                            except EC2ResponseError:
-                                pass
-                    vpc_client.delete_vpn_gateway(vpn_gateway_id)
-
-        for subnet_id, _ in subnets:
-            if subnet_id in resources_to_remove['subnets']:
-                with self._handled_exception(subnet_id, failed, 'subnets'):
-                    vpc_client.delete_subnet(subnet_id)
-
-        for internet_gateway_id, _ in internet_gateways:
-            if internet_gateway_id in resources_to_remove['internet_gateways']:
-                with self._handled_exception(internet_gateway_id,
-                                             failed,
-                                             'internet_gateways'):
-                    igs = vpc_client.get_all_internet_gateways(
-                        internet_gateway_id)
-                    for ig in igs:
-                        for attachment in ig.attachments:
-                            try:
-                                vpc_client.detach_internet_gateway(
-                                    internet_gateway_id, attachment.vpc_id)
-                            except EC2ResponseError:
-                                pass
-                    vpc_client.delete_internet_gateway(internet_gateway_id)
-
-        for dhcp_options_set_id, _ in dhcp_options_sets:
-            if dhcp_options_set_id in resources_to_remove['dhcp_options_sets']:
-                with self._handled_exception(dhcp_options_set_id,
-                                             failed,
-                                             'dhcp_options_sets'):
-                    vpc_client.delete_dhcp_options(dhcp_options_set_id)
-
-        for route_table_id, _ in route_tables:
-            if route_table_id in resources_to_remove['route_tables']:
-                with self._handled_exception(route_table_id, failed,
-                                             'route_tables'):
-                    for route_table in vpc_client.get_all_route_tables(
-                            route_table_id):
-                        for association in route_table.associations:
-                            vpc_client.disassociate_route_table(
-                                association.id)
-                        for route in route_table.routes:
-                            try:
-                                vpc_client.delete_route(
-                                    route_table.id,
-                                    route.destination_cidr_block)
-                            except EC2ResponseError:
-                                pass
-                    vpc_client.delete_route_table(route_table_id)
-
-        for network_acl_id, _ in network_acls:
-            if network_acl_id in resources_to_remove['network_acls']:
-                with self._handled_exception(network_acl_id,
-                                             failed,
-                                             'network_acls'):
-                    for network_acl in vpc_client.get_all_network_acls(
-                            network_acl_id):
-                        for association in network_acl.associations:
-                            vpc_client.disassociate_network_acl(
-                                association.subnet_id)
-                    vpc_client.delete_network_acl(network_acl_id)
-
-        for vpc_id, _ in vpcs:
-            if vpc_id in resources_to_remove['vpcs']:
-                with self._handled_exception(vpc_id, failed, 'vpcs'):
-                    for peer_cx in \
-                            vpc_client.get_all_vpc_peering_connections():
-                        if vpc_id in peer_cx.requester_vpc_info.vpc_id:
-                            vpc_client.delete_vpc_peering_connection(
-                                peer_cx.id)
-                    vpc_client.delete_vpc(vpc_id)
+                    if family == 'instances':
+                        tasks.append((family, tuple(sorted(resource_ids))))
+                    else:
+                        tasks.extend((family, resource_id)
+                                     for resource_id in resource_ids)
+                for family, result in pool.map(self._remove, tasks):
+                    for resource_ids, ex in result.items():
+                        if not isinstance(resource_ids, tuple):
+                            resource_ids = [resource_ids]
+                        for resource_id in resource_ids:
+                            failed[family][resource_id] = ex
+        finally:
+            pool.close()
 
         return failed
 
+    def _inventory(self, family_spec):
+        family, client_type, list_function = family_spec
+        client = self._client(client_type)
+        return family, dict(getattr(self, list_function)(client))
+
+    def _client(self, client_type):
+        # boto connections are not thread safe, every thread uses its own
+        return {
+            'ec2': self.ec2_client,
+            'vpc': self.vpc_client,
+            'elb': self.elb_client
+        }[client_type]()
+
+    def _remove(self, task):
+        family, resource_id = task
+        failed = {family: {}}
+        with self._handled_exception(resource_id, failed, family):
+            getattr(self, '_remove_{0}'.format(family))(resource_id)
+        return family, failed[family]
+
+    def _remove_instances(self, instance_ids):
+        """Terminates all the instances together and waits for them with
+        one describe call per attempt.
+        """
+
+        ec2_client = self.ec2_client()
+
+        for index in range(0, len(instance_ids), TERMINATE_CHUNK_SIZE):
+            ec2_client.terminate_instances(
+                list(instance_ids[index:index + TERMINATE_CHUNK_SIZE]))
+
+        # We need to make sure that the instances are terminated
+        # or VPC stuff is going to fail.
+        remaining = set(instance_ids)
+        for segment in range(TERMINATE_ATTEMPTS):
+            remaining = set(
+                instance.id for instance in
+                ec2_client.get_only_instances(sorted(remaining))
+                if 'terminated' not in instance.state)
+            if not remaining:
+                return
+            sleep(10)
+
+        raise RuntimeError(
+            'The test failed because instances {0} would not terminate.'
+            .format(sorted(remaining)))
+
+    def _remove_key_pairs(self, kp_name):
+        self.ec2_client().delete_key_pair(kp_name)
+
+    def _remove_elasticips(self, elasticip_id):
+        self.ec2_client().get_all_addresses(elasticip_id)[0].release()
+
+    def _remove_security_groups(self, security_group_id):
+        self.ec2_client().get_all_security_groups(
+            group_ids=[security_group_id])[0].delete()
+
+    def _remove_volumes(self, volume_id):
+        try:
+            volumes = self.ec2_client().get_all_volumes(volume_id)
+        except EC2ResponseError:
+            return
+        for volume in volumes:
+            if 'in-use' in volume.status:
+                volume.detach(force=True)
+            volume.delete()
+
+    def _remove_snapshots(self, snapshot_id):
+        self.ec2_client().get_all_snapshots(snapshot_id)[0].delete()
+
+    def _remove_load_balancers(self, elb_name):
+        self.elb_client().get_all_load_balancers(elb_name)[0].delete()
+
+    def _remove_customer_gateways(self, customer_gateway_id):
+        vpc_client = self.vpc_client()
+        for vpnx in vpc_client.get_all_vpn_connections():
+            if customer_gateway_id in vpnx.customer_gateway_id:
+                vpnx.delete()
+        vpc_client.delete_customer_gateway(customer_gateway_id)
+
+    def _remove_vpn_gateways(self, vpn_gateway_id):
+        vpc_client = self.vpc_client()
+        vgws = vpc_client.get_all_vpn_gateways(vpn_gateway_id)
+        for vgw in vgws:
+            for attachment in vgw.attachments:
+                try:
+                    vpc_client.detach_vpn_gateway(
+                        vgw.id, attachment.vpc_id)
+                except EC2ResponseError:
+                    pass
+        vpc_client.delete_vpn_gateway(vpn_gateway_id)
+
+    def _remove_subnets(self, subnet_id):
+        self.vpc_client().delete_subnet(subnet_id)
+
+    def _remove_internet_gateways(self, internet_gateway_id):
+        vpc_client = self.vpc_client()
+        igs = vpc_client.get_all_internet_gateways(internet_gateway_id)
+        for ig in igs:
+            for attachment in ig.attachments:
+                try:
+                    vpc_client.detach_internet_gateway(
+                        internet_gateway_id, attachment.vpc_id)
+                except EC2ResponseError:
+                    pass
+        vpc_client.delete_internet_gateway(internet_gateway_id)
+
+    def _remove_dhcp_options_sets(self, dhcp_options_set_id):
+        self.vpc_client().delete_dhcp_options(dhcp_options_set_id)
+
+    def _remove_route_tables(self, route_table_id):
+        vpc_client = self.vpc_client()
+        for route_table in vpc_client.get_all_route_tables(route_table_id):
+            for association in route_table.associations:
+                vpc_client.disassociate_route_table(association.id)
+            for route in route_table.routes:
+                try:
+                    vpc_client.delete_route(
+                        route_table.id, route.destination_cidr_block)
+                except EC2ResponseError:
+                    pass
+        vpc_client.delete_route_table(route_table_id)
+
+    def _remove_network_acls(self, network_acl_id):
+        vpc_client = self.vpc_client()
+        for network_acl in vpc_client.get_all_network_acls(network_acl_id):
+            for association in network_acl.associations:
+                vpc_client.disassociate_network_acl(association.subnet_id)
+        vpc_client.delete_network_acl(network_acl_id)
+
+    def _remove_vpcs(self, vpc_id):
+        vpc_client = self.vpc_client()
+        for peer_cx in vpc_client.get_all_vpc_peering_connections():
+            if vpc_id in peer_cx.requester_vpc_info.vpc_id:
+                vpc_client.delete_vpc_peering_connection(peer_cx.id)
+        vpc_client.delete_vpc(vpc_id)
+
     def _client_credentials(self):
 
         region = get_region(self.env.ec2_region_name)
@@ -418,9 +410,9 @@ class EC2Handler(BaseHandler):
                 if 'default' not in security_group.name]
 
     def _instances(self, ec2_client):
-        return [(instance[0].id, instance[0].id)
-                for instance in
-                [res.instances for res in ec2_client.get_all_reservations()]]
+        return [(instance.id, instance.id)
+                for reservation in ec2_client.get_all_reservations()
+                for instance in reservation.instances]
 
     def _key_pairs(self, ec2_client):
         return [(kp.name, kp.name)
@@ -510,17 +502,11 @@ class EC2Handler(BaseHandler):
                 if rtb.vpc_id != default_vpc and not any(
                 association.main for association in rtb.associations)]
 
-    def _remove_keys(self, dct, keys):
-        for key in keys:
-            if key in dct:
-                del dct[key]
-        return dct
-
     @contextmanager
     def _handled_exception(self, resource_id, failed, resource_group):
         try:
             yield
-        except BaseException, ex:
+        except Exception as ex:
             failed[resource_group][resource_id] = ex
 
 
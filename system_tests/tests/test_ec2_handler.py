@@ -0,0 +1,171 @@
+########
+# Copyright (c) 2015 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import sys
+import types
+import threading
+
+# Third Party Imports
+import mock
+import testtools
+
+
+def _import_ec2_handler():
+    """Imports the handler with a minimal stand-in for the cosmo_tester
+    framework, which is only installed where the system tests run.
+    """
+
+    class BaseHandler(object):
+        class CleanupContext(object):
+            pass
+
+    handlers = types.ModuleType('cosmo_tester.framework.handlers')
+    handlers.BaseHandler = BaseHandler
+    handlers.BaseCloudifyInputsConfigReader = object
+
+    modules = {
+        'cosmo_tester': types.ModuleType('cosmo_tester'),
+        'cosmo_tester.framework': types.ModuleType('cosmo_tester.framework'),
+        'cosmo_tester.framework.handlers': handlers
+    }
+    with mock.patch.dict(sys.modules, modules):
+        from system_tests import ec2_handler
+    return ec2_handler
+
+
+ec2_handler = _import_ec2_handler()
+
+
+class MockInstance(object):
+
+    def __init__(self, instance_id):
+        self.id = instance_id
+        self.state = 'terminated'
+
+
+class MockReservation(object):
+
+    def __init__(self, *instance_ids):
+        self.instances = [MockInstance(instance_id)
+                          for instance_id in instance_ids]
+
+
+class TestRemoveEC2Resources(testtools.TestCase):
+
+    def setUp(self):
+        super(TestRemoveEC2Resources, self).setUp()
+        self.handler = ec2_handler.EC2Handler.__new__(ec2_handler.EC2Handler)
+        self.removed = []
+        self.lock = threading.Lock()
+        self.failures = {}
+        for family in [family for family, _, _ in ec2_handler.INVENTORY]:
+            self.patch(self.handler, '_remove_{0}'.format(family),
+                       self._remover(family))
+
+    def _remover(self, family):
+        def remove(resource_id):
+            with self.lock:
+                self.removed.append((family, resource_id))
+            resource_ids = resource_id if isinstance(
+                resource_id, tuple) else (resource_id,)
+            for failing_id in resource_ids:
+                if failing_id in self.failures:
+                    raise self.failures[failing_id]
+        return remove
+
+    def _state(self, **families):
+        state = dict((family, {}) for family, _, _ in ec2_handler.INVENTORY)
+        for family, resource_ids in families.items():
+            state[family] = dict((resource_id, resource_id)
+                                 for resource_id in resource_ids)
+        return state
+
+    def _remove(self, current_state, resources_to_remove):
+        with mock.patch.object(self.handler, 'ec2_infra_state',
+                               return_value=current_state):
+            return self.handler.remove_ec2_resources(resources_to_remove)
+
+    def test_instances_of_every_reservation(self):
+        ec2_client = mock.Mock()
+        ec2_client.get_all_reservations.return_value = [
+            MockReservation('i-1', 'i-2'), MockReservation('i-3')]
+        self.assertEqual(
+            [('i-1', 'i-1'), ('i-2', 'i-2'), ('i-3', 'i-3')],
+            self.handler._instances(ec2_client))
+
+    def test_stages_removed_in_order(self):
+        state = self._state(instances=['i-1'], elasticips=['1.2.3.4'],
+                            subnets=['subnet-1'], vpcs=['vpc-1'],
+                            dhcp_options_sets=['dopt-1'])
+        failed = self._remove(state, state)
+
+        self.assertEqual(
+            [('instances', ('i-1',)), ('elasticips', '1.2.3.4'),
+             ('subnets', 'subnet-1'), ('vpcs', 'vpc-1'),
+             ('dhcp_options_sets', 'dopt-1')],
+            self.removed)
+        self.assertFalse(any(failed.values()))
+
+    def test_only_requested_and_existing_resources_removed(self):
+        state = self._state(vpcs=['vpc-1', 'vpc-2'])
+        self._remove(state, self._state(vpcs=['vpc-2', 'vpc-3']))
+
+        self.assertEqual([('vpcs', 'vpc-2')], self.removed)
+
+    def test_all_instances_terminated_together(self):
+        self.patch(self.handler, '_remove_instances',
+                   ec2_handler.EC2Handler._remove_instances.__get__(
+                       self.handler))
+        ec2_client = mock.Mock()
+        ec2_client.get_all_reservations.return_value = [
+            MockReservation('i-1', 'i-2'), MockReservation('i-3')]
+        ec2_client.get_only_instances.side_effect = \
+            lambda instance_ids: [MockInstance(instance_id)
+                                  for instance_id in instance_ids]
+        self.patch(self.handler, 'ec2_client', lambda: ec2_client)
+
+        state = self._state(
+            instances=[instance_id for instance_id, _ in
+                       self.handler._instances(ec2_client)])
+        failed = self._remove(state, state)
+
+        ec2_client.terminate_instances.assert_called_once_with(
+            ['i-1', 'i-2', 'i-3'])
+        self.assertEqual({}, failed['instances'])
+
+    def test_failure_recorded_per_resource(self):
+        error = RuntimeError('DependencyViolation')
+        self.failures = {'sg-1': error, 'i-2': error}
+        state = self._state(instances=['i-1', 'i-2'],
+                            security_groups=['sg-1', 'sg-2'])
+        failed = self._remove(state, state)
+
+        self.assertEqual({'i-1': error, 'i-2': error}, failed['instances'])
+        self.assertEqual({'sg-1': error}, failed['security_groups'])
+        self.assertIn(('security_groups', 'sg-2'), self.removed)
+
+    def test_only_exceptions_are_handled(self):
+        failed = {'vpcs': {}}
+        error = RuntimeError('in use')
+        with self.handler._handled_exception('vpc-1', failed, 'vpcs'):
+            raise error
+        self.assertEqual({'vpc-1': error}, failed['vpcs'])
+
+        def interrupted():
+            with self.handler._handled_exception('vpc-2', failed, 'vpcs'):
+                raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, interrupted)
+        self.assertNotIn('vpc-2', failed['vpcs'])